@@ -8,54 +8,71 @@ manage a database containing the library's books, their members and records
 of books borrowed and returned. To make it more realistic, the user can
 opt to 'scan' in library cards and books when using the features.
 
+This module is the interactive menu. The library's rules live in
+LibraryService (see library_service.py), which can be used
+on its own without a terminal. Importing this module has no side effects,
+the menu is started by running it or calling main().
+
 Functions
 ---------
 get_member:
     Obtains a valid member id from the user.
 get_book:
     Obtains a valid ISBN from the user, and notes if the isbn is already used.
-scan_all_books:
-    Returns a random ISBN from all books in the library.
-scan_from_shelf:
-    Returns a random ISBN from all books in the library that are not on loan.
-scan_from_user:
-    Returns a random ISBN from books the member has on loan.
-return_book:
-    Records a book returning to the library.
-borrow_book:
-    Records a book being taken out of the library.
-pay_fine:
-    Allows a member's fines to be cleared.
-reward:
-    Records reward points, increases borrow limit when member has enough rewards.
-fine:
-    Records a fine and resets the member's rewards and borrow limit.
 add_book:
     Adds a book to the library stock.
 remove_book:
     Removes a book from the library stock.
-add_member:
-    Adds a new library member to the database.
-user_id:
-    Returns a random new or random existing member ID.
 search_books:
-    Allows the user to search for books by title or author.
+    Allows the user to search for books by title, author or both.
 print_book_record:
     Displays the record for a book.
 print_all_books:
     Displays the records for all books.
 print_loaned_books:
     Displays the records for books currently out on loan.
+print_members:
+    Displays the records for all library members.
+print_loan_history:
+    Displays every loan a member has made.
+print_member_holds:
+    Displays the books a member has on hold.
+check_counters:
+    Checks the counts of copies on loan and on hold, holds waiting and
+    members' loans, and corrects any errors.
+print_query_stats:
+    Displays the time taken by each kind of SQL statement, and how often
+    books and members are found in the cache.
+print_slow_queries:
+    Displays recent slow SQL statements and their query plans.
+main:
+    Runs the menu.
 """
 
-import sqlite3
-import random as rd
-from tabulate import tabulate
+import argparse
+
+from library_branches import (BranchLibrary, BranchService, connect_branch,
+                              find_branches)
+from library_cache import LibraryCache
+from library_pool import configure, connect_readonly
+from library_reports import print_report
+from library_schema import connect
+from library_service import LibraryService, valid_isbn
+from library_stats import QueryStats
+
+
+# Slow queries are appended to this file while query timing is on.
+SLOW_LOG = 'library_slow_queries.jsonl'
 
 
-def get_member():
+def get_member(service):
     """Function to get a valid member id from the user.
 
+    Parameters
+    ----------
+    service: LibraryService
+        The library to look the member up in.
+
     Returns
     -------
     int
@@ -72,30 +89,32 @@ def get_member():
                                "or 0 to scan their card: "))
             if member == 0:
                 # Use 'scan' feature:
-                member = user_id(True)
+                member = service.user_id(True)
+                if member is None:
+                    print("Error: There are no member cards to scan.")
+                    continue
                 print(f"*Beep!* Card {member} accepted.")
                 break
+            elif not service.member_exists(member):
+                # The ID entered is not in the db:
+                print("Error: ID not found.")
             else:
-                # Check if the ID entered exists in the db:
-                cursor.execute('''SELECT * FROM users WHERE id = ?;'''
-                               , (member,))
-                id_list = cursor.fetchone()
-                if id_list is None:
-                    print("Error: ID not found.")
-                else:
-                    break
+                break
         except ValueError:
             print("Error: Invalid ID format.")
     return member
 
 
-def get_book(scan_type, member_id=None):
+def get_book(service, scan_type, member_id=None):
     """Function to get a valid ISBN from the user.
 
     Parameters
     ----------
+    service: LibraryService
+        The library to look the book up in.
     scan_type :
-        The scan function required (scan_all_books, scan_from_shelf or scan_from_user).
+        The scan method required (service.scan_all_books,
+        service.scan_from_shelf or service.scan_from_user).
     member_id: int
         The id of the member, only required for scan_from_user.
 
@@ -115,12 +134,15 @@ def get_book(scan_type, member_id=None):
             # Asks the user for an ISBN or to 'scan' book:
             book_isbn = int(input("Please enter the book ISBN or "
                                   "0 to scan the book: "))
-            if book_isbn > 0 and len(str(book_isbn)) == 13:
+            if valid_isbn(book_isbn):
                 # A valid ISBN number was entered
                 break
             elif book_isbn == 0:
                 # Run the 'scan' feature:
                 book_isbn = scan_type(member_id)
+                if book_isbn is None:
+                    print("Error: There are no books to scan.")
+                    continue
                 print(f"*Beep!* ISBN: {book_isbn}")
                 break
             else:
@@ -129,285 +151,19 @@ def get_book(scan_type, member_id=None):
             print("Error: ISBN must be a 13 digit number")
 
     # Checks if the ISBN is already in the db:
-    cursor.execute('''
-        SELECT EXISTS(
-            SELECT 1 FROM books WHERE isbn = ?);''', (book_isbn,))
-    exists = cursor.fetchone()[0]
+    return book_isbn, service.book_exists(book_isbn)
 
-    return book_isbn, exists
 
-
-def scan_all_books(member_id=None):
-    """Function to return a random ISBN from the library collection.
+def add_book(service):
+    """Function to add books to the library stock.
 
     Parameters
     ----------
-    member_id
-        Not required for this function (see get_book).
+    service: LibraryService
+        The library to add the book to."""
 
-    Returns
-    -------
-    int
-        A valid ISBN from the database."""
-    
-    # Fetches a list of ISBNs from books table:
-    cursor.execute('''SELECT isbn FROM books;''')
-    isbn_list = cursor.fetchall()
-
-    # Selects an ISBN at random:
-    isbn = rd.choice(isbn_list)[0]
-
-    return isbn
-
-
-def scan_from_shelf(member_id=None):
-    """Function to return a random ISBN from the library collection,
-    but only from copies that are not out on loan.
-
-    Parameters
-    ----------
-    member_id
-        Not required for this function (see get_book).
-
-    Returns
-    -------
-    int
-        A valid ISBN from books held in the database that are not on loan."""
-
-    # Fetches a list of ISBNs for books not on loan:
-    cursor.execute('''
-                    SELECT bk.isbn
-                    FROM books AS bk
-                    LEFT JOIN (
-                        SELECT * FROM records 
-                        WHERE returned = 'FALSE') AS rc
-                    ON bk.isbn = rc.isbn
-                    GROUP BY bk.isbn
-                    HAVING  MAX(bk.stock) - COUNT(rc.returned) > 0;
-                ''')
-    isbn_list = cursor.fetchall()
-
-    # Selects an ISBN at random:
-    isbn = rd.choice(isbn_list)[0]
-
-    return isbn
-
-
-def scan_from_user(member_id):
-    """Function to return a random ISBN from the books taken out by a user.
-
-    Parameters
-    ----------
-    member_id: int
-        The ID of the member.
-
-    Returns
-    -------
-    int
-        A valid ISBN from the books the member has on loan."""
-
-    # Fetches a list of ISBNs of books on loan with member:
-    cursor.execute('''SELECT isbn FROM records
-                        WHERE user_id = ? AND returned = 'FALSE';''',
-                   (member_id,))
-    isbn_list = cursor.fetchall()
-
-    # Selects an ISBN at random:   
-    isbn = rd.choice(isbn_list)[0]
-
-    return isbn
-
-
-def return_book(ISBN, member_id):
-    """Function to record a book returning to library.
-
-    Parameters
-    ----------
-    ISBN: int
-        The ISBN of the book being returned.
-    member_id: int
-        The id of the member who is attempting to return the book."""
-
-    # Check user has checked the book out:
-    cursor.execute('''SELECT * FROM records 
-                WHERE user_id = ?
-                AND isbn = ?
-                AND returned = 'FALSE';''',
-                   (member_id, ISBN))
-    check_book = cursor.fetchall()
-    # print(check_book)
-
-    if not check_book:
-        print(f"Error: Member {member_id} does not have this book on loan.")
-        pass
-
-    # Update the record
-    cursor.execute('''
-                UPDATE records
-                SET date_checked_in = DATE(), returned = 'TRUE'
-                WHERE isbn = ? AND user_id = ?;''',
-                   (ISBN, member_id))
-    db.commit()
-    print("Book successfully returned.")
-
-
-def borrow_book(ISBN, member_id):
-    """Function to borrow a book from the library.
-    Parameters
-    ----------
-    ISBN: int
-        The ISBN of the book to be borrowed.
-    member_id: int
-        The id of the member wishing to borrow the book."""
-
-    # Check that the book is in stock:
-    cursor.execute('''
-                SELECT bk.isbn
-                FROM books AS bk
-                LEFT JOIN (
-                    SELECT * FROM records 
-                    WHERE returned = 'FALSE') AS rc
-                ON bk.isbn = rc.isbn
-                WHERE bk.isbn = ?
-                GROUP BY bk.isbn
-                HAVING  MAX(bk.stock) - COUNT(rc.returned) > 0;
-            ''', (ISBN,))
-    check_stock = cursor.fetchone()
-
-    # Check user has not already got a copy of the book out:
-    cursor.execute('''
-                SELECT * FROM records 
-                WHERE isbn = ? AND  user_id = ? AND returned = 'FALSE';''',
-                   (ISBN, member_id))
-    check_user_copy = cursor.fetchone()
-
-    # Check borrowing limit not reached and check user has no fines:
-    cursor.execute('''
-            SELECT u.name, MAX(fines), MAX(borrow_limit) - COUNT(rc.returned)
-            FROM users as u
-            LEFT JOIN (
-                SELECT * FROM records
-                WHERE returned = 'FALSE') AS rc
-            ON u.id = rc.user_id
-            where u.id = ?
-            GROUP BY u.name;
-        ''', (member_id,))
-    check_user = cursor.fetchone()
-
-    if not check_stock:
-        # No copies left on the shelves
-        print("Error: All copies are currently out on loan.")
-    elif check_user_copy:
-        # User has already taken the book out
-        print(f"Error: {check_user[0]} has already got a copy on loan.")
-    elif check_user[1] > 0:
-        # User has fines
-        print(f"Error: {check_user[0]} has outstanding "
-              "fines to be paid before borrowing.")
-    elif check_user[2] == 0:
-        # User has reached borrowing limit
-        print(f"Error: {check_user[0]} has reached their borrowing limit.")
-    else:
-        cursor.execute('''
-                        INSERT INTO records(
-                        isbn, user_id, date_checked_out, returned)
-                        VALUES(?,?,DATE(),'FALSE');''',
-                       (ISBN, member_id))
-        db.commit()
-        print(f"{check_user[0]} successfully checked out {ISBN}")
-
-
-def pay_fine(member_id):
-    """Function to record that a fine has been paid.
-
-    Parameters
-    ----------
-    member_id: int
-        The id of the member paying a fine."""
-
-    # Check if a member has an outstanding fine:
-    cursor.execute('''SELECT fines FROM users WHERE id = ?;''', (member_id,))
-    fine_number = cursor.fetchone()[0]
-
-    if fine_number == 0:
-        # Member does not have any fines
-        print("No fines to pay.")
-    else:
-        # Calculates fine cost:
-        fine_total = fine_number * 1.50
-        print(f"Please pay £{fine_total:.2f}")
-
-        # Clears the fine (as if been paid):
-        print("*Beep!*")
-        cursor.execute('''UPDATE users SET fines = 0 WHERE id = ?;''',
-                       (member_id,))
-        db.commit()
-        print("Fines successfully paid.")
-
-
-def reward(member_id):
-    """Function to give a user a reward for returning books on time.
-
-    Parameters
-    ----------
-    member_id: int
-        The id of the member getting a reward point.
-    
-    Notes
-    -----
-        The borrowing limit is increased by 1 book each time 10 rewards
-        are collected, until 6 books can be borrowed. Rewards are reset
-        each time the borrowing limit is increased."""
-    
-    # Records the reward in the member's record:
-    cursor.execute('''
-            UPDATE users
-            SET rewards = rewards + 1
-            WHERE id = ?;''', (member_id,))
-    db.commit()
-    print("Reward point earned!")
-
-    # Fetches the current borrow limit for the member:
-    cursor.execute('''SELECT name, rewards, borrow_limit FROM users 
-                    WHERE id = ?;''', (member_id,))
-    reward_check = cursor.fetchone()
-
-    if reward_check[1] > 9 and reward_check[2] < 6:
-        # Increases borrowing limit if conditions are met:
-        print(f"Congratulations to {reward_check[0]}! "
-              f"They have earned 10 rewards and can now borrow"
-              f" {reward_check[2] + 1} books!")
-        cursor.execute('''
-                    UPDATE users
-                    SET rewards = 0, borrow_limit = borrow_limit + 1
-                    WHERE id = ?;''', (member_id,))
-        db.commit()
-
-
-def fine(member_id, fine_qty=1):
-    """Function to give the user a fine for a late return / lost book.
-
-    Parameters
-    ----------
-    member_id: int
-        The id of the member being given a fine.
-    fine_qty: int
-        The number of fines. This can be used to charge a larger amount for a lost book."""
-    
-    # Records fine in db:
-    cursor.execute('''
-                UPDATE users
-                SET fines = fines + ?, rewards = 0, borrow_limit = 3
-                WHERE id = ?;''', (fine_qty, member_id))
-    db.commit()
-    print("Fine has been issued")
-
-
-def add_book():
-    """Function to add books to the library stock."""
-
-    book = get_book(scan_all_books)
-    if book[1] == 1:
+    book = get_book(service, service.scan_all_books)
+    if book[1]:
         # Book already exists in library, user can add more copies:
         while True:
             try:
@@ -416,12 +172,7 @@ def add_book():
                                       "add to the stock?: "))
                 if add_stock >= 0:
                     # Updates number of copies:
-                    cursor.execute('''
-                            UPDATE books 
-                            SET stock = stock + ?
-                            WHERE isbn = ?;''', (add_stock, book[0]))
-                    db.commit()
-                    print("Stock updated.")
+                    print(service.add_stock(book[0], add_stock).message)
                     break
                 else:
                     print("Error: Invalid number.")
@@ -449,257 +200,274 @@ def add_book():
                 print("Error: Book stock must be a whole number.")
 
         # Records the new book record in books table:
-        cursor.execute('''
-                INSERT INTO books(isbn, title, author, stock)
-                VALUES(?,?,?,?);
-                ''', (book[0], book_title, book_author, book_stock))
-        db.commit()
-        print(f"{book_stock} copies of {book_title} added to database.")
+        print(service.add_book(book[0], book_title, book_author,
+                               book_stock).message)
 
 
-def remove_book(ISBN):
+def remove_book(service, ISBN):
     """Function to remove a book from stock, e.g. when lost.
 
     Parameters
     ----------
+    service: LibraryService
+        The library to remove the book from.
     ISBN: int
         The ISBN of the book being removed from stock."""
 
-    # Checks stock is more than 0:
-    cursor.execute('''SELECT stock FROM books WHERE isbn = ?;''', (ISBN,))
-    stock = cursor.fetchone()[0]
-
-    if stock > 0:
-        print("Book has stock")
-        # Checks if the book is on loan:
-        cursor.execute('''
-                SELECT user_id from records 
-                WHERE isbn = ? AND returned = 'FALSE';''', (ISBN,))
-        users_list = cursor.fetchall()
-        check_list = []
-
-        if users_list:
-            # Show who has the book on loan:
-            print("The following members currently have the book on loan:")
-            for item in users_list:
-                print(item[0])
-                check_list.append(item[0])
-            while True:
-                try:
-                    # Asks user if the copy to remove is one on loan:
-                    bad_member = int(
-                        input("If a member lost / damaged the book, "
-                              "please enter their number, "
-                              "else enter 0: "))
-                    
-                    if bad_member == 0:
-                        # Remove a copy held on shelf
-                        if len(check_list) == stock:
-                            print(
-                                "Error: All stock is on loan, please enter a user")
-                        else:
-                            break
+    # Checks if the book is on loan:
+    users_list = service.loan_holders(ISBN)
+    bad_member = None
+
+    if users_list and service.book_stock(ISBN):
+        # Show who has the book on loan:
+        print("The following members currently have the book on loan:")
+        for item in users_list:
+            print(item)
+        while True:
+            try:
+                # Asks user if the copy to remove is one on loan:
+                bad_member = int(
+                    input("If a member lost / damaged the book, "
+                          "please enter their number, "
+                          "else enter 0: ")) or None
+
+                # Returns the book to stock and fines member if needed:
+                outcome = service.remove_book(ISBN, bad_member)
+                if outcome.status not in ('all_on_loan', 'not_on_loan'):
+                    break
+                print(outcome.message)
+            except ValueError:
+                print("Error: Invalid member number")
+    else:
+        outcome = service.remove_book(ISBN)
+
+    print(outcome.message)
 
-                    elif bad_member in check_list:
-                        # Returns the book to stock and fines member:
-                        return_book(ISBN, bad_member)
-                        fine(bad_member, 5)
-                        break
-                    else:
-                        print("Error: Incorrect member number")
-                except ValueError:
-                    print("Error: Invalid member number")
 
-        # Reduce stock of the book by 1:
-        cursor.execute(
-            '''UPDATE books SET stock = stock - 1 WHERE isbn = ?;''',
-            (ISBN,))
-        db.commit()
-        print("One copy successfully removed from the stock record.")
+def search_books(service, column_name, search_for):
+    """Function to search for books in the library and display results.
+
+    Parameters
+    ----------
+    service: LibraryService
+        The library to search.
+    column_name: str
+        The column to be searched, either 'title' or 'author', or None to
+        search both.
+    search_for: str
+        The string the user wishes to look for."""
 
+    books_found = service.search_books(column_name, search_for)
+    if books_found:
+        for row in books_found:
+            print(f"ISBN: {row[0]}\tTitle: {row[1]}\tAuthor: {row[2]}")
     else:
-        print("Error: There are no copies of this book stocked.")
+        print("No books were found matching your search term.")
 
 
-def add_member(user_name):
-    """Function to add a new member to the database.
+def print_book_record(service, ISBN):
+    """Function to display a book record.
 
     Parameters
     ----------
-    user_name: str
-        The name of the member being added to the database."""
+    service: LibraryService
+        The library holding the book.
+    ISBN: int
+        The ISBN to display records for."""
 
-    # Obtains an ID for the new member:
-    new_id = user_id(False)
+    from tabulate import tabulate
 
-    # Creates a record for the new member:
-    cursor.execute('''
-            INSERT INTO users(id, name, fines, rewards, borrow_limit)
-            VALUES(?,?,0,0,3);
-            ''', (new_id, user_name))
-    db.commit()
-    print(f"Membership number {new_id}, {user_name} added to database.")
+    record = service.book_record(ISBN)
+    headings = ['ISBN', 'Title', 'Author', 'Copies Available']
+    print(tabulate([record] if record else [], headers=headings))
 
 
-def user_id(exists):
-    """Function to return a random new id or a random existing id.
+def print_all_books(service):
+    """Function to display all books in library database.
 
     Parameters
     ----------
-    exists: bool
-        True if an existing id is required.
+    service: LibraryService
+        The library to list."""
 
-    Returns
-    -------
-    int
-        A new random id if exists=False, a random id from database if exists=True."""
+    # Shown a page at a time, so the first books appear straight away:
+    print_report(service, 'books')
 
-    # Fetches a list of existing IDs:
-    cursor.execute('''SELECT id FROM users;''')
-    id_list = cursor.fetchall()
-    _id_list = [i[0] for i in id_list]
 
-    if exists:
-        # Select from the existing ids:
-        rand_id = rd.choice(_id_list)
-    else:
-        while True:
-            # Select a random number, repeat if id is already in use:
-            rand_id = rd.randint(1000, 9999)
-            if rand_id not in _id_list:
-                break
-    return rand_id
+def print_loaned_books(service):
+    """Function to display all books out on loan.
 
+    Parameters
+    ----------
+    service: LibraryService
+        The library to list."""
 
-def search_books(column_name, search_for):
-    """Function to search for books in the library and display results.
+    print_report(service, 'loans')
+
+
+def print_members(service):
+    """Function to display all library members.
 
     Parameters
     ----------
-    column_name: str
-        The column to be searched, either 'title' or 'author'.
-    search_for: str
-        The string the user wishes to look for."""
+    service: LibraryService
+        The library to list."""
 
-    search_for = '%' + search_for + '%'
-    cursor.execute('''
-            SELECT isbn, title, author
-            FROM books
-            WHERE (%s) LIKE ?;''' % (column_name), (search_for,))
-    books_found = cursor.fetchall()
-    if books_found:
-        for row in books_found:
-            print(f"ISBN: {row[0]}\tTitle: {row[1]}\tAuthor: {row[2]}")
+    print_report(service, 'members')
+
+
+def print_loan_history(service, member_id):
+    """Function to display every loan a member has made.
+
+    Parameters
+    ----------
+    service: LibraryService
+        The library to look in.
+    member_id: int
+        The id of the member."""
+
+    from tabulate import tabulate
+
+    headings = ['ISBN', 'Title', 'Date Borrowed', 'Date Returned']
+    print(tabulate(service.loan_history(member_id), headers=headings))
+
+
+def print_member_holds(service, member_id):
+    """Function to display the books a member has on hold.
+
+    Parameters
+    ----------
+    service: LibraryService
+        The library to look in.
+    member_id: int
+        The id of the member."""
+
+    from tabulate import tabulate
+
+    headings = ['ISBN', 'Title', 'Place In Queue', 'Collect By']
+    print(tabulate(service.member_holds(member_id), headers=headings))
+
+
+def check_counters(service):
+    """Function to check the counts of copies on loan and on hold, holds
+    waiting and members' books on loan against the records and holds
+    tables, and correct any that are wrong.
+
+    Parameters
+    ----------
+    service: LibraryService
+        The library to check."""
+
+    from tabulate import tabulate
+
+    # Recounts the loans and holds and fixes any counts that do not match:
+    drift = service.check_counters()
+    if drift:
+        headings = ['Count', 'ISBN / Member', 'Recorded', 'Actual']
+        print(tabulate(drift, headers=headings))
+        print(f"{len(drift)} count(s) corrected.")
     else:
-        print("No books were found matching your search term.")
+        print("All loans and holds are counted correctly.")
 
 
-def print_book_record(ISBN):
-    """Function to display a book record.
+def print_query_stats(service):
+    """Function to display the time taken by each kind of SQL statement,
+    and how often books and members are found in the cache.
 
     Parameters
     ----------
-    ISBN: int
-        The ISBN to display records for."""
+    service: LibraryService
+        The library being timed."""
 
-    cursor.execute('''
-                SELECT bk.isbn, bk.title, bk.author, 
-                MAX(stock) - COUNT(rc.returned)
-                FROM books AS bk
-                LEFT JOIN (
-                    SELECT * FROM records 
-                    WHERE returned = 'FALSE') AS rc
-                ON bk.isbn = rc.isbn
-                WHERE bk.isbn = ?
-                GROUP BY bk.isbn''', (ISBN,))
-    record = cursor.fetchall()
-    headings = ['ISBN', 'Title', 'Author', 'Copies Available']
-    print(tabulate(record, headers=headings))
-
-
-def print_all_books():
-    """Function to display all books in library database."""
-    cursor.execute('''
-                SELECT bk.isbn, bk.title, bk.author, bk.stock,
-                MAX(stock) - COUNT(rc.returned)
-                FROM books AS bk
-                LEFT JOIN (
-                    SELECT * FROM records 
-                    WHERE returned = 'FALSE') AS rc
-                ON bk.isbn = rc.isbn
-                GROUP BY bk.isbn''')
-    table = cursor.fetchall()
-    headings = ['ISBN','Title','Author','Stock','On Shelf']
-    print(tabulate(table, headers=headings))
-
-
-def print_loaned_books():
-    """Function to display all books out on loan."""
-    cursor.execute('''
-                SELECT 
-                 rc.isbn, 
-                 bk.title, 
-                 bk.author, 
-                 rc.user_id,
-                 u.name,
-                 rc.date_checked_out
-                FROM records AS rc
-                INNER JOIN books AS bk
-                ON rc.isbn = bk.isbn
-                INNER JOIN users AS u
-                ON rc.user_id = u.id
-                WHERE rc.returned = 'FALSE'
-                ORDER BY rc.isbn
-                ''')
-    table = cursor.fetchall()
-    headings = ['ISBN','Title','Author','ID','Name', 'Date Borrowed']
-    print(tabulate(table, headers=headings))
-
-
-# ------------------------------------------------------------------------
-# ------------------------------------------------------------------------
-# Sets up database with 3 tables: books, users, records:
-try:
-    db = sqlite3.connect('library_db')
-    cursor = db.cursor()
-
-    # Check if books table exists, and create if not:
-    cursor.execute('''
-            CREATE TABLE IF NOT EXISTS books(
-            isbn INTEGER PRIMARY KEY,
-            title TEXT,
-            author TEXT,
-            stock INTEGER);
-    ''')
-    db.commit()
-
-    # Check if users table exists, and create if not:
-    cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users(
-            id INTEGER PRIMARY KEY,
-            name TEXT,
-            fines INTEGER,
-            rewards INTEGER,
-            borrow_limit INTEGER);
-    ''')
-    db.commit()
-
-    # Check if records table exists, and create if not:
-    cursor.execute('''
-            CREATE TABLE IF NOT EXISTS records(
-            isbn INTEGER,
-            user_id INTEGER,
-            date_checked_out,
-            date_checked_in,
-            returned);
-    ''')
-    db.commit()
-    # ---------------------------------------------------------------------
-    print("Welcome to the Library Management System")
-
-    # Provide the user with the list of options for the library system:
-    while True:
-        print("""
+    from tabulate import tabulate
+
+    if service.cache is not None:
+        headings = ['Cache', 'Hits', 'Misses', 'Hit Rate', 'Rows']
+        print(tabulate([(kind, row['hits'], row['misses'], row['hit_rate'],
+                         row['size'])
+                        for kind, row in service.cache.summary().items()],
+                       headers=headings, floatfmt='.1%'))
+        print()
+
+    if service.stats is None:
+        print("Query timing is off.")
+        return
+
+    headings = ['Operation', 'Count', 'Total ms', 'Mean ms', 'p50 ms',
+                'p95 ms', 'p99 ms', 'Max ms']
+    print(tabulate([(label, row['count'], row['total_ms'], row['mean_ms'],
+                     row['p50_ms'], row['p95_ms'], row['p99_ms'],
+                     row['max_ms'])
+                    for label, row in service.stats.summary().items()],
+                   headers=headings, floatfmt='.3f'))
+
+
+def print_slow_queries(service):
+    """Function to display recent slow SQL statements and their plans.
+
+    Parameters
+    ----------
+    service: LibraryService
+        The library being timed."""
+
+    if service.stats is None:
+        print("Query timing is off.")
+        return
+
+    slow = service.stats.slow_queries()
+    if not slow:
+        print(f"No statements have taken over {service.stats.slow_ms} ms.")
+    for entry in slow:
+        print(f"{entry['time']}  {entry['label']}  {entry['ms']:.1f} ms")
+        print(f"    {entry['sql']}")
+        for line in entry['plan']:
+            print(f"    plan: {line}")
+
+
+def main(path='library_db', branch=None, directory='.'):
+    """Function to run the Library Management System menu.
+
+    Parameters
+    ----------
+    path: str
+        The database file to use.
+    branch: str
+        The branch this desk is at, to use the branch's shard and the
+        shared member registry in directory instead of path (see
+        library_branches).
+    directory: str
+        The directory holding the branches' files."""
+
+    # Opens the database, creating or upgrading its tables if needed
+    # (see library_schema). WAL mode lets several desks run the menu on
+    # the same database, and reports use their own read-only connection
+    # (see library_pool). Books and members looked up are kept in a cache,
+    # which is emptied when another desk changes the database:
+    library = None
+    if branch is None:
+        db = configure(connect(path))
+        read_db = connect_readonly(path)
+        service = LibraryService(db, read_db,
+                                 cache=LibraryCache(other_writers=True))
+    else:
+        # Every branch is opened, to look for books out here at the others.
+        # data_version only notices changes to the branch's own shard, so
+        # members, kept in the registry, are not cached:
+        library = BranchLibrary(sorted(set(find_branches(directory))
+                                       | {branch}), directory)
+        db = connect_branch(library.shards[branch], library.registry)
+        read_db = connect_branch(library.shards[branch], library.registry,
+                                 readonly=True)
+        service = BranchService(db, read_db,
+                                cache=LibraryCache(members=0,
+                                                   other_writers=True))
+
+    try:
+        print("Welcome to the Library Management System")
+
+        # Provide the user with the list of options for the library system:
+        while True:
+            print("""
 Please select from the following options:
     1. Search for a book
     2. Borrow a book
@@ -707,162 +475,270 @@ Please select from the following options:
     4. Pay a fine
     5. Manage book stock
     6. Manage library members
-    7. Exit
+    7. Query statistics
+    8. Exit
     """)
-        user_choice = input("Please enter your choice (1-7): ")
-
-        # -----------------------------------------------------------
-        if user_choice == '7':
-            # Exit system
-            break
-        # -----------------------------------------------------------
-        elif user_choice == '1':
-            # Book search feature
-            while True:
-                print("""
+            user_choice = input("Please enter your choice (1-8): ")
+
+            # -----------------------------------------------------------
+            if user_choice == '8':
+                # Exit system
+                break
+            # -----------------------------------------------------------
+            elif user_choice == '1':
+                # Book search feature
+                while True:
+                    print("""
 Please select the type of search:
     1. Search for an author
     2. Search for a book title
-    3. Back
+    3. Search titles and authors
+    4. Back
                 """)
-                user_sub_choice = input("Please enter your choice (1-3): ")
-                if user_sub_choice == '3':
-                    # Returns to main menu
-                    break
-                elif user_sub_choice == '1':
-                    user_search_term = input("Please enter your search term: ")
-                    search_books('author', user_search_term)
+                    user_sub_choice = input("Please enter your choice (1-4): ")
+                    if user_sub_choice == '4':
+                        # Returns to main menu
+                        break
+                    elif user_sub_choice == '1':
+                        user_search_term = input("Please enter your search term: ")
+                        search_books(service, 'author', user_search_term)
+
+                    elif user_sub_choice == '2':
+                        user_search_term = input("Please enter your search term: ")
+                        search_books(service, 'title', user_search_term)
 
-                elif user_sub_choice == '2':
-                    user_search_term = input("Please enter your search term: ")
-                    search_books('title', user_search_term)
+                    elif user_sub_choice == '3':
+                        user_search_term = input("Please enter your search term: ")
+                        search_books(service, None, user_search_term)
 
+                    else:
+                        print("Error: Please enter a number between 1 and 4.")
+            # -----------------------------------------------------------
+            elif user_choice == '2':
+                # Borrow a book
+                chosen_book = get_book(service, service.scan_from_shelf)
+                # Check book is from the library:
+                if not chosen_book[1]:
+                    print("Error: This is not a book from the library.")
                 else:
-                    print("Error: Please enter a number between 1 and 3.")
-        # -----------------------------------------------------------
-        elif user_choice == '2':
-            # Borrow a book
-            chosen_book = get_book(scan_from_shelf)
-            # Check book is from the library:
-            if not chosen_book[1]:
-                print("Error: This is not a book from the library.")
-            else:
-                print_book_record(chosen_book[0])
-                borrow_book(chosen_book[0], get_member())
-        # -----------------------------------------------------------
-        elif user_choice == '3':
-            # Return a book
-            memberid = get_member()
-            # Check member has books on loan
-            cursor.execute('''SELECT * FROM records
-                            WHERE user_id = ?
-                            AND returned = 'FALSE';''', (memberid,))
-            check_loans = cursor.fetchone()
-            if not check_loans:
-                print(f"Error: Member {memberid} has no books on loan.")
-            else:
-                returned_book = get_book(scan_from_user, memberid)
-                if returned_book[1]:
-                    print_book_record(returned_book[0])
-                    return_book(returned_book[0], memberid)
-                    # Ask if the book was late, issue fine or reward:
-                    while True:
-                        on_time = input("Was the book returned on time? (Y/N)"
-                                        ).upper()
-                        if on_time == 'N':
-                            fine(memberid)
-                            break
-                        elif on_time == 'Y':
-                            reward(memberid)
-                            break
-                        else:
+                    print_book_record(service, chosen_book[0])
+                    memberid = get_member(service)
+                    outcome = service.borrow_book(chosen_book[0], memberid)
+                    print(outcome.message)
+                    if outcome.status == 'no_stock' and library is not None:
+                        for other, on_shelf in library.availability(
+                                chosen_book[0]):
+                            if other != branch and on_shelf:
+                                print(f"{other} has {on_shelf} on the shelf.")
+                    if outcome.status == 'no_stock':
+                        # Offer a place in the queue for the next copy
+                        # returned:
+                        while True:
+                            hold = input("Place a hold on this book? (Y/N)"
+                                         ).upper()
+                            if hold in ('Y', 'N'):
+                                break
                             print("Error: Invalid input. Please enter Y or N.")
+                        if hold == 'Y':
+                            print(service.place_hold(chosen_book[0],
+                                                     memberid).message)
+            # -----------------------------------------------------------
+            elif user_choice == '3':
+                # Return a book
+                memberid = get_member(service)
+                # Check member has books on loan
+                if not service.has_loans(memberid):
+                    print(f"Error: Member {memberid} has no books on loan.")
                 else:
-                    print("Error: This is not a book from the library.")
-        # -----------------------------------------------------------
-        elif user_choice == '4':
-            # Pay a fine
-            pay_fine(get_member())
-        # -----------------------------------------------------------
-        elif user_choice == '5':
-            # Manage Book stock
-            while True:
-                print("""
+                    returned_book = get_book(service, service.scan_from_user,
+                                             memberid)
+                    if returned_book[1]:
+                        print_book_record(service, returned_book[0])
+                        # The due date decides between a fine and a
+                        # reward:
+                        outcome = service.return_book(returned_book[0],
+                                                      memberid)
+                        print(outcome.message)
+                        if outcome.ok:
+                            after = outcome.data['after']
+                            if after is None:
+                                print("The book was overdue and has "
+                                      "already been fined for.")
+                            else:
+                                if outcome.data['late']:
+                                    print("The book was overdue.")
+                                if after.status == 'limit_raised':
+                                    print("Reward point earned!")
+                                print(after.message)
+                    else:
+                        print("Error: This is not a book from the library.")
+            # -----------------------------------------------------------
+            elif user_choice == '4':
+                # Pay a fine
+                outcome = service.pay_fine(get_member(service))
+                if outcome.ok:
+                    print(f"Please pay £{outcome.data['amount']:.2f}")
+                    print("*Beep!*")
+                print(outcome.message)
+            # -----------------------------------------------------------
+            elif user_choice == '5':
+                # Manage Book stock
+                while True:
+                    print("""
 Please select from the following options:
     1. View book stock
     2. Add book to stock
     3. Remove book
     4. View books on loan
-    5. Back
+    5. Check loan and hold counts
+    6. Back
                 """)
-                user_sub_choice = input("Please enter your choice (1-5): ")
-                if user_sub_choice == '5':
-                    # Returns to main menu
-                    break
+                    user_sub_choice = input("Please enter your choice (1-6): ")
+                    if user_sub_choice == '6':
+                        # Returns to main menu
+                        break
 
-                elif user_sub_choice == '1':
-                    # Display all book records
-                    print_all_books()
+                    elif user_sub_choice == '1':
+                        # Display all book records
+                        print_all_books(service)
+
+                    elif user_sub_choice == '2':
+                        # Add a book to the stock
+                        add_book(service)
+
+                    elif user_sub_choice == '3':
+                        # Remove books from stock
+                        book_to_remove = get_book(service,
+                                                  service.scan_all_books)
+                        if book_to_remove[1]:
+                            print_book_record(service, book_to_remove[0])
+                            remove_book(service, book_to_remove[0])
+                        else:
+                            print("Error: This is not a book from the library.")
 
-                elif user_sub_choice == '2':
-                    # Add a book to the stock
-                    add_book()
+                    elif user_sub_choice == '4':
+                        # View books currently on loan
+                        print_loaned_books(service)
 
-                elif user_sub_choice == '3':
-                    # Remove books from stock
-                    book_to_remove = get_book(scan_all_books)
-                    if book_to_remove[1]:
-                        print_book_record(book_to_remove[0])
-                        remove_book(book_to_remove[0])
+                    elif user_sub_choice == '5':
+                        # Recount loans and holds and correct any errors
+                        check_counters(service)
                     else:
-                        print("Error: This is not a book from the library.")
-
-                elif user_sub_choice == '4':
-                    # View books currently on loan
-                    print_loaned_books()
-                else:
-                    print("Error: Please enter a number between 1 and 5.")
+                        print("Error: Please enter a number between 1 and 6.")
 
-        # -----------------------------------------------------------
-        elif user_choice == '6':
-            # Manage Library Users
-            while True:
-                print("""
+            # -----------------------------------------------------------
+            elif user_choice == '6':
+                # Manage Library Users
+                while True:
+                    print("""
 Please select from the following options:
     1. View library members
     2. Add a new member
-    3. Back
+    3. View a member's loan history
+    4. View a member's holds
+    5. Cancel a hold
+    6. Back
                 """)
-                user_sub_choice = input("Please enter your choice (1-3): ")
-                if user_sub_choice == '3':
-                    # Returns to main menu
-                    break
+                    user_sub_choice = input("Please enter your choice (1-6): ")
+                    if user_sub_choice == '6':
+                        # Returns to main menu
+                        break
 
-                elif user_sub_choice == '1':
-                    # Display all member records
-                    cursor.execute('''SELECT * FROM users;''')
-                    member_table = cursor.fetchall()
-                    table_headers = ['ID', 'Name', 'Fines', 'Rewards', 'Borrow Limit']
-                    print(tabulate(member_table, headers=table_headers))
+                    elif user_sub_choice == '1':
+                        # Display all member records
+                        print_members(service)
+
+                    elif user_sub_choice == '2':
+                        # Add a member to the database
+                        user = input("Please enter the new member's name: "
+                                     ).capitalize()
+                        print(service.add_member(user).message)
+
+                    elif user_sub_choice == '3':
+                        # Display all loans made by a member
+                        print_loan_history(service, get_member(service))
+
+                    elif user_sub_choice == '4':
+                        # Display the books a member is waiting for
+                        print_member_holds(service, get_member(service))
+
+                    elif user_sub_choice == '5':
+                        # Take a member out of the queue for a book
+                        memberid = get_member(service)
+                        held_book = get_book(service, service.scan_all_books)
+                        if held_book[1]:
+                            print(service.cancel_hold(held_book[0],
+                                                      memberid).message)
+                        else:
+                            print("Error: This is not a book from the library.")
 
-                elif user_sub_choice == '2':
-                    # Add a member to the database
-                    user = input("Please enter the new member's name: "
-                                 ).capitalize()
-                    add_member(user)
+                    else:
+                        print("Error: Please enter a number between 1 and 6.")
 
-                else:
-                    print("Error: Please enter a number between 1 and 3.")
+            # -----------------------------------------------------------
+            elif user_choice == '7':
+                # Query statistics
+                while True:
+                    print("""
+Please select from the following options:
+    1. Show query statistics
+    2. Show slow queries
+    3. Turn query timing on / off
+    4. Back
+                """)
+                    user_sub_choice = input("Please enter your choice (1-4): ")
+                    if user_sub_choice == '4':
+                        # Returns to main menu
+                        break
 
-        # -----------------------------------------------------------
-        else:
-            print("Error: Please enter a number between 1 and 7.")
+                    elif user_sub_choice == '1':
+                        # Display timings for each operation
+                        print_query_stats(service)
+
+                    elif user_sub_choice == '2':
+                        # Display the slowest recent statements
+                        print_slow_queries(service)
+
+                    elif user_sub_choice == '3':
+                        # Timing is off by default, it costs a little on
+                        # every statement:
+                        if service.stats is None:
+                            service.stats = QueryStats(slow_log=SLOW_LOG)
+                            print("Query timing is on. Slow queries are "
+                                  f"logged to {SLOW_LOG}.")
+                        else:
+                            service.stats = None
+                            print("Query timing is off.")
 
-except Exception as e:
-    # Roll back any changes made before error
-    db.rollback()
-    raise e
+                    else:
+                        print("Error: Please enter a number between 1 and 4.")
 
-finally:
-    # Close the db connection
-    db.close()
+            # -----------------------------------------------------------
+            else:
+                print("Error: Please enter a number between 1 and 8.")
+
+    except Exception as e:
+        # Roll back any changes made before error
+        db.rollback()
+        raise e
+
+    finally:
+        # Close the db connections
+        read_db.close()
+        db.close()
+        if library is not None:
+            library.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Run the Library Management System menu.")
+    parser.add_argument('--db', default='library_db',
+                        help="The database file, for a single library")
+    parser.add_argument('--branch',
+                        help="The branch this desk is at, for a library "
+                             "with several branches (see library_branches)")
+    parser.add_argument('--dir', default='.',
+                        help="The directory holding the branches' files")
+    args = parser.parse_args()
+    main(args.db, args.branch, args.dir)
@@ -0,0 +1,71 @@
+"""
+Benchmarks for the Library Management System.
+
+Modules
+-------
+synthetic:
+    Generates deterministic synthetic libraries of any size.
+run:
+    Times the library's operations and writes the results as JSON.
+compare:
+    Compares two sets of results, e.g. from before and after a change.
+durability:
+    Compares throughput and latency under each durability profile.
+backup:
+    Measures online backups, restores and the desks' latency meanwhile.
+load:
+    Simulates desks in separate processes, closed or open loop.
+
+Run from the top of the repository, e.g.
+
+    python -m benchmarks.run --books 100000 --members 20000 --loans 1000000
+    python -m benchmarks.compare before.json after.json
+
+The latencies are summarised by library_stats.percentiles.
+
+Functions
+---------
+desk:
+    Borrows and returns books at random until stopped, timing each change.
+"""
+
+import random
+import time
+
+from benchmarks.synthetic import FIRST_ISBN, pick
+
+
+def desk(pools, books, member_ids, seed, stop, samples):
+    """Function to borrow and return books until stop is set, e.g. in one
+    of several desk threads.
+
+    Parameters
+    ----------
+    pools: LibraryPools
+        The pools the desk gets its services from.
+    books: int
+        The number of books in the synthetic library.
+    member_ids: list
+        The ids of its members.
+    seed: int
+        The random seed for choosing books and members.
+    stop: threading.Event
+        Set to stop the desk.
+    samples: list
+        An (end, seconds) tuple is added for each change: when it ended,
+        by time.perf_counter, and how long it took."""
+
+    rng = random.Random(seed)
+    while not stop.is_set():
+        isbn = FIRST_ISBN + pick(rng, books)
+        member_id = member_ids[pick(rng, len(member_ids))]
+        with pools.service() as library:
+            start = time.perf_counter()
+            outcome = library.borrow_book(isbn, member_id)
+            end = time.perf_counter()
+            samples.append((end, end - start))
+            if outcome.ok:
+                start = time.perf_counter()
+                library.return_book(isbn, member_id, True)
+                end = time.perf_counter()
+                samples.append((end, end - start))
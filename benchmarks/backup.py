@@ -0,0 +1,158 @@
+"""
+Measures online backups, and how much they slow the desks down.
+
+Desk threads borrow and return books on a copy of a synthetic library, first
+on their own and then while a backup of the library is made (see
+library_backup). The backup is then restored to a new file. Reported are the
+backup's throughput, the desks' latency before and during the backup, and
+the time taken to restore, e.g.
+
+    python -m benchmarks.backup --books 1000000 --members 200000 \\
+        --loans 25000000 --pause 0.005 0.02
+
+Functions
+---------
+run_backup:
+    Runs the desks through a backup and a restore and returns the results.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import desk
+from benchmarks.run import library_file
+from library_backup import BACKUP_PAGES, backup, restore
+from library_pool import LibraryPools
+from library_stats import percentiles
+
+
+def run_backup(path, work_dir, desks=4, seconds=5.0, pages=BACKUP_PAGES,
+               pause=0.005, seed=1):
+    """Function to back up a library while desks use it, then restore it.
+
+    Parameters
+    ----------
+    path: str
+        A synthetic library (see benchmarks.run.library_file). It is changed
+        by the run, so pass a copy.
+    work_dir: str
+        The directory for the backup and the restored library.
+    desks: int
+        The number of desk threads.
+    seconds: float
+        How long the desks run for on their own, before the backup.
+    pages: int
+        The pages copied in each step of the backup.
+    pause: float
+        The pause, in seconds, between the steps of the backup.
+    seed: int
+        The random seed for choosing books and members.
+
+    Returns
+    -------
+    dict
+        The size of the library, the backup's time and the throughput of
+        its copying (leaving out the check of the copy), the latency
+        summaries (see library_stats.percentiles) of the desks'
+        changes before and during the backup, and the restore's time and
+        throughput."""
+
+    pools = LibraryPools(path, writers=desks, readers=desks)
+    target = os.path.join(work_dir, 'library_backup')
+    try:
+        with pools.service() as library:
+            cursor = library.read_cursor
+            cursor.execute('''SELECT COUNT(*) FROM books;''')
+            books = cursor.fetchone()[0]
+            cursor.execute('''SELECT id FROM users ORDER BY id;''')
+            member_ids = [row[0] for row in cursor.fetchall()]
+
+        stop = threading.Event()
+        samples = [[] for _ in range(desks)]
+        threads = [threading.Thread(target=desk, args=(
+            pools, books, member_ids, seed + number, stop, samples[number]))
+            for number in range(desks)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        backup_start = time.perf_counter()
+        made = backup(path, target, pages, pause)
+        backup_end = time.perf_counter()
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        pools.close()
+
+    before = [latency for desk_samples in samples
+              for end, latency in desk_samples if end < backup_start]
+    during = [latency for desk_samples in samples
+              for end, latency in desk_samples
+              if backup_start <= end <= backup_end]
+    restored = restore(target, os.path.join(work_dir, 'library_restored'))
+    mebibytes = made['bytes'] / 2 ** 20
+    return {'pages': pages, 'pause': pause, 'desks': desks,
+            'size_mib': mebibytes,
+            'backup_seconds': made['seconds'],
+            'check_seconds': made['check_seconds'],
+            'copy_mib_per_sec': mebibytes / (made['seconds']
+                                             - made['check_seconds']),
+            'latency_before': percentiles(before),
+            'latency_during': percentiles(during),
+            'restore_seconds': restored['seconds'],
+            'restore_mib_per_sec': mebibytes / restored['seconds']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Measure online backups of a synthetic library.")
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--members', type=int, default=20000)
+    parser.add_argument('--loans', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--desks', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--pages', type=int, default=BACKUP_PAGES)
+    parser.add_argument('--pause', type=float, nargs='+', default=[0.005],
+                        help="Pauses between steps to compare, in seconds")
+    parser.add_argument('--cache-dir', default='bench_cache')
+    parser.add_argument('--output', '-o',
+                        help="File for the JSON results (default: print them)")
+    args = parser.parse_args()
+
+    source = library_file(args.cache_dir, args.books, args.members,
+                          args.loans, args.seed)
+    results = []
+    for pause in args.pause:
+        with tempfile.TemporaryDirectory(dir=args.cache_dir) as work_dir:
+            path = os.path.join(work_dir, 'library')
+            shutil.copyfile(source, path)
+            results.append(run_backup(path, work_dir, args.desks,
+                                      args.seconds, args.pages, pause,
+                                      args.seed))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': vars(args), 'results': results}, f, indent=2)
+        print("  Pause     MiB  Backup s  Check s  Copy MiB/s"
+              "  p50 before/during ms  p99 before/during ms  Restore s")
+        for result in results:
+            before = result['latency_before']
+            during = result['latency_during']
+            print(f"{result['pause']:7.3f} {result['size_mib']:7.0f} "
+                  f"{result['backup_seconds']:9.1f} "
+                  f"{result['check_seconds']:8.1f} "
+                  f"{result['copy_mib_per_sec']:11.0f} "
+                  f"{before['p50_ms']:9.3f} / {during['p50_ms']:7.3f} "
+                  f"{before['p99_ms']:11.3f} / {during['p99_ms']:7.3f} "
+                  f"{result['restore_seconds']:10.1f}")
+    else:
+        json.dump({'meta': vars(args), 'results': results}, sys.stdout,
+                  indent=2)
+        print()
@@ -0,0 +1,88 @@
+"""
+Compares two sets of benchmark results, e.g. from before and after a change.
+
+An operation has regressed when one of its percentiles is more than the
+threshold slower, and by more than a small absolute amount so that timer
+noise on sub-millisecond lookups is not reported. Exits with status 1 if any
+operation regressed, so it can be used in a script or CI job:
+
+    python -m benchmarks.compare before.json after.json --threshold 0.2
+
+Functions
+---------
+compare:
+    Returns the change in each percentile of each operation.
+"""
+
+import argparse
+import json
+import sys
+
+
+PERCENTILES = ('p50_ms', 'p95_ms', 'p99_ms')
+
+
+def compare(before, after, threshold=0.1, min_ms=0.05):
+    """Function to compare two sets of results from benchmarks.run.
+
+    Parameters
+    ----------
+    before: dict
+        The results to compare against.
+    after: dict
+        The new results.
+    threshold: float
+        The fraction slower a percentile must be to count as a regression,
+        e.g. 0.1 for 10%.
+    min_ms: float
+        The number of milliseconds slower it must also be.
+
+    Returns
+    -------
+    list
+        (operation, percentile, before ms, after ms, regressed) tuples for
+        each operation in both sets of results."""
+
+    if before['meta'].get('books') != after['meta'].get('books'):
+        print("Warning: the results are for libraries of different sizes.",
+              file=sys.stderr)
+
+    changes = []
+    for name, old in before['results'].items():
+        new = after['results'].get(name)
+        if new is None:
+            continue
+        for percentile in PERCENTILES:
+            regressed = (new[percentile] > old[percentile] * (1 + threshold)
+                         and new[percentile] - old[percentile] > min_ms)
+            changes.append((name, percentile, old[percentile],
+                            new[percentile], regressed))
+    return changes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compare two sets of benchmark results.")
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    parser.add_argument('--min-ms', type=float, default=0.05)
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    changes = compare(before, after, args.threshold, args.min_ms)
+    print("Operation         Pctl    Before ms    After ms   Change")
+    for name, percentile, old, new, regressed in changes:
+        change = (new - old) / old * 100 if old else 0.0
+        print(f"{name:17} {percentile[:3]:4} {old:11.3f} {new:11.3f} "
+              f"{change:+7.1f}%{'  REGRESSED' if regressed else ''}")
+
+    regressions = sum(change[4] for change in changes)
+    if regressions:
+        print(f"{regressions} regressions above {args.threshold:.0%}")
+        sys.exit(1)
+    print("No regressions.")
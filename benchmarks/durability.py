@@ -0,0 +1,139 @@
+"""
+Measures the trade-off between durability, latency and throughput.
+
+Several desk threads borrow and return books as fast as they can for a few
+seconds under each durability profile (see library_transactions), each on a
+fresh copy of the same synthetic library. For each profile the changes per
+second, the latency of each change and the number of changes sharing each
+commit are reported, e.g.
+
+    python -m benchmarks.durability --desks 1 8 32
+
+Functions
+---------
+run_profile:
+    Runs the desks under one profile and returns the results.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import desk
+from benchmarks.run import library_file
+from library_pool import LibraryPools
+from library_stats import percentiles
+from library_transactions import PROFILES
+
+
+def run_profile(path, profile, desks, seconds=5.0, seed=1):
+    """Function to run desks against a library under a durability profile.
+
+    Parameters
+    ----------
+    path: str
+        A synthetic library (see benchmarks.run.library_file). It is changed
+        by the run, so pass a copy.
+    profile: str
+        The durability profile, e.g. 'strict' or 'group'.
+    desks: int
+        The number of desk threads.
+    seconds: float
+        How long the desks run for.
+    seed: int
+        The random seed for choosing books and members.
+
+    Returns
+    -------
+    dict
+        The changes per second, the latency summary of the changes (see
+        library_stats.percentiles) and, for grouped profiles, the changes
+        per commit."""
+
+    pools = LibraryPools(path, writers=desks, readers=desks,
+                         durability=profile)
+    try:
+        with pools.service() as library:
+            cursor = library.read_cursor
+            cursor.execute('''SELECT COUNT(*) FROM books;''')
+            books = cursor.fetchone()[0]
+            cursor.execute('''SELECT id FROM users ORDER BY id;''')
+            member_ids = [row[0] for row in cursor.fetchall()]
+
+        stop = threading.Event()
+        samples = [[] for _ in range(desks)]
+        threads = [threading.Thread(target=desk, args=(
+            pools, books, member_ids, seed + number, stop, samples[number]))
+            for number in range(desks)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        # Changes still waiting for a commit are only done once committed:
+        if pools.transactions is not None:
+            pools.transactions.flush()
+        elapsed = time.perf_counter() - start
+    finally:
+        pools.close()
+
+    times = [latency for desk_samples in samples
+             for end, latency in desk_samples]
+    result = {'profile': profile, 'desks': desks,
+              'changes_per_sec': len(times) / elapsed,
+              'latency': percentiles(times)}
+    if pools.transactions is not None:
+        result['changes_per_commit'] = (
+            pools.transactions.summary()['changes_per_commit'])
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compare the durability profiles on a synthetic library.")
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--members', type=int, default=2000)
+    parser.add_argument('--loans', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES),
+                        default=['strict', 'normal', 'group', 'bulk'])
+    parser.add_argument('--desks', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--cache-dir', default='bench_cache')
+    parser.add_argument('--output', '-o',
+                        help="File for the JSON results (default: print them)")
+    args = parser.parse_args()
+
+    source = library_file(args.cache_dir, args.books, args.members,
+                          args.loans, args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for profile in args.profiles:
+            for desks in args.desks:
+                path = os.path.join(work_dir, f'library_{profile}_{desks}')
+                shutil.copyfile(source, path)
+                results.append(run_profile(path, profile, desks, args.seconds,
+                                           args.seed))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': vars(args), 'results': results}, f, indent=2)
+        print("Profile  Desks  Changes/s   p50 ms   p99 ms  Per commit")
+        for result in results:
+            latency = result['latency']
+            per_commit = result.get('changes_per_commit', 1.0)
+            print(f"{result['profile']:8} {result['desks']:5} "
+                  f"{result['changes_per_sec']:10.0f} "
+                  f"{latency['p50_ms']:8.3f} {latency['p99_ms']:8.3f} "
+                  f"{per_commit:11.1f}")
+    else:
+        json.dump({'meta': vars(args), 'results': results}, sys.stdout,
+                  indent=2)
+        print()
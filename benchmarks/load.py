@@ -0,0 +1,368 @@
+"""
+Simulates busy desks, each in its own process, to size hardware and to find
+where the library stops scaling.
+
+Each worker process is one circulation desk, with its own connections to a
+shared copy of a synthetic library, as a desk PC would have. It scans the
+way the desk does (see LibraryService.user_id, scan_from_shelf and
+scan_from_user): a member's card, then a book from the shelf to borrow, one
+of the member's loans to return, a search of the catalogue or a payment of
+their fines. A member who is refused a book for fines pays them and tries
+again.
+
+Two ways of setting the pace are offered:
+
+    closed: each desk starts its next operation once the last has ended,
+        at most at the target rate. Throughput is what the library manages
+        and latency only counts the operation itself.
+    open: operations arrive at random at the target rate, whether or not
+        the desks keep up, like members queueing at the desk. Latency counts
+        from when an operation arrived, so it grows with the queue once the
+        library cannot keep up.
+
+Reported for each interval of the run are the operations per second, their
+latency, and how often a change waited for another desk's write lock
+(longer than LOCK_WAIT_MS to start) or gave up waiting ("database is
+locked"). Runs with more and more desks show where the library stops
+scaling, e.g.
+
+    python -m benchmarks.load --desks 1 2 4 8 16 --seconds 20
+    python -m benchmarks.load --desks 8 --mode open --rate 2000
+
+Functions
+---------
+run_load:
+    Runs the desk processes against a library and returns the results.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from benchmarks.run import library_file
+from benchmarks.synthetic import MEMBER_ID_WIDTH, vocabulary
+from library_ids import IdAllocator
+from library_pool import (SYNCHRONOUS, SYNCHRONOUS_LEVELS, configure,
+                          connect_readonly)
+from library_schema import connect
+from library_service import LibraryService
+from library_stats import percentiles
+
+
+# The share of each operation at the desks, in percent:
+MIX = {'search': 40, 'borrow': 25, 'return': 25, 'pay_fine': 10}
+
+# A change that takes longer than this (in ms) to get the write lock is
+# counted as having waited for another desk. Taking a free lock takes a few
+# microseconds.
+LOCK_WAIT_MS = 1.0
+
+# How many members' cards a desk scans to find one with a book to return.
+RETURN_SCANS = 5
+
+
+class _Desk(LibraryService):
+    """A LibraryService that counts the changes that waited for the write
+    lock."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock_waits = 0
+        self.lock_wait_seconds = 0.0
+
+    def _begin(self):
+        start = time.perf_counter()
+        super()._begin()
+        waited = time.perf_counter() - start
+        if waited > LOCK_WAIT_MS / 1000:
+            self.lock_waits += 1
+            self.lock_wait_seconds += waited
+
+
+def _operate(library, op, words, rng):
+    """Function to carry out one desk operation, returning its status."""
+
+    member_id = library.user_id(True)
+    if op == 'search':
+        found = library.search_books('title', rng.choice(words))
+        return 'found' if found else 'not_found'
+    elif op == 'borrow':
+        isbn = library.scan_from_shelf()
+        if isbn is None:
+            return 'no_stock'
+        outcome = library.borrow_book(isbn, member_id)
+        if outcome.status == 'has_fines':
+            library.pay_fine(member_id)
+            outcome = library.borrow_book(isbn, member_id)
+        return outcome.status
+    elif op == 'return':
+        for _ in range(RETURN_SCANS):
+            isbn = library.scan_from_user(member_id)
+            if isbn is not None:
+                return library.return_book(isbn, member_id,
+                                           rng.random() < 0.9).status
+            member_id = library.user_id(True)
+        return 'nothing_on_loan'
+    return library.pay_fine(member_id).status
+
+
+def _new_interval():
+    return {'latency': [], 'statuses': {}, 'lock_waits': 0,
+            'lock_wait_seconds': 0.0, 'busy': 0, 'errors': 0}
+
+
+def _add(total, counts):
+    """Function to add one interval's counts to another's."""
+
+    total['latency'].extend(counts['latency'])
+    for key, count in counts['statuses'].items():
+        total['statuses'][key] = total['statuses'].get(key, 0) + count
+    for key in ('lock_waits', 'lock_wait_seconds', 'busy', 'errors'):
+        total[key] += counts[key]
+
+
+def _desk(path, desk, mode, rate, seconds, interval, mix, synchronous, seed,
+          go, results):
+    """Function run by each desk process: operations until the run ends,
+    putting (desk, intervals, operations not started) on results."""
+
+    # Each process has its own copy of the random module, seeded the same
+    # when forked:
+    random.seed(seed + desk)
+    rng = random.Random(seed + desk)
+    words = vocabulary(seed)
+    ops, weights = zip(*mix.items())
+
+    db = configure(sqlite3.connect(path), synchronous=synchronous)
+    read_db = connect_readonly(path)
+    library = _Desk(db, read_db, ids=IdAllocator(db, MEMBER_ID_WIDTH))
+    intervals = {}
+    unstarted = 0
+    try:
+        go.wait()
+        begin = time.perf_counter()
+        end = begin + seconds
+        arrival = begin
+        while True:
+            if rate:
+                arrival += rng.expovariate(rate)
+            now = time.perf_counter()
+            if mode == 'closed':
+                # A desk cannot catch up on time it spent waiting:
+                arrival = max(arrival, now)
+            if arrival >= end:
+                break
+            if now >= end:
+                # Members still queueing when the run ends:
+                unstarted += 1
+                continue
+            if arrival > now:
+                time.sleep(arrival - now)
+            start = time.perf_counter()
+
+            op = rng.choices(ops, weights)[0]
+            waits = library.lock_waits, library.lock_wait_seconds
+            try:
+                status = _operate(library, op, words, rng)
+            except sqlite3.OperationalError as e:
+                status = 'busy' if 'locked' in str(e) else 'error'
+            finished = time.perf_counter()
+
+            # Open loop counts the time queueing too:
+            latency = finished - (arrival if mode == 'open' else start)
+            index = int((finished - begin) / interval)
+            counts = intervals.setdefault(index, _new_interval())
+            counts['latency'].append((op, latency))
+            key = f'{op}.{status}'
+            counts['statuses'][key] = counts['statuses'].get(key, 0) + 1
+            counts['lock_waits'] += library.lock_waits - waits[0]
+            counts['lock_wait_seconds'] += (library.lock_wait_seconds
+                                            - waits[1])
+            if status in ('busy', 'error'):
+                counts[{'busy': 'busy', 'error': 'errors'}[status]] += 1
+    finally:
+        read_db.close()
+        db.close()
+        results.put((desk, intervals, unstarted))
+
+
+def run_load(path, desks=4, mode='closed', rate=None, seconds=10.0,
+             interval=1.0, mix=None, synchronous=SYNCHRONOUS, seed=1):
+    """Function to run desk processes against a library.
+
+    Parameters
+    ----------
+    path: str
+        A synthetic library (see benchmarks.run.library_file). It is changed
+        by the run, so pass a copy.
+    desks: int
+        The number of desk processes.
+    mode: str
+        'closed' or 'open' (see the module docstring).
+    rate: float
+        The target operations per second across all the desks. Needed for
+        the open mode, None for the closed mode to go as fast as it can.
+    seconds: float
+        How long the desks run for.
+    interval: float
+        The length, in seconds, of each interval reported.
+    mix: dict
+        The share of each operation, e.g. MIX, which is the default.
+    synchronous: str
+        The synchronous level of the desks' write connections.
+    seed: int
+        The random seed for choosing operations, members and books.
+
+    Returns
+    -------
+    dict
+        The operations per second, the latency summary (see
+        library_stats.percentiles) of all and of each operation, the counts
+        of lock waits and of 'database is locked' errors, each operation's
+        status counts, the operations not started by the end (open mode),
+        and the same (but for the statuses) for each interval."""
+
+    if mode not in ('closed', 'open'):
+        raise ValueError(f"Unknown mode {mode}")
+    if mode == 'open' and not rate:
+        raise ValueError("The open mode needs a target rate")
+    mix = mix or MIX
+
+    # Migrate and switch to WAL before the desks open it:
+    configure(connect(path), synchronous=synchronous).close()
+
+    context = multiprocessing.get_context()
+    go = context.Event()
+    results = context.Queue()
+    workers = [context.Process(target=_desk, args=(
+        path, desk, mode, rate / desks if rate else None, seconds, interval,
+        mix, synchronous, seed, go, results)) for desk in range(desks)]
+    for worker in workers:
+        worker.start()
+    go.set()
+    # Taken off the queue before joining, or a worker could not exit:
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    merged = {}
+    for _, intervals, _ in outcomes:
+        for index, counts in intervals.items():
+            _add(merged.setdefault(index, _new_interval()), counts)
+
+    def summary(counts, length):
+        latency = counts['latency']
+        return {'operations': len(latency),
+                'ops_per_sec': len(latency) / length,
+                'latency': percentiles([sample for _, sample in latency]),
+                'lock_waits': counts['lock_waits'],
+                'lock_wait_ms': counts['lock_wait_seconds'] * 1000,
+                'busy': counts['busy'], 'errors': counts['errors']}
+
+    # The last interval holds operations that ended after the run:
+    last = int(seconds / interval)
+    overall = _new_interval()
+    series = []
+    for index in range(last + 1):
+        counts = merged.get(index, _new_interval())
+        if index < last:
+            series.append(dict(summary(counts, interval),
+                               start=index * interval))
+        _add(overall, counts)
+
+    result = dict(summary(overall, seconds), desks=desks, mode=mode,
+                  rate=rate, intervals=series,
+                  unstarted=sum(unstarted for *_, unstarted in outcomes),
+                  statuses=dict(sorted(overall['statuses'].items())))
+    result['by_operation'] = {
+        op: percentiles([sample for name, sample in overall['latency']
+                         if name == op])
+        for op in sorted(mix)}
+    return result
+
+
+def _mix(text):
+    """Function to read an operation's share, e.g. borrow=30, for argparse.
+    """
+
+    op, _, share = text.partition('=')
+    if op not in MIX:
+        raise argparse.ArgumentTypeError(f"Unknown operation {op}")
+    return op, float(share)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Simulate busy desks, each in its own process, on a "
+                    "synthetic library.")
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--members', type=int, default=2000)
+    parser.add_argument('--loans', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--desks', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help="Numbers of desks to try, each as a separate run")
+    parser.add_argument('--mode', choices=['closed', 'open'],
+                        default='closed')
+    parser.add_argument('--rate', type=float,
+                        help="Target operations per second across the desks "
+                             "(needed for --mode open)")
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help="Seconds in each interval reported")
+    parser.add_argument('--mix', type=_mix, nargs='+',
+                        help="Shares of the operations, e.g. borrow=30 "
+                             "search=50 (default: "
+                             + ' '.join(f'{op}={share}'
+                                        for op, share in MIX.items()) + ')')
+    parser.add_argument('--synchronous', choices=SYNCHRONOUS_LEVELS,
+                        default=SYNCHRONOUS)
+    parser.add_argument('--cache-dir', default='bench_cache')
+    parser.add_argument('--output', '-o',
+                        help="File for the JSON results (default: print them)")
+    args = parser.parse_args()
+    if args.mode == 'open' and not args.rate:
+        parser.error("--mode open needs --rate")
+
+    source = library_file(args.cache_dir, args.books, args.members,
+                          args.loans, args.seed)
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.cache_dir) as work_dir:
+        for desks in args.desks:
+            path = os.path.join(work_dir, f'library_{desks}')
+            shutil.copyfile(source, path)
+            results.append(run_load(path, desks, args.mode, args.rate,
+                                    args.seconds, args.interval,
+                                    dict(args.mix) if args.mix else None,
+                                    args.synchronous, args.seed))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': vars(args), 'results': results}, f, indent=2)
+        for result in results:
+            print(f"{result['desks']} desks, {result['mode']} loop")
+            print("     At s    Ops/s   p50 ms   p99 ms  Lock waits  Busy")
+            for row in result['intervals']:
+                latency = row['latency']
+                print(f"{row['start']:9.1f} {row['ops_per_sec']:8.0f} "
+                      f"{latency['p50_ms']:8.3f} {latency['p99_ms']:8.3f} "
+                      f"{row['lock_waits']:11} {row['busy']:5}")
+            print()
+        print("Desks    Ops/s   p50 ms   p95 ms   p99 ms  Lock waits  Busy"
+              "  Unstarted")
+        for result in results:
+            latency = result['latency']
+            print(f"{result['desks']:5} {result['ops_per_sec']:8.0f} "
+                  f"{latency['p50_ms']:8.3f} {latency['p95_ms']:8.3f} "
+                  f"{latency['p99_ms']:8.3f} {result['lock_waits']:11} "
+                  f"{result['busy']:5} {result['unstarted']:10}")
+    else:
+        json.dump({'meta': vars(args), 'results': results}, sys.stdout,
+                  indent=2)
+        print()
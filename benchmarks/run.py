@@ -0,0 +1,231 @@
+"""
+Times the library's operations on a synthetic library.
+
+A library of the requested size is generated once and kept in a cache
+directory. Each run works on a fresh copy of it, so runs on different commits
+start from exactly the same data. Every operation is timed through
+LibraryService, the same code the menu, the kiosk server and the desks use,
+and the results are written as JSON for benchmarks.compare.
+
+Functions
+---------
+library_file:
+    Returns the cached synthetic library for a scale and seed, generating it
+    if needed.
+run:
+    Times each operation and returns the results.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import (FIRST_ISBN, MEMBER_ID_WIDTH, generate,
+                                  pick, vocabulary)
+from library_ids import IdAllocator
+from library_reports import PAGE_SIZE
+from library_schema import connect
+from library_service import LibraryService
+from library_stats import QueryStats, percentiles
+
+
+# The operations timed, in the order they are reported.
+OPERATIONS = ['borrow_book', 'return_book', 'search_books', 'book_record',
+              'all_books', 'all_books.page', 'loaned_books',
+              'loaned_books.page', 'scan_all_books', 'scan_from_shelf',
+              'scan_from_user', 'user_id.existing', 'user_id.new']
+
+
+def library_file(cache_dir, books, members, loans, seed, archived=True):
+    """Function to get the synthetic library for a scale and seed.
+
+    Returns
+    -------
+    str
+        The path of the library in cache_dir. It is generated the first
+        time it is needed, which can take a while for large libraries."""
+
+    os.makedirs(cache_dir, exist_ok=True)
+    name = f"library_{books}_{members}_{loans}_{seed}"
+    if not archived:
+        name += '_unarchived'
+    path = os.path.join(cache_dir, name + '.db')
+    if not os.path.exists(path):
+        # Generate under a temporary name, so an interrupted run does not
+        # leave a half built library to be used next time:
+        partial = path + '.partial'
+        if os.path.exists(partial):
+            os.remove(partial)
+        generate(partial, books, members, loans, seed=seed, progress=True,
+                 archived=archived)
+        os.replace(partial, path)
+    return path
+
+
+def _timed(samples, name, function, *args):
+    """Function to call function(*args), adding its time to samples[name]."""
+
+    start = time.perf_counter()
+    result = function(*args)
+    samples[name].append(time.perf_counter() - start)
+    return result
+
+
+def run(path, iterations=1000, report_iterations=5, seed=1, stats=None):
+    """Function to time the library's operations.
+
+    Parameters
+    ----------
+    path: str
+        A synthetic library (see library_file). It is changed by the run, so
+        pass a copy.
+    iterations: int
+        How many times to time each operation.
+    report_iterations: int
+        How many times to time the full reports that read every book or
+        every loan (all_books and loaned_books), which are far slower.
+        Single pages of them are timed every iteration.
+    seed: int
+        The random seed for choosing books, members and search terms.
+    stats: QueryStats
+        To also time each SQL statement (see library_stats), or None.
+
+    Returns
+    -------
+    dict
+        The latency summary (see library_stats.percentiles) for each
+        operation, plus the status counts for borrow_book."""
+
+    rng = random.Random(seed)
+    # The scan helpers use the random module directly:
+    random.seed(seed)
+    words = vocabulary(seed)
+
+    db = connect(path)
+    library = LibraryService(db, ids=IdAllocator(db, MEMBER_ID_WIDTH),
+                             stats=stats)
+    cursor = db.cursor()
+    cursor.execute('''SELECT COUNT(*) FROM books;''')
+    books = cursor.fetchone()[0]
+    cursor.execute('''SELECT id FROM users ORDER BY id;''')
+    member_ids = [row[0] for row in cursor.fetchall()]
+
+    samples = {name: [] for name in OPERATIONS}
+    statuses = {}
+    try:
+        for _ in range(iterations):
+            isbn = FIRST_ISBN + pick(rng, books)
+            member_id = member_ids[pick(rng, len(member_ids))]
+
+            # Popular books and heavy borrowers are picked most, so some
+            # borrows are refused, as they would be at a real desk:
+            outcome = _timed(samples, 'borrow_book', library.borrow_book,
+                             isbn, member_id)
+            statuses[outcome.status] = statuses.get(outcome.status, 0) + 1
+            if outcome.ok:
+                _timed(samples, 'return_book', library.return_book,
+                       isbn, member_id, True)
+
+            term = ' '.join(rng.choice(words)[:rng.randint(3, 6)]
+                            for _ in range(rng.randint(1, 2)))
+            _timed(samples, 'search_books', library.search_books,
+                   rng.choice(['title', 'author', None]), term)
+            _timed(samples, 'book_record', library.book_record, isbn)
+            # One page of each report, starting part way through:
+            _timed(samples, 'all_books.page', library.all_books, isbn,
+                   PAGE_SIZE)
+            _timed(samples, 'loaned_books.page', library.loaned_books,
+                   (isbn, 0), PAGE_SIZE)
+            _timed(samples, 'scan_all_books', library.scan_all_books)
+            _timed(samples, 'scan_from_shelf', library.scan_from_shelf)
+            _timed(samples, 'scan_from_user', library.scan_from_user,
+                   member_id)
+            _timed(samples, 'user_id.existing', library.user_id, True)
+            _timed(samples, 'user_id.new', library.user_id, False)
+
+        for _ in range(report_iterations):
+            _timed(samples, 'all_books', library.all_books)
+            _timed(samples, 'loaned_books', library.loaned_books)
+    finally:
+        db.close()
+
+    results = {name: percentiles(times) for name, times in samples.items()
+               if times}
+    results['borrow_book']['statuses'] = statuses
+    return results
+
+
+def _git_commit():
+    """Function to get the current commit, or None outside a git checkout."""
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Time the library's operations on a synthetic library.")
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--members', type=int, default=2000)
+    parser.add_argument('--loans', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--report-iterations', type=int, default=5)
+    parser.add_argument('--unarchived', action='store_true',
+                        help="keep returned loans in the records table")
+    parser.add_argument('--query-stats', action='store_true',
+                        help="also time each SQL statement")
+    parser.add_argument('--cache-dir', default='bench_cache')
+    parser.add_argument('--output', '-o',
+                        help="File for the JSON results (default: print them)")
+    args = parser.parse_args()
+
+    source = library_file(args.cache_dir, args.books, args.members,
+                          args.loans, args.seed, not args.unarchived)
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'library_db')
+        shutil.copyfile(source, path)
+        stats = QueryStats(slow_ms=float('inf')) if args.query_stats else None
+        results = run(path, args.iterations, args.report_iterations,
+                      args.seed, stats)
+
+    report = {
+        'meta': {'books': args.books, 'members': args.members,
+                 'loans': args.loans, 'seed': args.seed,
+                 'archived': not args.unarchived,
+                 'file_bytes': os.path.getsize(source),
+                 'iterations': args.iterations,
+                 'report_iterations': args.report_iterations,
+                 'query_stats': args.query_stats,
+                 'commit': _git_commit(),
+                 'python': platform.python_version(),
+                 'sqlite': sqlite3.sqlite_version,
+                 'platform': platform.platform(),
+                 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'results': results}
+    if stats is not None:
+        report['queries'] = stats.summary()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Operation          Count   p50 ms   p95 ms   p99 ms")
+        for name, result in results.items():
+            print(f"{name:17} {result['count']:6} {result['p50_ms']:8.3f} "
+                  f"{result['p95_ms']:8.3f} {result['p99_ms']:8.3f}")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,285 @@
+"""
+Deterministic synthetic libraries for benchmarking.
+
+The same seed and sizes always give the same library. Borrowing is skewed
+the way it is in a real library: a small share of popular titles and heavy
+borrowers account for most of the loans.
+
+Functions
+---------
+pick:
+    Picks a random position, favouring popular ones.
+generate:
+    Creates a library database with the given numbers of books, members and
+    loans.
+
+Run as a script to create a library file, e.g.
+
+    python -m benchmarks.synthetic bench_db --books 1000000 --loans 10000000
+"""
+
+import argparse
+import datetime
+import itertools
+import os
+import random
+import time
+
+from library_ids import IdAllocator
+from library_schema import connect
+from library_service import LOAN_DAYS
+
+
+# The first ISBN and the width of the membership numbers used.
+FIRST_ISBN = 9780000000000
+MEMBER_ID_WIDTH = 8
+
+# How strongly loans favour popular books and heavy borrowers: the share of
+# picks landing in the first fraction f of books is f ** (1 / SKEW), e.g.
+# with 3 the top 10% of books get 46% of loans.
+SKEW = 3
+
+# Loan history runs from this date for HISTORY_DAYS days. Loans store days
+# as day numbers, counting from EPOCH (see library_schema).
+FIRST_DAY = datetime.date(2015, 1, 1)
+HISTORY_DAYS = 10 * 365
+EPOCH = datetime.date(1970, 1, 1)
+
+SYLLABLES = ['an', 'bel', 'cor', 'dra', 'el', 'fen', 'gar', 'hol', 'is',
+             'jun', 'kel', 'lor', 'mar', 'nor', 'os', 'pel', 'quin', 'ros',
+             'sar', 'tor', 'ul', 'ven', 'wil', 'yar', 'zen']
+
+
+def pick(rng, count):
+    """Function to pick a random position from 0 to count - 1, favouring
+    popular ones (see SKEW). The popular positions are spread across the
+    whole range, so e.g. the popular books are not simply the lowest ISBNs.
+
+    Parameters
+    ----------
+    rng: random.Random
+        The random number generator to use.
+    count: int
+        The number of positions.
+
+    Returns
+    -------
+    int
+        The position picked."""
+
+    rank = min(int(count * rng.random() ** SKEW), count - 1)
+    # 2654435761 is prime, so this gives each rank its own position (unless
+    # count is a multiple of it):
+    return rank * 2654435761 % count
+
+
+def vocabulary(seed, size=5000):
+    """Function to make the made-up words used for titles and names.
+
+    Returns
+    -------
+    list
+        size distinct words, the same for the same seed."""
+
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES)
+                          for _ in range(rng.randint(2, 3))))
+    return sorted(words)
+
+
+def _book_rows(rng, books, words):
+    """Function to make the rows for the books table."""
+
+    authors = [f"{rng.choice(words).capitalize()} "
+               f"{rng.choice(words).capitalize()}"
+               for _ in range(max(1, books // 20))]
+    for i in range(books):
+        title = ' '.join(rng.choice(words)
+                         for _ in range(rng.randint(1, 5))).capitalize()
+        yield FIRST_ISBN + i, title, rng.choice(authors), rng.randint(1, 5)
+
+
+def _history_rows(rng, books, member_ids, count):
+    """Function to make the rows for returned loans, spread over the
+    history."""
+
+    first_day = (FIRST_DAY - EPOCH).days
+    for _ in range(count):
+        out = first_day + rng.randrange(HISTORY_DAYS)
+        back = out + rng.randint(1, 42)
+        yield (FIRST_ISBN + pick(rng, books),
+               member_ids[pick(rng, len(member_ids))], out, back,
+               out + LOAN_DAYS)
+
+
+def _open_rows(rng, books, member_ids, stock, open_loans):
+    """Function to make the rows for loans still out, at the end of the
+    history."""
+
+    # Open loans keep to the rules: one copy of a book per member, no more
+    # than 3 books per member, and no more copies out than are owned:
+    per_member = {}
+    per_book = {}
+    taken = set()
+    last_day = (FIRST_DAY - EPOCH).days + HISTORY_DAYS
+    made = 0
+    attempts = 0
+    while made < open_loans and attempts < open_loans * 20:
+        attempts += 1
+        book = pick(rng, books)
+        member_id = member_ids[pick(rng, len(member_ids))]
+        if ((book, member_id) in taken or per_member.get(member_id, 0) >= 3
+                or per_book.get(book, 0) >= stock[book]):
+            continue
+        taken.add((book, member_id))
+        per_member[member_id] = per_member.get(member_id, 0) + 1
+        per_book[book] = per_book.get(book, 0) + 1
+        made += 1
+        out = last_day - rng.randint(0, 28)
+        yield FIRST_ISBN + book, member_id, out, out + LOAN_DAYS
+
+
+def _write(db, statement, rows, chunk_size, label, progress):
+    """Function to insert rows in chunked transactions."""
+
+    cursor = db.cursor()
+    start = time.perf_counter()
+    written = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        cursor.execute('''BEGIN;''')
+        cursor.executemany(statement, chunk)
+        db.commit()
+        written += len(chunk)
+        if progress:
+            rate = written / (time.perf_counter() - start)
+            print(f"{label}: {written} rows ({rate:.0f} rows/sec)")
+    return written
+
+
+def generate(path, books=10000, members=2000, loans=50000, open_share=0.02,
+             seed=1, chunk_size=50000, progress=False, archived=True):
+    """Function to create a synthetic library database.
+
+    Parameters
+    ----------
+    path: str
+        The database file to create. It must not already exist.
+    books: int
+        The number of titles.
+    members: int
+        The number of members.
+    loans: int
+        The number of loan records, returned and open.
+    open_share: float
+        The share of loan records still out on loan (fewer are made if the
+        borrowing rules do not allow that many).
+    seed: int
+        The random seed. The same seed and sizes give the same library.
+    chunk_size: int
+        The number of rows written in each transaction.
+    progress: bool
+        True to print progress while writing.
+    archived: bool
+        True to write the returned loans to loan_history, as if
+        library_archive had been run, or False to leave them in records.
+
+    Returns
+    -------
+    dict
+        The numbers of books, members, loans and open loans written."""
+
+    if os.path.exists(path):
+        raise FileExistsError(f"{path} already exists")
+
+    rng = random.Random(seed)
+    words = vocabulary(seed)
+    db = connect(path)
+    cursor = db.cursor()
+    try:
+        # The search index is built once at the end rather than book by
+        # book, so its insert trigger is set aside while loading. The file
+        # is new, so nothing else can be using it:
+        cursor.execute('''SELECT sql FROM sqlite_master
+                        WHERE name = 'books_fts_insert';''')
+        fts_trigger = cursor.fetchone()[0]
+        cursor.execute('''DROP TRIGGER books_fts_insert;''')
+
+        # Stock is kept to check the open loans against:
+        stock = []
+        book_rows = (row for row in _book_rows(rng, books, words)
+                     if not stock.append(row[3]))
+        _write(db, '''INSERT INTO books(isbn, title, author, stock)
+                    VALUES(?,?,?,?);''', book_rows, chunk_size, 'books',
+               progress)
+        cursor.execute('''INSERT INTO books_fts(books_fts) VALUES('rebuild');''')
+        cursor.execute(fts_trigger)
+        db.commit()
+
+        # Membership numbers come from the normal allocator, so new members
+        # added during a benchmark carry on from the last one:
+        member_ids = IdAllocator(db, MEMBER_ID_WIDTH).allocate_block(members)
+        member_rows = ((member_id, f"{rng.choice(words).capitalize()}", 0, 0, 3)
+                       for member_id in member_ids)
+        _write(db, '''INSERT INTO users(id, name, fines, rewards, borrow_limit)
+                    VALUES(?,?,?,?,?);''', member_rows, chunk_size, 'members',
+               progress)
+
+        open_loans = int(loans * open_share)
+        history_rows = _history_rows(rng, books, member_ids,
+                                     loans - open_loans)
+        # Loan ids are numbered on from the history to the open loans, as
+        # if every loan had been made through the desks:
+        loan_ids = itertools.count(1)
+        history_rows = ((next(loan_ids),) + row for row in history_rows)
+        if archived:
+            statement = '''
+                INSERT INTO loan_history(
+                loan_id, isbn, user_id, day_out, day_in, day_due)
+                VALUES(?,?,?,?,?,?);'''
+        else:
+            statement = '''
+                INSERT INTO records(
+                loan_id, isbn, user_id, day_out, day_in, day_due)
+                VALUES(?,?,?,?,?,?);'''
+        written = _write(db, statement, history_rows, chunk_size, 'history',
+                         progress)
+        open_rows = ((next(loan_ids),) + row for row in _open_rows(
+            rng, books, member_ids, stock, open_loans))
+        written += _write(db, '''
+            INSERT INTO records(loan_id, isbn, user_id, day_out, day_due)
+            VALUES(?,?,?,?,?);''', open_rows, chunk_size, 'open loans',
+            progress)
+
+        cursor.execute('''SELECT COUNT(*) FROM records
+                        WHERE day_in IS NULL;''')
+        made_open = cursor.fetchone()[0]
+        cursor.execute('''ANALYZE;''')
+        db.commit()
+    finally:
+        db.close()
+
+    return {'books': books, 'members': members, 'loans': written,
+            'open_loans': made_open}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Create a synthetic library database.")
+    parser.add_argument('path')
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--members', type=int, default=2000)
+    parser.add_argument('--loans', type=int, default=50000)
+    parser.add_argument('--open-share', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--unarchived', action='store_true',
+                        help="leave returned loans in the records table")
+    args = parser.parse_args()
+
+    print(generate(args.path, args.books, args.members, args.loans,
+                   args.open_share, args.seed, progress=True,
+                   archived=not args.unarchived))
@@ -0,0 +1,111 @@
+"""
+Archiving of returned loans.
+
+Open loans are what the desks work with, but returned loans pile up in the
+records table forever. archive_returned moves them to the append-only
+loan_history table (see library_schema), keeping records small. It runs
+online: each batch is a short write transaction followed by a pause, so
+desks borrowing and returning in the meantime only ever wait for one batch.
+
+The full loan history, open and returned, can still be read from the
+all_loans view.
+
+Functions
+---------
+archive_returned:
+    Moves returned loans from records to loan_history in batches.
+"""
+
+import argparse
+import time
+
+from library_pool import configure
+from library_schema import connect
+
+
+def archive_returned(db, batch_size=5000, pause=0.05, progress=False):
+    """Function to move returned loans from records to loan_history.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to a migrated library database.
+    batch_size: int
+        The most loans moved in each transaction. Smaller batches hold the
+        write lock for less time.
+    pause: float
+        Seconds to wait between batches, leaving the desks a chance to
+        write.
+    progress: bool
+        True to print progress after each batch.
+
+    Returns
+    -------
+    dict
+        The number of loans moved ('moved'), the number of batches and the
+        time taken in seconds."""
+
+    cursor = db.cursor()
+    start = time.perf_counter()
+    moved = 0
+    batches = 0
+    # Batches work through records in loan id order, so each one starts
+    # where the last stopped rather than re-reading the open loans it
+    # skipped:
+    last = 0
+
+    while True:
+        try:
+            cursor.execute('''BEGIN IMMEDIATE;''')
+            cursor.execute('''
+                SELECT MAX(loan_id) FROM (
+                    SELECT loan_id FROM records
+                    WHERE loan_id > ? AND day_in IS NOT NULL
+                    ORDER BY loan_id LIMIT ?);''', (last, batch_size))
+            upto = cursor.fetchone()[0]
+            if upto is None:
+                db.rollback()
+                break
+
+            cursor.execute('''
+                INSERT INTO loan_history(
+                loan_id, isbn, user_id, day_out, day_in, day_due)
+                SELECT loan_id, isbn, user_id, day_out, day_in, day_due
+                FROM records
+                WHERE loan_id > ? AND loan_id <= ? AND day_in IS NOT NULL
+                ORDER BY loan_id;''', (last, upto))
+            cursor.execute('''
+                DELETE FROM records
+                WHERE loan_id > ? AND loan_id <= ? AND day_in IS NOT NULL;''',
+                           (last, upto))
+            moved += cursor.rowcount
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        batches += 1
+        last = upto
+        if progress:
+            print(f"{moved} loans archived")
+        time.sleep(pause)
+
+    return {'moved': moved, 'batches': batches,
+            'seconds': time.perf_counter() - start}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Move returned loans to the loan history.")
+    parser.add_argument('--db', default='library_db')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--pause', type=float, default=0.05)
+    args = parser.parse_args()
+
+    db = configure(connect(args.db))
+    try:
+        result = archive_returned(db, args.batch_size, args.pause, True)
+        print(f"{result['moved']} loans archived in {result['batches']} "
+              f"batches, {result['seconds']:.1f}s")
+    finally:
+        db.close()
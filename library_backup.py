@@ -0,0 +1,285 @@
+"""
+Backing up a library database while the desks are open, and restoring it.
+
+backup copies a library database with SQLite's backup API while desks carry
+on borrowing and returning. Copying the file itself could give a torn copy,
+half from before a change and half from after. The backup API copies a few
+pages at a time, pausing between steps so the desks' own reads and writes
+are not crowded out.
+
+The copy is of one moment: it is made inside a read transaction on the
+library, which in WAL mode the desks' changes do not wait for. Left to
+itself, the backup API would start again from the first page whenever a
+desk changed the library, so on a busy library it might never finish.
+While a backup runs, checkpoints cannot go past that moment, so the WAL
+file grows with the changes made meanwhile, until the next checkpoint after
+the backup.
+
+A backup is written under a temporary name, checked with PRAGMA quick_check
+and only then given its name, so a file with a backup's name is complete. It
+is a single file in rollback journal mode, so it can be copied or archived
+on its own.
+
+Functions
+---------
+backup:
+    Copies a library database to a backup file, while it is in use.
+verify:
+    Checks a backup (or any library database) is whole.
+restore:
+    Checks a backup and puts it in place of a library database.
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+
+from library_pool import BUSY_TIMEOUT, configure, connect_readonly
+from library_schema import SCHEMA_VERSION, connect
+
+
+# Pages copied in each step of a backup. With 4 KiB pages, a step copies
+# 4 MiB, which takes a few milliseconds.
+BACKUP_PAGES = 1024
+
+# Seconds to pause between the steps of a backup, to leave the disk to the
+# desks.
+BACKUP_PAUSE = 0.005
+
+
+def backup(path, target, pages=BACKUP_PAGES, pause=BACKUP_PAUSE, check=True,
+           progress=None):
+    """Function to copy a library database to a backup file.
+
+    Parameters
+    ----------
+    path: str
+        The library database, which can be in use by any number of desks.
+    target: str
+        The backup file to write. An existing file is replaced once the
+        new backup is complete.
+    pages: int
+        The number of pages to copy in each step.
+    pause: float
+        How long, in seconds, to pause between steps.
+    check: bool
+        True to check the copy with PRAGMA quick_check before giving it
+        its name.
+    progress: callable
+        Called after each step with the number of pages copied so far and
+        the total, e.g. to show a progress bar. None for no progress.
+
+    Returns
+    -------
+    dict
+        The number of pages and bytes copied, the number of steps, and the
+        time taken in seconds in all and by the check.
+
+    Raises
+    ------
+    ValueError
+        If the copy fails its check. The copy is deleted."""
+
+    partial = target + '.partial'
+    for stale in (partial, partial + '-journal'):
+        if os.path.exists(stale):
+            os.remove(stale)
+
+    start = time.perf_counter()
+    steps = 0
+
+    def step(status, remaining, total):
+        nonlocal steps
+        steps += 1
+        if progress is not None:
+            progress(total - remaining, total)
+        time.sleep(pause)
+
+    source = connect_readonly(path)
+    try:
+        # Holding a read transaction keeps the moment being copied fixed
+        # (see the module docstring):
+        source.execute('''BEGIN;''')
+        source.execute('''SELECT COUNT(*) FROM sqlite_master;''').fetchone()
+        copy = sqlite3.connect(partial)
+        try:
+            # The copy is synced once, when complete (see below):
+            copy.execute('''PRAGMA synchronous = OFF;''')
+            source.backup(copy, pages=pages, progress=step)
+            # A copy of a WAL database is in WAL mode too. A single file is
+            # easier to keep:
+            copy.execute('''PRAGMA journal_mode = DELETE;''')
+            page_count = copy.execute('''PRAGMA page_count;''').fetchone()[0]
+            page_size = copy.execute('''PRAGMA page_size;''').fetchone()[0]
+        finally:
+            copy.close()
+    finally:
+        source.close()
+
+    check_seconds = 0.0
+    if check:
+        check_start = time.perf_counter()
+        problems = verify(partial)
+        check_seconds = time.perf_counter() - check_start
+        if problems:
+            os.remove(partial)
+            raise ValueError(f"The backup of {path} failed its check: "
+                             f"{problems[0]}")
+
+    # Make sure the copy is on disk before it replaces an older backup:
+    with open(partial, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(partial, target)
+
+    return {'pages': page_count, 'bytes': page_count * page_size,
+            'steps': steps, 'seconds': time.perf_counter() - start,
+            'check_seconds': check_seconds}
+
+
+def verify(path, full=False):
+    """Function to check a backup, or any library database, is whole.
+
+    Parameters
+    ----------
+    path: str
+        The database file.
+    full: bool
+        True for PRAGMA integrity_check, which also checks that every index
+        matches its table. The default, PRAGMA quick_check, checks the
+        file's structure and takes a fraction of the time.
+
+    Returns
+    -------
+    list
+        A message for each problem found. The list is empty when the file
+        is a whole library database this program can open."""
+
+    try:
+        db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    except sqlite3.OperationalError as e:
+        # e.g. "unable to open database file", for a missing file:
+        return [f"Cannot open {path}: {e}"]
+    try:
+        # Both checks report 'ok', or a line for each problem:
+        check = 'integrity_check' if full else 'quick_check'
+        problems = [row[0] for row in db.execute('''PRAGMA %s;''' % check)
+                    if row[0] != 'ok']
+
+        version = db.execute('''PRAGMA user_version;''').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            problems.append(f"Schema version {version} is newer than this "
+                            f"program's, {SCHEMA_VERSION}")
+        books = db.execute('''SELECT 1 FROM sqlite_master
+                           WHERE type = 'table' AND name = 'books';''')
+        if books.fetchone() is None:
+            problems.append("It is not a library database")
+    except sqlite3.DatabaseError as e:
+        # e.g. "file is not a database"
+        problems = [str(e)]
+    finally:
+        db.close()
+    return problems
+
+
+def restore(source, path, busy_timeout=BUSY_TIMEOUT):
+    """Function to put a backup in place of a library database.
+
+    Parameters
+    ----------
+    source: str
+        The backup file. It is checked with verify first, and not used if
+        any problem is found.
+    path: str
+        The library database to replace, created if it does not exist.
+    busy_timeout: int
+        How long, in milliseconds, to wait for the desks' transactions to
+        finish.
+
+    Returns
+    -------
+    dict
+        The number of pages restored and the time taken in seconds.
+
+    Raises
+    ------
+    ValueError
+        If the backup fails its check.
+
+    Notes
+    -----
+        The backup is copied in one step, under one write lock, so desks
+        still connected see either the library as it was or the backup,
+        never a mix. Their caches are only emptied if they check for other
+        connections' changes (LibraryCache(other_writers=True), see
+        library_cache); restart the desks otherwise. A backup from before
+        the latest schema is upgraded afterwards."""
+
+    problems = verify(source)
+    if problems:
+        raise ValueError(f"{source} cannot be restored: {problems[0]}")
+
+    start = time.perf_counter()
+    try:
+        backup_db = sqlite3.connect(f'file:{source}?mode=ro', uri=True)
+    except sqlite3.OperationalError as e:
+        # e.g. the file was removed since it was checked:
+        raise ValueError(f"{source} cannot be restored: Cannot open "
+                         f"{source}: {e}") from e
+    try:
+        db = configure(sqlite3.connect(path), busy_timeout)
+        try:
+            backup_db.backup(db)
+            page_count = db.execute('''PRAGMA page_count;''').fetchone()[0]
+            # Move the restored pages from the WAL into the database file:
+            db.execute('''PRAGMA wal_checkpoint(TRUNCATE);''')
+        finally:
+            db.close()
+    finally:
+        backup_db.close()
+
+    connect(path).close()
+    return {'pages': page_count, 'seconds': time.perf_counter() - start}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Back up, check and restore a library database.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    make = commands.add_parser(
+        'backup', help="Copy the library, while it is in use")
+    make.add_argument('target', help="The backup file to write")
+    make.add_argument('--db', default='library_db')
+    make.add_argument('--pages', type=int, default=BACKUP_PAGES,
+                      help="Pages to copy at each step")
+    make.add_argument('--pause', type=float, default=BACKUP_PAUSE,
+                      help="Seconds to pause between steps")
+    check = commands.add_parser('verify', help="Check a backup is whole")
+    check.add_argument('source', help="The backup file")
+    check.add_argument('--full', action='store_true',
+                       help="Also check every index against its table")
+    put_back = commands.add_parser(
+        'restore', help="Replace the library with a backup")
+    put_back.add_argument('source', help="The backup file")
+    put_back.add_argument('--db', default='library_db')
+    args = parser.parse_args()
+
+    if args.command == 'backup':
+        result = backup(args.db, args.target, args.pages, args.pause)
+        print(f"{result['bytes'] / 2 ** 20:.1f} MiB backed up to "
+              f"{args.target} in {result['seconds']:.1f}s")
+    elif args.command == 'verify':
+        problems = verify(args.source, args.full)
+        for problem in problems:
+            print(f"Error: {problem}")
+        if problems:
+            raise SystemExit(1)
+        print(f"{args.source} is whole.")
+    else:
+        try:
+            result = restore(args.source, args.db)
+        except ValueError as e:
+            print(f"Error: {e}")
+            raise SystemExit(1)
+        print(f"{args.db} restored from {args.source} in "
+              f"{result['seconds']:.1f}s")
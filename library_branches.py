@@ -0,0 +1,591 @@
+"""
+Several library branches, each with its own database file.
+
+Each branch keeps its books, loans and holds in a database file of its own,
+its shard (e.g. library_central_db), and every branch shares one member
+registry (library_members_db). A branch's connections open its shard and
+ATTACH the registry as 'members'. A shard has no users table of its own, so
+the library's SQL finds the registry's, and LibraryService works on a branch
+unchanged.
+
+Locking
+-------
+A branch's changes take the write lock on its own shard, so desks at one
+branch never wait for another branch's reports or holds. The registry is
+locked as well only while member rows change: briefly on a borrow or return
+(for the member's count of loans, and the reward or fine), and for paying
+fines, fining, rewards and adding members. Borrowing limits count a member's
+loans at every branch, kept in the registry's users.open_loans by TEMP
+triggers on each branch connection, so borrows and returns at different
+branches take turns for the registry. In WAL mode a commit that changes both
+files is atomic for each file, but not across them: a crash at that moment
+could keep a return and lose its reward.
+
+Across branches, availability and search_books ask every shard at once,
+each on its own read-only connection, and merge the results.
+
+Classes
+-------
+BranchService:
+    A LibraryService for one branch.
+BranchLibrary:
+    The branches of one library, with cross-branch availability and search.
+
+Functions
+---------
+shard_path:
+    Returns the database file for a branch.
+registry_path:
+    Returns the database file for the member registry.
+find_branches:
+    Lists the branches with a shard in a directory.
+connect_branch:
+    Opens a branch's shard with the member registry attached.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import glob
+import os
+import re
+import sqlite3
+
+from library_holds import expire_holds
+from library_overdue import fine_overdue
+from library_pool import (BUSY_TIMEOUT, SYNCHRONOUS, SYNCHRONOUS_LEVELS,
+                          ConnectionPool, configure, connect_readonly)
+from library_schema import (COUNTERS, OPEN_LOANS_TRIGGERS, connect, migrate,
+                            rebuild_counters)
+from library_service import LibraryService
+
+
+# The schema version from which the registry counts members' loans (see
+# library_schema).
+OPEN_LOANS_VERSION = 12
+
+# The tables kept only in the member registry. A shard's own copies would
+# hide the registry's, so they are dropped from shards.
+MEMBER_TABLES = ('users', 'id_sequences')
+
+
+def shard_path(branch, directory='.'):
+    """Function to name the database file for a branch.
+
+    Parameters
+    ----------
+    branch: str
+        The branch name, e.g. 'central'.
+    directory: str
+        The directory holding the library's files.
+
+    Returns
+    -------
+    str
+        The path of the branch's shard."""
+
+    if not re.fullmatch(r'\w+', branch) or branch == 'members':
+        raise ValueError(f"Invalid branch name {branch}")
+    return os.path.join(directory, f'library_{branch}_db')
+
+
+def registry_path(directory='.'):
+    """Function to name the database file for the member registry.
+
+    Parameters
+    ----------
+    directory: str
+        The directory holding the library's files.
+
+    Returns
+    -------
+    str
+        The path of the registry."""
+
+    return os.path.join(directory, 'library_members_db')
+
+
+def find_branches(directory='.'):
+    """Function to list the branches with a shard in a directory.
+
+    Parameters
+    ----------
+    directory: str
+        The directory holding the library's files.
+
+    Returns
+    -------
+    list
+        The branch names, in alphabetical order."""
+
+    branches = (
+        re.fullmatch(r'library_(\w+)_db', os.path.basename(path)).group(1)
+        for path in glob.glob(os.path.join(directory, 'library_*_db')))
+    return sorted(branch for branch in branches if branch != 'members')
+
+
+def connect_branch(shard, registry, readonly=False, busy_timeout=BUSY_TIMEOUT,
+                   synchronous=SYNCHRONOUS):
+    """Function to open a branch's shard with the member registry attached.
+
+    Parameters
+    ----------
+    shard: str
+        The branch's database file, created or upgraded if need be.
+    registry: str
+        The member registry, which must already exist (see BranchLibrary).
+    readonly: bool
+        True for a read-only connection, e.g. for reports.
+    busy_timeout: int
+        How long, in milliseconds, to wait for a lock.
+    synchronous: str
+        The synchronous level for both files.
+
+    Returns
+    -------
+    sqlite3.Connection
+        A connection for a BranchService. Its changes to loans are counted
+        in the registry's users.open_loans.
+
+    Raises
+    ------
+    ValueError
+        If the shard is the registry, or has members of its own."""
+
+    if os.path.exists(shard) and os.path.exists(registry) and (
+            os.path.samefile(shard, registry)):
+        raise ValueError(f"{shard} is the member registry, not a branch")
+
+    if readonly:
+        db = connect_readonly(shard, busy_timeout)
+        db.execute('''ATTACH DATABASE ? AS members;''',
+                   (f'file:{registry}?mode=ro',))
+        return db
+
+    db = connect(shard)
+    try:
+        for table in MEMBER_TABLES:
+            if db.execute('''SELECT 1 FROM sqlite_master
+                          WHERE type = 'table' AND name = ?;''',
+                          (table,)).fetchone() is None:
+                continue
+            # Never drop members, only the empty tables of a new shard:
+            if table == 'users' and db.execute(
+                    '''SELECT 1 FROM users LIMIT 1;''').fetchone():
+                raise ValueError(f"{shard} has members of its own, add "
+                                 "them to the registry first")
+            # The name comes from MEMBER_TABLES, not from the caller:
+            db.execute('''DROP TABLE main.%s;''' % table)
+        # The shard's own loan counting triggers would update its users
+        # table, which has gone:
+        for trigger in OPEN_LOANS_TRIGGERS:
+            db.execute('''DROP TRIGGER IF EXISTS main.%s;''' % trigger)
+        db.commit()
+
+        configure(db, busy_timeout, synchronous)
+        db.execute('''ATTACH DATABASE ? AS members;''', (registry,))
+        # PRAGMA does not accept parameters, configure checked the level:
+        db.execute('''PRAGMA members.synchronous = %s;'''
+                   % synchronous.upper())
+        # TEMP triggers can change the registry's users table, which the
+        # shard's own triggers cannot:
+        for trigger in OPEN_LOANS_TRIGGERS.values():
+            db.execute(trigger.replace('CREATE TRIGGER',
+                                       'CREATE TEMP TRIGGER', 1))
+    except Exception:
+        db.close()
+        raise
+    return db
+
+
+class BranchService(LibraryService):
+    """A LibraryService for one branch, on a connection from
+    connect_branch.
+
+    Changes lock the branch's shard when they start, and the member
+    registry only when they first change a member, so they do not hold up
+    other branches (see the module docstring). Paying fines, fining and
+    adding members read member rows before changing them, so they lock both
+    from the start: a transaction that has read the registry cannot wait
+    for its write lock, and would fail at once with "database is locked"
+    if another branch had it. Rewards lock both from the start too, as
+    they only change the member.
+
+    A return changes the loan first and only then the member, writing to
+    the registry before reading it, so it does not need to."""
+
+    _lock_registry = False
+
+    def _begin(self):
+        """Method to start the write transaction for _transaction."""
+
+        if self._lock_registry:
+            # IMMEDIATE locks every attached file, the registry included:
+            self._execute('begin', '''BEGIN IMMEDIATE;''')
+            return
+
+        self._execute('begin', '''BEGIN;''')
+        # A write to the shard takes its write lock now, and no other. The
+        # registry's is taken by the first change to a member. (records, as
+        # a no-op write to books fails at once when another desk has the
+        # lock, rather than waiting for it. fined, as no trigger changing a
+        # member follows it, and the trigger would lock the registry too.)
+        try:
+            self._execute('begin.shard', '''
+                          UPDATE main.records SET fined = fined WHERE 0;''')
+        except BaseException:
+            self.db.rollback()
+            raise
+
+    @contextlib.contextmanager
+    def _registry_locked(self):
+        """Method to lock the registry from the start of changes made in
+        the with block."""
+
+        self._lock_registry = True
+        try:
+            yield
+        finally:
+            self._lock_registry = False
+
+    def pay_fine(self, member_id):
+        """Method to record that a member's fines have been paid (see
+        LibraryService.pay_fine)."""
+
+        with self._registry_locked():
+            return super().pay_fine(member_id)
+
+    def fine(self, member_id, fine_qty=1):
+        """Method to fine a member (see LibraryService.fine)."""
+
+        with self._registry_locked():
+            return super().fine(member_id, fine_qty)
+
+    def reward(self, member_id):
+        """Method to give a member a reward point (see
+        LibraryService.reward)."""
+
+        with self._registry_locked():
+            return super().reward(member_id)
+
+    def add_member(self, user_name):
+        """Method to add a new member to the registry (see
+        LibraryService.add_member)."""
+
+        with self._registry_locked():
+            return super().add_member(user_name)
+
+    def check_counters(self):
+        """Method to recount the branch's books' counters (see
+        LibraryService.check_counters). A member's open_loans counts their
+        loans at every branch, so it is recounted by
+        BranchLibrary.check_counters instead."""
+
+        drift = rebuild_counters(self.db, [counter for counter in COUNTERS
+                                           if counter[0] == 'books'])
+        if drift and self.cache is not None:
+            self.cache.clear()
+        return drift
+
+
+class BranchLibrary:
+    """The branches of one library, sharing a member registry.
+
+    Parameters
+    ----------
+    branches: list
+        The branch names. Shards for new branches are created.
+    directory: str
+        The directory holding the shards and the registry.
+    busy_timeout: int
+        How long, in milliseconds, each connection waits for a lock.
+    synchronous: str
+        The synchronous level for write connections.
+    readers: int
+        The most read-only connections to each shard, for availability
+        and search_books."""
+
+    def __init__(self, branches, directory='.', busy_timeout=BUSY_TIMEOUT,
+                 synchronous=SYNCHRONOUS, readers=2):
+        if synchronous.upper() not in SYNCHRONOUS_LEVELS:
+            raise ValueError(f"Unknown synchronous level {synchronous}")
+        self.directory = directory
+        self.registry = registry_path(directory)
+        self.shards = {branch: shard_path(branch, directory)
+                       for branch in branches}
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+
+        # Create or upgrade every file, and turn on WAL, before any
+        # pooled connection opens:
+        db = sqlite3.connect(self.registry)
+        try:
+            version = db.execute('''PRAGMA user_version;''').fetchone()[0]
+            migrate(db)
+            configure(db, busy_timeout, synchronous)
+        finally:
+            db.close()
+        for shard in self.shards.values():
+            connect_branch(shard, self.registry, False, busy_timeout,
+                           synchronous).close()
+        # The registry's new loan counts only know its own loans (none):
+        if 0 < version < OPEN_LOANS_VERSION:
+            self._recount_open_loans()
+
+        self.read_pools = {branch: ConnectionPool(shard, readers, True,
+                                                  busy_timeout)
+                           for branch, shard in self.shards.items()}
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            len(self.shards) * readers, thread_name_prefix='library-branch')
+
+    def _recount_open_loans(self):
+        """Method to recount each member's loans at every branch into the
+        registry's users.open_loans.
+
+        Returns
+        -------
+        list
+            A ('users.open_loans', member id, stored count, actual count)
+            tuple for each member whose count was wrong and has been
+            corrected."""
+
+        shards = {shard_path(branch, self.directory)
+                  for branch in find_branches(self.directory)}
+        registry = configure(sqlite3.connect(self.registry),
+                             self.busy_timeout, self.synchronous)
+        try:
+            # Every change to a loan also changes its member's count in the
+            # registry, so while its write lock is held the loans committed
+            # at each branch are the ones the counts should match:
+            registry.execute('''BEGIN IMMEDIATE;''')
+            counted = collections.Counter()
+            for shard in sorted(shards | set(self.shards.values())):
+                db = connect_readonly(shard, self.busy_timeout)
+                try:
+                    counted.update(dict(db.execute('''
+                        SELECT user_id, COUNT(*) FROM records
+                        WHERE day_in IS NULL
+                        GROUP BY user_id;''')))
+                finally:
+                    db.close()
+
+            drift = [('users.open_loans', member_id, stored,
+                      counted[member_id])
+                     for member_id, stored in registry.execute(
+                         '''SELECT id, open_loans FROM users;''')
+                     if stored != counted[member_id]]
+            registry.executemany('''UPDATE users SET open_loans = ?
+                                 WHERE id = ?;''',
+                                 [(actual, member_id)
+                                  for _, member_id, _, actual in drift])
+            registry.commit()
+        except Exception:
+            registry.rollback()
+            raise
+        finally:
+            registry.close()
+        return drift
+
+    def check_counters(self):
+        """Method to recount the counters kept by triggers at every branch
+        (see LibraryService.check_counters): each branch's books' counters
+        from its own loans and holds, then each member's open_loans from
+        their loans at every branch.
+
+        Returns
+        -------
+        dict
+            The (counter, key, stored count, actual count) tuples corrected,
+            by branch name, and for the registry's members under None."""
+
+        drift = {}
+        for branch in self.shards:
+            with self.service(branch) as library:
+                drift[branch] = library.check_counters()
+        drift[None] = self._recount_open_loans()
+        return drift
+
+    @classmethod
+    def discover(cls, directory='.', **kwargs):
+        """Method to open every branch with a shard in a directory.
+
+        Returns
+        -------
+        BranchLibrary
+            The branches found, by their shard file names."""
+
+        return cls(find_branches(directory), directory, **kwargs)
+
+    @contextlib.contextmanager
+    def service(self, branch, **kwargs):
+        """Method to get a BranchService for a branch's desk.
+
+        Parameters
+        ----------
+        branch: str
+            The branch name.
+        kwargs
+            Passed on to the BranchService, e.g. stats or cache.
+
+        Yields
+        ------
+        BranchService
+            A service on its own write and read-only connections, which
+            are closed when the with block ends."""
+
+        shard = self.shards[branch]
+        db = connect_branch(shard, self.registry, False, self.busy_timeout,
+                            self.synchronous)
+        try:
+            read_db = connect_branch(shard, self.registry, True,
+                                     self.busy_timeout)
+            try:
+                yield BranchService(db, read_db, **kwargs)
+            finally:
+                read_db.close()
+        finally:
+            db.close()
+
+    def _fan_out(self, method, *args):
+        """Method to call a LibraryService method on every branch at once.
+
+        Returns
+        -------
+        dict
+            The result from each branch, by branch name."""
+
+        def call(branch):
+            with self.read_pools[branch].connection() as read_db:
+                return getattr(LibraryService(read_db, read_db),
+                               method)(*args)
+
+        futures = {branch: self._executor.submit(call, branch)
+                   for branch in self.shards}
+        return {branch: future.result() for branch, future in futures.items()}
+
+    def availability(self, ISBN):
+        """Method to find which branches have a book.
+
+        Parameters
+        ----------
+        ISBN: int
+            The ISBN of the book.
+
+        Returns
+        -------
+        list
+            (branch, copies on the shelf) tuples for each branch that
+            stocks the book, most copies first."""
+
+        records = self._fan_out('book_record', ISBN)
+        return sorted(((branch, record[3])
+                       for branch, record in records.items() if record),
+                      key=lambda found: (-found[1], found[0]))
+
+    def search_books(self, column_name, search_for, limit=50):
+        """Method to search for books across every branch.
+
+        Parameters
+        ----------
+        column_name: str
+            As for LibraryService.search_books.
+        search_for: str
+            The string the user wishes to look for.
+        limit: int
+            The maximum number of books to return.
+
+        Returns
+        -------
+        list
+            (isbn, title, author, branches) tuples, best matches first.
+            branches lists the branches where the book was one of the best
+            limit matches.
+
+        Notes
+        -----
+            Each branch ranks its own matches. A book's place in the merged
+            list is its best place at any branch."""
+
+        found = {}
+        for branch, books in self._fan_out('search_books', column_name,
+                                           search_for, limit).items():
+            for place, (isbn, title, author) in enumerate(books):
+                best, _, _, _, branches = found.setdefault(
+                    isbn, [place, isbn, title, author, []])
+                found[isbn][0] = min(best, place)
+                branches.append(branch)
+
+        merged = sorted(found.values(), key=lambda book: (book[0], book[1]))
+        return [(isbn, title, author, sorted(branches))
+                for _, isbn, title, author, branches in merged[:limit]]
+
+    def sweep(self):
+        """Method to run the nightly overdue and pickup sweeps (see
+        library_overdue and library_holds) on every branch, one branch at
+        a time.
+
+        Returns
+        -------
+        dict
+            The results of both sweeps, by branch name."""
+
+        results = {}
+        for branch, shard in self.shards.items():
+            db = connect_branch(shard, self.registry, False,
+                                self.busy_timeout, self.synchronous)
+            try:
+                results[branch] = {'overdue': fine_overdue(db),
+                                   'holds': expire_holds(db)}
+            finally:
+                db.close()
+        return results
+
+    def close(self):
+        """Method to close the read-only connections."""
+
+        self._executor.shutdown()
+        for pool in self.read_pools.values():
+            pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Search and look after the branches of a library.")
+    parser.add_argument('--dir', default='.',
+                        help="The directory holding the branches' files")
+    parser.add_argument('--branch', action='append', dest='branches',
+                        help="A branch name, repeated for each branch "
+                             "(default: every shard found)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    search = commands.add_parser('search', help="Search every branch")
+    search.add_argument('search_for')
+    search.add_argument('--column', choices=['title', 'author'])
+    search.add_argument('--limit', type=int, default=50)
+    available = commands.add_parser(
+        'availability', help="Show the copies of a book at each branch")
+    available.add_argument('isbn', type=int)
+    commands.add_parser(
+        'sweep', help="Run the nightly overdue and pickup sweeps")
+    args = parser.parse_args()
+
+    if args.branches:
+        library = BranchLibrary(args.branches, args.dir)
+    else:
+        library = BranchLibrary.discover(args.dir)
+    try:
+        if args.command == 'search':
+            for isbn, title, author, branches in library.search_books(
+                    args.column, args.search_for, args.limit):
+                print(f"ISBN: {isbn}\tTitle: {title}\tAuthor: {author}"
+                      f"\tBranches: {', '.join(branches)}")
+        elif args.command == 'availability':
+            for branch, on_shelf in library.availability(args.isbn):
+                print(f"{branch}: {on_shelf} on the shelf")
+        else:
+            for branch, result in library.sweep().items():
+                print(f"{branch}: {result['overdue']['loans']} overdue "
+                      f"loans fined, {result['holds']['expired']} holds "
+                      "expired")
+    finally:
+        library.close()
@@ -0,0 +1,157 @@
+"""
+An in-process cache of book and member rows.
+
+A desk looks the same book and member up several times while serving one
+person: checking the ISBN and membership number, showing the book's record
+and then borrowing it. LibraryCache keeps the most recently used books and
+members in memory, so the repeat lookups do not go back to the database.
+
+Entries are removed by the LibraryService methods that change them, once the
+change is committed (see LibraryService._transaction), so one cache can be
+shared by every service writing to a database, e.g. all those handed out by a
+LibraryPools. A row read while a change is being made is not kept, in case it
+is the row from before the change.
+
+Changes made by other programs are not seen by the services. With
+other_writers=True the cache is emptied whenever the database has been
+changed by another connection, found with PRAGMA data_version. This is for a
+cache used by one service, e.g. one desk running the menu.
+
+Classes
+-------
+LibraryCache:
+    Least recently used caches of book and member rows.
+"""
+
+import collections
+import threading
+
+
+# Returned by LibraryCache.get when the row is not in the cache. (None is a
+# row that is not in the database, which is kept like any other.)
+MISSING = object()
+
+
+class LibraryCache:
+    """Least recently used caches of book and member rows.
+
+    Parameters
+    ----------
+    books: int
+        The most books kept.
+    members: int
+        The most members kept.
+    other_writers: bool
+        True if other programs may change the database, so the cache is
+        checked against PRAGMA data_version before each use (see the module
+        docstring).
+
+    Notes
+    -----
+        A kind of row is 'book' or 'member', and the key is the ISBN or
+        membership number."""
+
+    def __init__(self, books=10000, members=10000, other_writers=False):
+        self.sizes = {'book': books, 'member': members}
+        self.other_writers = other_writers
+        self._lock = threading.Lock()
+        self._rows = {kind: collections.OrderedDict() for kind in self.sizes}
+        # Moves on with every change, so a read that overlaps a change can
+        # be spotted (see put):
+        self.generation = 0
+        self._data_version = None
+        self.hits = dict.fromkeys(self.sizes, 0)
+        self.misses = dict.fromkeys(self.sizes, 0)
+
+    def get(self, kind, key):
+        """Method to look a row up.
+
+        Returns
+        -------
+        tuple
+            The row, None if the row is known not to exist, or MISSING if
+            it is not in the cache."""
+
+        with self._lock:
+            rows = self._rows[kind]
+            row = rows.get(key, MISSING)
+            if row is MISSING:
+                self.misses[kind] += 1
+            else:
+                self.hits[kind] += 1
+                rows.move_to_end(key)
+            return row
+
+    def put(self, kind, key, row, generation):
+        """Method to keep a row read from the database.
+
+        Parameters
+        ----------
+        kind: str
+            'book' or 'member'.
+        key: int
+            The ISBN or membership number.
+        row: tuple
+            The row, or None if there is no such row.
+        generation: int
+            The cache's generation from before the row was read. If any
+            row has been changed since, the row is not kept."""
+
+        with self._lock:
+            if generation != self.generation:
+                return
+            rows = self._rows[kind]
+            rows[key] = row
+            rows.move_to_end(key)
+            if len(rows) > self.sizes[kind]:
+                rows.popitem(last=False)
+
+    def invalidate(self, kind, key):
+        """Method to remove a row that has been changed."""
+
+        with self._lock:
+            self.generation += 1
+            self._rows[kind].pop(key, None)
+
+    def clear(self):
+        """Method to remove every row."""
+
+        with self._lock:
+            self.generation += 1
+            for rows in self._rows.values():
+                rows.clear()
+
+    def check_data_version(self, data_version):
+        """Method to empty the cache if another connection has changed the
+        database.
+
+        Parameters
+        ----------
+        data_version: int
+            The PRAGMA data_version of the connection the service reads
+            on, which changes when any other connection commits."""
+
+        with self._lock:
+            changed = (self._data_version is not None
+                       and data_version != self._data_version)
+            self._data_version = data_version
+        if changed:
+            self.clear()
+
+    def summary(self):
+        """Method to report how well the cache is working.
+
+        Returns
+        -------
+        dict
+            For 'book' and 'member': the hits, misses, hit_rate, and the
+            rows held (size) out of the most allowed (capacity)."""
+
+        with self._lock:
+            return {kind: {'hits': self.hits[kind],
+                           'misses': self.misses[kind],
+                           'hit_rate': self.hits[kind] / (
+                               self.hits[kind] + self.misses[kind] or 1),
+                           'size': len(self._rows[kind]),
+                           'capacity': self.sizes[kind]}
+                    for kind in self.sizes}
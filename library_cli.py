@@ -0,0 +1,245 @@
+"""
+The circulation desk without the menu: single commands and batches.
+
+Each command carries out one operation and exits, e.g.
+
+    python library_cli.py borrow 9781234567897 1234
+    python library_cli.py return 9781234567897 1234 --late
+
+and the batch command applies a stream of operations, e.g. a day's scanner
+log or a returns drop-box, from a file or standard input:
+
+    python library_cli.py batch returns.jsonl --output results.jsonl
+
+Each line of a batch is one operation, written as a request to the kiosk
+server (see library_server), e.g.
+
+    {"op": "return", "isbn": 9781234567897, "member_id": 1234}
+
+with one more operation, fine: member_id, and fine_qty (default 1). Every
+operation keeps the same rules as at the desk, as it is carried out by
+LibraryService. A line for each operation's result, the server's response
+with the line number, is written as JSON.
+
+A batch is committed every batch_size operations rather than after each
+one, which saves waiting for the disk at every operation. Each operation is
+still undone on its own if it fails (see library_transactions). Results are
+only written once the operations they are for have been committed, so the
+results file never reports an operation that was lost.
+
+Functions
+---------
+run_batch:
+    Applies a stream of operations, committing them in batches.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from library_pool import configure, connect_readonly
+from library_schema import connect
+from library_server import OPERATIONS
+from library_service import LibraryService
+from library_transactions import PROFILES, TransactionManager
+
+
+def _fine(library, request):
+    """Function to fine a member for a batch or command line request."""
+
+    return library.fine(int(request['member_id']),
+                        int(request.get('fine_qty', 1)))._asdict()
+
+
+# The kiosk operations, with fining (which kiosks cannot do) added:
+DESK_OPERATIONS = dict(OPERATIONS, fine=(_fine, True))
+
+
+def _carry_out(library, request):
+    """Function to carry out one request, returning its result."""
+
+    try:
+        operation, _ = DESK_OPERATIONS[request.get('op')]
+        return operation(library, request)
+    except KeyError as e:
+        return {'ok': False, 'status': 'bad_request',
+                'message': f"Error: Missing or unknown {e}"}
+    except (TypeError, ValueError) as e:
+        return {'ok': False, 'status': 'bad_request',
+                'message': f"Error: {e}"}
+
+
+def run_batch(db, lines, output, batch_size=500, durability='normal'):
+    """Function to apply a stream of operations, committing them in
+    batches.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to a migrated library database, used only by this
+        batch.
+    lines: iterable
+        The operations, one JSON request per line (see the module
+        docstring). Blank lines and lines starting with # are skipped.
+    output: file
+        Where to write a JSON line with each operation's result.
+    batch_size: int
+        The number of operations in each commit.
+    durability: str
+        The durability profile whose synchronous level to commit with,
+        e.g. 'strict' (see library_transactions).
+
+    Returns
+    -------
+    dict
+        The number of operations, how many went ahead, the number of
+        commits, the time taken in seconds and the operations per second.
+
+    Raises
+    ------
+    sqlite3.Error
+        If a commit fails. The results of the operations committed before
+        it have been written."""
+
+    transactions = TransactionManager(db, durability, group_ops=batch_size,
+                                      wait=False)
+    library = LibraryService(db, transactions=transactions)
+    # Results of the operations not yet committed:
+    waiting = []
+    operations = went_ahead = 0
+    start = time.perf_counter()
+
+    def write_waiting():
+        for result in waiting:
+            output.write(json.dumps(result) + '\n')
+        waiting.clear()
+
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        operations += 1
+
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError
+        except ValueError:
+            waiting.append({'line': number, 'ok': False,
+                            'status': 'bad_request',
+                            'message': "Error: Invalid JSON"})
+            continue
+
+        commits = transactions.commits
+        try:
+            result = _carry_out(library, request)
+        except Exception as e:
+            if transactions.commits != commits:
+                # The commit this operation ended failed, the batch is lost
+                raise
+            result = {'ok': False, 'status': 'error',
+                      'message': f"Error: {e}"}
+        result.update(line=number, id=request.get('id'))
+        went_ahead += bool(result.get('ok'))
+        waiting.append(result)
+        if transactions.commits != commits:
+            write_waiting()
+
+    transactions.flush()
+    write_waiting()
+    output.flush()
+    elapsed = time.perf_counter() - start
+    return {'operations': operations, 'ok': went_ahead,
+            'commits': transactions.commits, 'seconds': elapsed,
+            'ops_per_sec': operations / elapsed if elapsed else 0.0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Carry out circulation desk operations without the menu.")
+    parser.add_argument('--db', default='library_db')
+    parser.add_argument('--json', action='store_true',
+                        help="Print each result in full, as JSON")
+    commands = parser.add_subparsers(dest='op', required=True)
+
+    borrow = commands.add_parser('borrow', help="Borrow a book")
+    borrow.add_argument('isbn', type=int)
+    borrow.add_argument('member_id', type=int)
+    give_back = commands.add_parser(
+        'return', help="Return a book, by ISBN and member or by loan id")
+    give_back.add_argument('isbn', type=int, nargs='?')
+    give_back.add_argument('member_id', type=int, nargs='?')
+    give_back.add_argument('--loan', type=int, dest='loan_id')
+    on_time = give_back.add_mutually_exclusive_group()
+    on_time.add_argument('--on-time', action='store_true', default=None,
+                         help="Give a reward (default: by the due date)")
+    on_time.add_argument('--late', action='store_false', dest='on_time',
+                         help="Give a fine (default: by the due date)")
+    fine = commands.add_parser('fine', help="Fine a member")
+    fine.add_argument('member_id', type=int)
+    fine.add_argument('--fine-qty', type=int, default=1)
+    pay = commands.add_parser('pay_fine', help="Pay a member's fines")
+    pay.add_argument('member_id', type=int)
+    hold = commands.add_parser('hold', help="Place a hold on a book")
+    hold.add_argument('isbn', type=int)
+    hold.add_argument('member_id', type=int)
+    cancel = commands.add_parser('cancel_hold', help="Cancel a hold")
+    cancel.add_argument('isbn', type=int)
+    cancel.add_argument('member_id', type=int)
+    holds = commands.add_parser('holds', help="List a member's holds")
+    holds.add_argument('member_id', type=int)
+    member = commands.add_parser('member', help="Show a member's record")
+    member.add_argument('member_id', type=int)
+    search = commands.add_parser('search', help="Search for books")
+    search.add_argument('search_for')
+    search.add_argument('--column', choices=['title', 'author'])
+    search.add_argument('--limit', type=int, default=50)
+    batch = commands.add_parser(
+        'batch', help="Apply a file of operations, one JSON line each")
+    batch.add_argument('input', nargs='?', default='-',
+                       help="The operations (default: standard input)")
+    batch.add_argument('--output', '-o',
+                       help="File for the results (default: standard "
+                            "output)")
+    batch.add_argument('--batch-size', type=int, default=500,
+                       help="Operations in each commit")
+    batch.add_argument('--durability', choices=sorted(PROFILES),
+                       default='normal')
+    args = parser.parse_args()
+
+    if args.op == 'batch':
+        db = configure(connect(args.db))
+        source = sys.stdin if args.input == '-' else open(args.input)
+        results = sys.stdout if args.output is None else open(
+            args.output, 'w')
+        try:
+            summary = run_batch(db, source, results, args.batch_size,
+                                args.durability)
+        finally:
+            db.close()
+            if source is not sys.stdin:
+                source.close()
+            if results is not sys.stdout:
+                results.close()
+        # Kept off standard output, which may be the results:
+        print(f"{summary['operations']} operations ({summary['ok']} went "
+              f"ahead) in {summary['seconds']:.2f}s, "
+              f"{summary['ops_per_sec']:.0f} operations/s, "
+              f"{summary['commits']} commits", file=sys.stderr)
+    else:
+        request = {key: value for key, value in vars(args).items()
+                   if key not in ('db', 'json') and value is not None}
+        db = configure(connect(args.db))
+        read_db = connect_readonly(args.db)
+        try:
+            result = _carry_out(LibraryService(db, read_db), request)
+        finally:
+            read_db.close()
+            db.close()
+        if args.json or 'message' not in result:
+            print(json.dumps(result))
+        else:
+            print(result['message'])
+        if not result['ok']:
+            sys.exit(1)
@@ -0,0 +1,101 @@
+"""
+The pickup sweep: expiring holds that were not collected.
+
+A copy set aside for a hold (see LibraryService.place_hold) waits
+PICKUP_DAYS for the member to borrow it. expire_holds removes every ready
+hold past its collection date and sets each copy freed aside for the next
+member in that book's queue, or puts it back on the shelf if there is no one
+waiting. It is meant to run once a day, e.g. nightly.
+
+The sweep is one short transaction, whatever the number of holds: a single
+DELETE reads the expired holds from the holds_expiry index, then one
+prepared UPDATE (library_service.allocate_hold) is run for each copy freed,
+each finding the head of the book's queue with one lookup in the
+holds_queue index.
+
+Functions
+---------
+expire_holds:
+    Expires uncollected holds and passes their copies on, in one
+    transaction.
+"""
+
+import argparse
+import time
+
+from library_pool import configure
+from library_schema import connect
+from library_service import allocate_hold
+from library_stats import execute
+
+
+def expire_holds(db, day=None, stats=None):
+    """Function to expire uncollected holds and pass their copies on.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to a migrated library database.
+    day: int
+        Holds to be collected by a day before this day number (days since
+        1970-01-01) have expired. None for today.
+    stats: QueryStats
+        To time each statement (see library_stats), or None.
+
+    Returns
+    -------
+    dict
+        The number of holds expired, the number of copies set aside for
+        the next hold in their queue, and the time taken in seconds.
+
+    Notes
+    -----
+        Books' rows change outside any LibraryService, so a cache shared by
+        services in another program (see library_cache) should be cleared
+        afterwards."""
+
+    cursor = db.cursor()
+    start = time.perf_counter()
+    try:
+        cursor.execute('''BEGIN IMMEDIATE;''')
+        if day is None:
+            cursor.execute('''
+                SELECT CAST(julianday('now') - 2440587.5 AS INTEGER);''')
+            day = cursor.fetchone()[0]
+
+        execute(cursor, stats, 'expire_holds.delete', '''
+            DELETE FROM holds
+            WHERE day_ready IS NOT NULL AND day_expires < ?
+            RETURNING isbn;''', (day,))
+        freed = cursor.fetchall()
+
+        # One freed copy at a time, so that a book with several copies
+        # freed serves several holds in turn:
+        allocated = 0
+        for (isbn,) in freed:
+            if allocate_hold(cursor, isbn, day, stats,
+                             'expire_holds.allocate') is not None:
+                allocated += 1
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return {'expired': len(freed), 'allocated': allocated,
+            'seconds': time.perf_counter() - start}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Expire holds that were not collected in time.")
+    parser.add_argument('--db', default='library_db')
+    args = parser.parse_args()
+
+    db = configure(connect(args.db))
+    try:
+        result = expire_holds(db)
+        print(f"{result['expired']} holds expired, {result['allocated']} "
+              f"copies set aside for the next in the queue, "
+              f"{result['seconds']:.1f}s")
+    finally:
+        db.close()
@@ -0,0 +1,209 @@
+"""
+Allocation of new membership numbers.
+
+Membership numbers come from a sequence stored in the id_sequences table.
+Numbers are reserved in blocks inside a write transaction, so several
+terminals can allocate at once without ever handing out the same number,
+and no allocation reads the whole users table. Numbers already taken (e.g.
+by members added before the sequence existed) are skipped with one indexed
+range lookup per block.
+
+A membership number is a fixed number of digits, optionally followed by a
+Luhn check digit so that mistyped numbers can be spotted.
+
+Classes
+-------
+IdAllocator:
+    Hands out new membership numbers.
+IdSpaceExhausted:
+    Raised when every number of the configured width has been used.
+
+Functions
+---------
+check_digit:
+    Calculates the Luhn check digit for a number.
+has_valid_check_digit:
+    Checks the last digit of a number is its Luhn check digit.
+"""
+
+
+class IdSpaceExhausted(RuntimeError):
+    """Raised when every membership number of the configured width has been
+    allocated. Use a wider IdAllocator to carry on."""
+
+
+def check_digit(number):
+    """Function to calculate the Luhn check digit for a number.
+
+    Parameters
+    ----------
+    number: int
+        The number without its check digit.
+
+    Returns
+    -------
+    int
+        The digit to append, so that the result passes the Luhn check."""
+
+    total = 0
+    # Double every other digit, starting from the rightmost:
+    for position, digit in enumerate(reversed(str(number))):
+        digit = int(digit)
+        if position % 2 == 0:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return (10 - total % 10) % 10
+
+
+def has_valid_check_digit(member_id):
+    """Function to check the last digit of a number is its check digit.
+
+    Parameters
+    ----------
+    member_id: int
+        The full membership number.
+
+    Returns
+    -------
+    bool
+        True if the check digit is right."""
+
+    return member_id >= 10 and check_digit(member_id // 10) == member_id % 10
+
+
+class IdAllocator:
+    """Hands out new membership numbers.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to a migrated library database.
+    width: int
+        The number of digits in a membership number, not counting the
+        check digit. Numbers start at 10 ** (width - 1), so the default
+        gives the original 1000 - 9999 card numbers.
+    use_check_digit: bool
+        True to add a Luhn check digit to the end of each number.
+    block_size: int
+        How many numbers to reserve at a time. Reserving more than one
+        saves a write to the sequence for every new member, but numbers
+        still unused when the program exits are never handed out. Blocks
+        are only kept for later in a transaction of their own (see
+        reserve), so a rollback can never leave numbers in memory that
+        the sequence will hand out again."""
+
+    def __init__(self, db, width=4, use_check_digit=False, block_size=1):
+        self.db = db
+        self.width = width
+        self.use_check_digit = use_check_digit
+        self.block_size = block_size
+        # Each format of number has its own sequence:
+        self.sequence = f"member_id:{width}{':luhn' if use_check_digit else ''}"
+        self._reserved = []
+
+    def _full_id(self, body):
+        """Method to turn a sequence number into a membership number."""
+
+        if self.use_check_digit:
+            return body * 10 + check_digit(body)
+        return body
+
+    def allocate(self):
+        """Method to get one new membership number.
+
+        Returns
+        -------
+        int
+            A membership number no member has."""
+
+        if not self._reserved:
+            if self.db.in_transaction:
+                # Taken in the caller's transaction, and given back to the
+                # sequence with it if it rolls back:
+                return self.allocate_block(1)[0]
+            self._reserved = self.allocate_block(self.block_size)
+        return self._reserved.pop(0)
+
+    def reserve(self):
+        """Method to reserve the next block of numbers, if none are left,
+        in a transaction of its own. Call it before starting a transaction
+        that will allocate a number, so that allocate need not take one in
+        that transaction."""
+
+        if self._reserved or self.block_size <= 1 or self.db.in_transaction:
+            return
+        try:
+            self._reserved = self.allocate_block(self.block_size)
+        except IdSpaceExhausted:
+            # Fewer numbers are left than a block, so allocate takes them
+            # one at a time until there are none:
+            pass
+
+    def allocate_block(self, count):
+        """Method to reserve several new membership numbers at once, e.g.
+        for a bulk import of members.
+
+        Parameters
+        ----------
+        count: int
+            How many numbers are needed.
+
+        Returns
+        -------
+        list
+            count membership numbers, in increasing order.
+
+        Raises
+        ------
+        IdSpaceExhausted
+            If there are not count numbers of this width left."""
+
+        cursor = self.db.cursor()
+        lowest = 10 ** (self.width - 1)
+        highest = 10 ** self.width - 1
+
+        # Only start a transaction if the caller is not already in one.
+        # IMMEDIATE takes the write lock first, so two terminals cannot
+        # read the same next_value:
+        own_transaction = not self.db.in_transaction
+        if own_transaction:
+            cursor.execute('''BEGIN IMMEDIATE;''')
+        try:
+            cursor.execute('''
+                INSERT OR IGNORE INTO id_sequences(name, next_value)
+                VALUES(?,?);''', (self.sequence, lowest))
+            cursor.execute('''SELECT next_value FROM id_sequences
+                            WHERE name = ?;''', (self.sequence,))
+            next_value = cursor.fetchone()[0]
+
+            ids = []
+            while len(ids) < count:
+                if next_value > highest:
+                    raise IdSpaceExhausted(
+                        f"All {self.width} digit membership numbers "
+                        "have been used.")
+
+                # Take the next run of numbers, less any already in use:
+                last = min(next_value + count - len(ids) - 1, highest)
+                cursor.execute('''SELECT id FROM users
+                                WHERE id BETWEEN ? AND ?;''',
+                               (self._full_id(next_value),
+                                self._full_id(last)))
+                taken = {row[0] for row in cursor.fetchall()}
+                ids += [self._full_id(body)
+                        for body in range(next_value, last + 1)
+                        if self._full_id(body) not in taken]
+                next_value = last + 1
+
+            cursor.execute('''UPDATE id_sequences SET next_value = ?
+                            WHERE name = ?;''', (next_value, self.sequence))
+            if own_transaction:
+                self.db.commit()
+        except Exception:
+            if own_transaction:
+                self.db.rollback()
+            raise
+
+        return ids
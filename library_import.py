@@ -0,0 +1,281 @@
+"""
+Bulk loading of books and members into the library database.
+
+Rows are streamed from CSV or JSONL files and written in chunks, each chunk
+with one executemany inside one transaction, so memory use depends on the
+chunk size rather than the size of the file.
+
+CSV files need a header row. Book files use the columns isbn, title, author
+and stock (stock defaults to 1), member files use id and name. Copies added
+to a book members are waiting for are set aside for its holds queue, in the
+chunk's transaction, as LibraryService.add_stock does. Members with
+no id are given new membership numbers, reserved a chunk at a time. JSONL
+files hold one object per line with the same keys.
+
+Functions
+---------
+read_rows:
+    Streams the rows of a CSV or JSONL file as dictionaries.
+import_books:
+    Adds books to the library stock from a file.
+import_members:
+    Adds library members to the database from a file.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import time
+
+from library_ids import IdAllocator
+from library_schema import connect
+from library_service import allocate_hold, valid_isbn
+
+
+def read_rows(path):
+    """Function to stream the rows of a CSV or JSONL file.
+
+    Parameters
+    ----------
+    path: str
+        The file to read. Files ending .jsonl or .json are read as one JSON
+        object per line, anything else as CSV with a header row.
+
+    Yields
+    ------
+    dict
+        The next row, or None for a line that could not be read."""
+
+    with open(path, newline='', encoding='utf-8') as file:
+        if path.endswith(('.jsonl', '.json')):
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield row if isinstance(row, dict) else None
+        else:
+            yield from csv.DictReader(file)
+
+
+def _book_params(row):
+    """Function to turn a row from a book file into INSERT parameters,
+    or None if the row is not valid."""
+
+    if not row:
+        return None
+    isbn = valid_isbn(row.get('isbn'))
+    title = (row.get('title') or '').strip()
+    try:
+        stock = int(row.get('stock') or 1)
+    except (TypeError, ValueError):
+        return None
+    if isbn is None or not title or stock <= 0:
+        return None
+    return isbn, title, (row.get('author') or '').strip(), stock
+
+
+def _member_params(row):
+    """Function to turn a row from a member file into INSERT parameters,
+    or None if the row is not valid."""
+
+    if not row:
+        return None
+    name = (row.get('name') or '').strip()
+    if not name:
+        return None
+    if row.get('id') in (None, ''):
+        # A new member, to be given a number when the chunk is written:
+        return None, name.capitalize()
+    try:
+        member_id = int(row.get('id'))
+    except (TypeError, ValueError):
+        return None
+    if member_id <= 0:
+        return None
+    return member_id, name.capitalize()
+
+
+def _load(db, path, to_params, statement, chunk_size, progress,
+          prepare=None, finish=None):
+    """Function to write a file to the database in chunked transactions.
+    prepare, if given, is called with each chunk's parameters inside its
+    transaction and returns the parameters to write. finish, if given, is
+    called with the parameters written, still inside the transaction.
+
+    Returns
+    -------
+    dict
+        Counts of rows read, written and rejected, the time taken and the
+        rows per second."""
+
+    cursor = db.cursor()
+    stats = {'rows': 0, 'written': 0, 'rejected': 0}
+    start = time.perf_counter()
+
+    rows = read_rows(path)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        params = [p for p in map(to_params, chunk) if p is not None]
+
+        try:
+            cursor.execute('''BEGIN;''')
+            if prepare:
+                params = prepare(params)
+            cursor.executemany(statement, params)
+            written = cursor.rowcount
+            if finish:
+                finish(params)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        stats['rows'] += len(chunk)
+        stats['written'] += written
+        stats['rejected'] += len(chunk) - len(params)
+        if progress:
+            elapsed = time.perf_counter() - start
+            print(f"{stats['rows']} rows read "
+                  f"({stats['rows'] / elapsed:.0f} rows/sec)")
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['rows_per_sec'] = stats['rows'] / stats['seconds']
+    return stats
+
+
+def import_books(db, path, chunk_size=10000, progress=False):
+    """Function to add books to the library stock from a file.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to a migrated library database.
+    path: str
+        The CSV or JSONL file of books.
+    chunk_size: int
+        The number of rows written in each transaction.
+    progress: bool
+        True to print the running rows/sec after each chunk.
+
+    Returns
+    -------
+    dict
+        Counts of rows read, written and rejected, and of copies set aside
+        for holds, the time taken and the rows per second.
+
+    Notes
+    -----
+        As in add_book, an ISBN already in the library has the copies
+        added to its stock - its title and author are left as they are.
+        As in add_stock, the new copies go to the book's holds queue
+        first."""
+
+    cursor = db.cursor()
+    set_aside = 0
+
+    def allocate_holds(params):
+        nonlocal set_aside
+        # Each book is looked up by its primary key. Only books with
+        # members waiting are given to the holds queue:
+        for isbn in dict.fromkeys(isbn for isbn, *_ in params):
+            cursor.execute('''SELECT holds FROM books WHERE isbn = ?;''',
+                           (isbn,))
+            if cursor.fetchone()[0] > 0:
+                while allocate_hold(cursor, isbn) is not None:
+                    set_aside += 1
+
+    result = _load(db, path, _book_params, '''
+            INSERT INTO books(isbn, title, author, stock)
+            VALUES(?,?,?,?)
+            ON CONFLICT(isbn) DO UPDATE SET stock = stock + excluded.stock;
+            ''', chunk_size, progress, finish=allocate_holds)
+    result['set_aside'] = set_aside
+    return result
+
+
+def import_members(db, path, chunk_size=10000, progress=False, ids=None):
+    """Function to add library members to the database from a file.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to a migrated library database.
+    path: str
+        The CSV or JSONL file of members.
+    chunk_size: int
+        The number of rows written in each transaction.
+    progress: bool
+        True to print the running rows/sec after each chunk.
+    ids: IdAllocator
+        Gives numbers to members with no id. The default gives 4 digit
+        numbers with no check digit.
+
+    Returns
+    -------
+    dict
+        Counts of rows read, written and rejected, the time taken and the
+        rows per second.
+
+    Notes
+    -----
+        New members start with no fines or rewards and a borrow limit of 3,
+        as in add_member. Rows for IDs already in use are not written."""
+
+    ids = ids or IdAllocator(db)
+
+    def number_new_members(params):
+        # One block of numbers covers every new member in the chunk,
+        # leaving out any numbers given to other members in the same chunk:
+        given = {member_id for member_id, _ in params if member_id}
+        needed = sum(1 for member_id, _ in params if member_id is None)
+        new_ids = []
+        while len(new_ids) < needed:
+            new_ids += [member_id for member_id
+                        in ids.allocate_block(needed - len(new_ids))
+                        if member_id not in given]
+        new_ids = iter(new_ids)
+        return [(member_id or next(new_ids), name)
+                for member_id, name in params]
+
+    return _load(db, path, _member_params, '''
+            INSERT INTO users(id, name, fines, rewards, borrow_limit)
+            VALUES(?,?,0,0,3)
+            ON CONFLICT(id) DO NOTHING;
+            ''', chunk_size, progress, number_new_members)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Bulk import books or members into the library database.")
+    parser.add_argument('table', choices=['books', 'members'])
+    parser.add_argument('path', help="CSV or JSONL file to import")
+    parser.add_argument('--db', default='library_db')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--id-width', type=int, default=4,
+                        help="digits in new membership numbers")
+    parser.add_argument('--check-digit', action='store_true',
+                        help="add a check digit to new membership numbers")
+    args = parser.parse_args()
+
+    db = connect(args.db)
+    try:
+        if args.table == 'books':
+            result = import_books(db, args.path, args.chunk_size, True)
+        else:
+            result = import_members(
+                db, args.path, args.chunk_size, True,
+                IdAllocator(db, args.id_width, args.check_digit))
+        print(f"{result['written']} of {result['rows']} rows written, "
+              f"{result['rejected']} rejected, in {result['seconds']:.1f}s "
+              f"({result['rows_per_sec']:.0f} rows/sec)")
+        if result.get('set_aside'):
+            print(f"{result['set_aside']} copies set aside for members "
+                  "with the books on hold")
+    finally:
+        db.close()
@@ -0,0 +1,198 @@
+"""
+The outbox: the changes made to the library, for other systems to follow.
+
+Every change made through LibraryService adds an event to the outbox table
+in the change's own transaction, so an event is kept if and only if its
+change is. The overdue sweep (see library_overdue) adds a 'fine' event for
+each member it fines. Reporting and notification systems can then keep the
+seq of the last event they handled and read only the events after it,
+rather than querying whole tables to see what has changed.
+
+Events are numbered by seq, which only ever goes up. As SQLite has one
+writer at a time, events are committed in seq order: a consumer that has
+read up to a seq will never later find an earlier event it missed.
+
+Each event is a (seq, at, kind, isbn, user_id, loan_id, value) tuple, where
+at is the time in seconds since 1970-01-01. The kinds of event, and what
+value holds for each, are:
+
+    borrow_book   The day number (days since 1970-01-01) the loan is due.
+    return_book   None.
+    fine          The number of fines given.
+    reward        The member's reward points after it, 0 when the reward
+                  raised their borrowing limit.
+    pay_fine      The number of fines paid.
+    add_book      The number of copies of the new book.
+    add_stock     The number of copies added.
+    remove_book   None. user_id is the member who lost the copy, if any.
+    add_member    None.
+
+At a library with several branches (see library_branches), each branch's
+shard has an outbox of its own, for the changes made at that branch.
+
+Functions
+---------
+read_events:
+    Reads the next batch of events after a seq.
+tail_events:
+    Yields the events after a seq in batches, optionally waiting for more.
+trim_events:
+    Deletes the events every consumer has handled.
+"""
+
+import argparse
+import json
+import time
+
+from library_pool import configure, connect_readonly
+from library_schema import connect
+from library_stats import execute
+
+
+# The names of the columns of an event, in order:
+EVENT_COLUMNS = ('seq', 'at', 'kind', 'isbn', 'user_id', 'loan_id', 'value')
+
+
+def read_events(db, after=0, limit=1000, stats=None):
+    """Function to read the next batch of events.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to a migrated library database, e.g. a read-only
+        one (see library_pool).
+    after: int
+        The seq of the last event already handled, 0 to start from the
+        oldest event kept.
+    limit: int
+        The most events to return.
+    stats: QueryStats
+        To time the query (see library_stats), or None.
+
+    Returns
+    -------
+    list
+        Event tuples (see the module docstring), in seq order.
+
+    Notes
+    -----
+        Events are found by seq in the table's primary key, so a batch is
+        as quick to read from the end of a long outbox as from the start."""
+
+    cursor = db.cursor()
+    execute(cursor, stats, 'read_events', '''
+        SELECT seq, at, kind, isbn, user_id, loan_id, value
+        FROM outbox
+        WHERE seq > ?
+        ORDER BY seq
+        LIMIT ?;''', (after, limit))
+    return cursor.fetchall()
+
+
+def tail_events(db, after=0, batch_size=1000, follow=False,
+                poll_interval=1.0):
+    """Function to read every event after a seq, a batch at a time.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        As for read_events. It should not be in a transaction, so that
+        each batch sees the events committed since the last.
+    after: int
+        The seq of the last event already handled.
+    batch_size: int
+        The most events in each batch.
+    follow: bool
+        True to carry on waiting for new events once every event has been
+        read, as 'tail -f' does, rather than stopping.
+    poll_interval: float
+        How long, in seconds, to wait before looking for new events when
+        following.
+
+    Yields
+    ------
+    list
+        The next batch of event tuples, in seq order. The last seq of a
+        batch is where to carry on from next time."""
+
+    while True:
+        batch = read_events(db, after, batch_size)
+        if batch:
+            after = batch[-1][0]
+            yield batch
+        if len(batch) < batch_size:
+            # Caught up with the outbox:
+            if not follow:
+                return
+            time.sleep(poll_interval)
+
+
+def trim_events(db, up_to):
+    """Function to delete events every consumer has handled, to keep the
+    outbox small.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to a migrated library database.
+    up_to: int
+        The lowest seq handled by every consumer. This event and those
+        before it are deleted.
+
+    Returns
+    -------
+    int
+        The number of events deleted.
+
+    Notes
+    -----
+        The seq numbers of deleted events are never used again, so the
+        consumers can carry on from where they were."""
+
+    cursor = db.cursor()
+    try:
+        cursor.execute('''BEGIN IMMEDIATE;''')
+        cursor.execute('''DELETE FROM outbox WHERE seq <= ?;''', (up_to,))
+        deleted = cursor.rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return deleted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Print the library's change events as JSON lines.")
+    parser.add_argument('--db', default='library_db')
+    parser.add_argument('--after', type=int, default=0,
+                        help="The seq of the last event already handled")
+    parser.add_argument('--batch', type=int, default=1000,
+                        help="The most events to read at a time")
+    parser.add_argument('--follow', action='store_true',
+                        help="Keep waiting for new events")
+    parser.add_argument('--trim', action='store_true',
+                        help="Delete the events up to --after instead")
+    args = parser.parse_args()
+
+    if args.trim:
+        db = configure(connect(args.db))
+        try:
+            print(f"{trim_events(db, args.after)} events deleted")
+        finally:
+            db.close()
+    else:
+        # Creates or upgrades the database first, as connect_readonly
+        # cannot:
+        connect(args.db).close()
+        db = connect_readonly(args.db)
+        try:
+            for events in tail_events(db, args.after, args.batch,
+                                      args.follow):
+                for event in events:
+                    print(json.dumps(dict(zip(EVENT_COLUMNS, event))),
+                          flush=True)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            db.close()
@@ -0,0 +1,111 @@
+"""
+The overdue sweep: fining members for books kept past their due date.
+
+Each loan is due back LOAN_DAYS after it is borrowed (see library_service).
+fine_overdue finds every open loan past its due date that has not been fined
+for yet, and gives each member one fine per overdue book, resetting their
+rewards and borrowing limit as a fine at the desk does. It is meant to run
+once a day, e.g. nightly.
+
+The sweep is three set-based statements in one short transaction, whatever
+the number of overdue loans: one fines the members, one adds a 'fine' event
+to the outbox for each of them (see library_outbox), and the last marks the
+loans as fined so they are not fined again (nor when they are returned, see
+LibraryService.return_book). All three read the overdue loans from the
+records_overdue index, which holds only the open loans not yet fined.
+
+Functions
+---------
+fine_overdue:
+    Fines members for every overdue loan in one transaction.
+"""
+
+import argparse
+import time
+
+from library_pool import configure
+from library_schema import connect
+from library_stats import execute
+
+
+def fine_overdue(db, day=None, stats=None):
+    """Function to fine members for their overdue loans.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to a migrated library database.
+    day: int
+        Loans due before this day number (days since 1970-01-01) are
+        overdue. None for today.
+    stats: QueryStats
+        To time each statement (see library_stats), or None.
+
+    Returns
+    -------
+    dict
+        The number of loans and members fined, and the time taken in
+        seconds.
+
+    Notes
+    -----
+        Members' rows change outside any LibraryService, so a cache shared
+        by services in another program (see library_cache) should be
+        cleared afterwards."""
+
+    cursor = db.cursor()
+    start = time.perf_counter()
+    try:
+        cursor.execute('''BEGIN IMMEDIATE;''')
+        if day is None:
+            cursor.execute('''
+                SELECT CAST(julianday('now') - 2440587.5 AS INTEGER);''')
+            day = cursor.fetchone()[0]
+
+        # Every statement sees the same overdue loans, as the write lock is
+        # held between them. Left to itself, the planner would rather read
+        # every open loan in member order than sort the overdue ones:
+        execute(cursor, stats, 'fine_overdue.members', '''
+            UPDATE users
+            SET fines = fines + overdue.loans, rewards = 0, borrow_limit = 3
+            FROM (
+                SELECT user_id, COUNT(*) AS loans
+                FROM records INDEXED BY records_overdue
+                WHERE day_in IS NULL AND fined = 0 AND day_due < ?
+                GROUP BY user_id) AS overdue
+            WHERE users.id = overdue.user_id;''', (day,))
+        members = cursor.rowcount
+        execute(cursor, stats, 'fine_overdue.outbox', '''
+            INSERT INTO outbox(at, kind, user_id, value)
+            SELECT CAST((julianday('now') - 2440587.5) * 86400 AS INTEGER),
+            'fine', user_id, COUNT(*)
+            FROM records INDEXED BY records_overdue
+            WHERE day_in IS NULL AND fined = 0 AND day_due < ?
+            GROUP BY user_id;''', (day,))
+        execute(cursor, stats, 'fine_overdue.loans', '''
+            UPDATE records
+            SET fined = 1
+            WHERE day_in IS NULL AND fined = 0 AND day_due < ?;''', (day,))
+        loans = cursor.rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return {'loans': loans, 'members': members,
+            'seconds': time.perf_counter() - start}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Fine members for overdue loans.")
+    parser.add_argument('--db', default='library_db')
+    args = parser.parse_args()
+
+    db = configure(connect(args.db))
+    try:
+        result = fine_overdue(db)
+        print(f"{result['loans']} overdue loans fined, for "
+              f"{result['members']} members, {result['seconds']:.1f}s")
+    finally:
+        db.close()
@@ -0,0 +1,402 @@
+"""
+Concurrent access to one library database from many circulation desks.
+
+The database is switched to write-ahead logging (WAL), so readers never block
+the writer and the writer never blocks readers. Connections are handed out
+from bounded pools, one connection per thread at a time: a write pool for
+borrowing, returning and other changes, and a read-only pool for searches and
+reports.
+
+With a grouped durability profile (see library_transactions), changes from
+every desk are made on one shared write connection and share commits.
+
+Classes
+-------
+ConnectionPool:
+    A bounded pool of connections to one database file.
+LibraryPools:
+    Write and read pools for a library database, handing out LibraryService
+    objects.
+
+Functions
+---------
+configure:
+    Sets the WAL, busy timeout and synchronous settings on a connection.
+connect_readonly:
+    Opens a read-only connection to a library database.
+stress_test:
+    Measures throughput as more desks share the database.
+"""
+
+import argparse
+import contextlib
+import queue
+import random as rd
+import sqlite3
+import threading
+import time
+
+from library_schema import connect
+from library_service import LibraryService
+from library_transactions import PROFILES, TransactionManager
+
+
+# How long (in ms) a connection waits for a lock before giving up with
+# "database is locked". Desk transactions are short, so a few seconds is
+# far longer than any normal wait.
+BUSY_TIMEOUT = 5000
+
+# NORMAL only syncs the WAL at checkpoints. A power cut can lose the last
+# few commits, but never corrupts the database. FULL syncs every commit.
+SYNCHRONOUS = 'NORMAL'
+
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+def configure(db, busy_timeout=BUSY_TIMEOUT, synchronous=SYNCHRONOUS,
+              readonly=False):
+    """Function to set up a connection for use by many desks at once.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to configure.
+    busy_timeout: int
+        How long, in milliseconds, to wait for a lock.
+    synchronous: str
+        The synchronous level: 'OFF', 'NORMAL', 'FULL' or 'EXTRA'.
+    readonly: bool
+        True for a read-only connection, which cannot change the journal
+        mode (it reads a WAL database all the same).
+
+    Returns
+    -------
+    sqlite3.Connection
+        The same connection."""
+
+    if synchronous.upper() not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f"Unknown synchronous level {synchronous}")
+
+    # PRAGMA does not accept parameters, both values are checked above:
+    db.execute('''PRAGMA busy_timeout = %d;''' % int(busy_timeout))
+    if not readonly:
+        # WAL is stored in the database file, so this is only slow once:
+        db.execute('''PRAGMA journal_mode = WAL;''')
+    db.execute('''PRAGMA synchronous = %s;''' % synchronous.upper())
+    return db
+
+
+def connect_readonly(path='library_db', busy_timeout=BUSY_TIMEOUT):
+    """Function to open a read-only connection to a library database.
+
+    Parameters
+    ----------
+    path: str
+        The database file, which must already exist.
+    busy_timeout: int
+        How long, in milliseconds, to wait for a lock.
+
+    Returns
+    -------
+    sqlite3.Connection
+        A connection that can only read the database."""
+
+    db = sqlite3.connect(f'file:{path}?mode=ro', uri=True,
+                         check_same_thread=False)
+    return configure(db, busy_timeout, readonly=True)
+
+
+class ConnectionPool:
+    """A bounded pool of connections to one database file.
+
+    Connections are opened when first needed, up to size of them. A thread
+    that finds them all in use waits until one is handed back.
+
+    Parameters
+    ----------
+    path: str
+        The database file.
+    size: int
+        The most connections the pool will open.
+    readonly: bool
+        True to open read-only connections.
+    busy_timeout: int
+        How long, in milliseconds, each connection waits for a lock.
+    synchronous: str
+        The synchronous level for write connections."""
+
+    def __init__(self, path, size, readonly=False, busy_timeout=BUSY_TIMEOUT,
+                 synchronous=SYNCHRONOUS):
+        self.path = path
+        self.readonly = readonly
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+
+        # None marks a slot with no connection opened yet:
+        self._idle = queue.LifoQueue(maxsize=size)
+        for _ in range(size):
+            self._idle.put(None)
+        self._all = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """Method to open a new connection for the pool."""
+
+        if self.readonly:
+            db = connect_readonly(self.path, self.busy_timeout)
+        else:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            configure(db, self.busy_timeout, self.synchronous)
+        with self._lock:
+            self._all.append(db)
+        return db
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """Method to check a connection out of the pool.
+
+        Parameters
+        ----------
+        timeout: float
+            Seconds to wait for a free connection, or None to wait for as
+            long as it takes.
+
+        Yields
+        ------
+        sqlite3.Connection
+            A connection only the calling thread is using. It goes back to
+            the pool when the with block ends, with any open transaction
+            rolled back."""
+
+        db = self._idle.get(timeout=timeout)
+        try:
+            if db is None:
+                db = self._open()
+            yield db
+        finally:
+            if db is not None and db.in_transaction:
+                db.rollback()
+            self._idle.put(db)
+
+    def close(self):
+        """Method to close every connection the pool has opened."""
+
+        with self._lock:
+            for db in self._all:
+                db.close()
+            self._all = []
+
+
+class LibraryPools:
+    """Write and read connection pools for one library database.
+
+    Parameters
+    ----------
+    path: str
+        The database file. It is created or upgraded, and switched to WAL.
+    writers: int
+        The most write connections to open.
+    readers: int
+        The most read-only connections to open.
+    busy_timeout: int
+        How long, in milliseconds, each connection waits for a lock.
+    synchronous: str
+        The synchronous level for write connections.
+    stats: QueryStats
+        Shared by every service handed out, to time their statements (see
+        library_stats). None to not time them.
+    durability: str
+        A durability profile from library_transactions, e.g. 'strict', or
+        None to commit as set by synchronous. With the 'group' and 'bulk'
+        profiles, every service shares one write connection so that their
+        changes can share commits.
+    cache: LibraryCache
+        Shared by every service handed out, to keep book and member rows
+        (see library_cache). None to not keep them."""
+
+    def __init__(self, path='library_db', writers=4, readers=8,
+                 busy_timeout=BUSY_TIMEOUT, synchronous=SYNCHRONOUS,
+                 stats=None, durability=None, cache=None):
+        if durability is not None:
+            synchronous = PROFILES[durability].synchronous
+
+        # Migrate and turn on WAL once, before any pooled connection opens:
+        db = connect(path)
+        configure(db, busy_timeout, synchronous)
+        db.close()
+
+        self.write_pool = ConnectionPool(path, writers, False, busy_timeout,
+                                         synchronous)
+        self.read_pool = ConnectionPool(path, readers, True, busy_timeout)
+        self.stats = stats
+        self.cache = cache
+
+        self.transactions = None
+        if durability is not None and PROFILES[durability].group_ops > 1:
+            shared_db = sqlite3.connect(path, check_same_thread=False)
+            configure(shared_db, busy_timeout, synchronous)
+            self.transactions = TransactionManager(shared_db, durability)
+
+    @contextlib.contextmanager
+    def service(self):
+        """Method to get a LibraryService using pooled connections.
+
+        Yields
+        ------
+        LibraryService
+            A service that makes changes on a write connection and runs
+            searches and reports on a read-only connection."""
+
+        if self.transactions is not None:
+            with self.read_pool.connection() as read_db:
+                yield LibraryService(self.transactions.db, read_db,
+                                     stats=self.stats,
+                                     transactions=self.transactions,
+                                     cache=self.cache)
+            return
+
+        with self.write_pool.connection() as db:
+            with self.read_pool.connection() as read_db:
+                yield LibraryService(db, read_db, stats=self.stats,
+                                     cache=self.cache)
+
+    @contextlib.contextmanager
+    def reader(self):
+        """Method to get a LibraryService for searches and reports only.
+
+        Yields
+        ------
+        LibraryService
+            A service using only a read-only connection, so it never waits
+            for a write connection."""
+
+        with self.read_pool.connection() as read_db:
+            yield LibraryService(read_db, read_db, stats=self.stats,
+                                 cache=self.cache)
+
+    def close(self):
+        """Method to close all pooled connections, committing any changes
+        still waiting for a group commit."""
+
+        if self.transactions is not None:
+            self.transactions.close()
+        self.write_pool.close()
+        self.read_pool.close()
+
+
+# ------------------------------------------------------------------------
+# Stress test
+# ------------------------------------------------------------------------
+
+def _seed(path, books, members):
+    """Function to fill an empty database with books and members for the
+    stress test."""
+
+    db = connect(path)
+    try:
+        db.execute('''BEGIN;''')
+        db.executemany('''
+            INSERT OR IGNORE INTO books(isbn, title, author, stock)
+            VALUES(?,?,?,?);''',
+            ((9780000000000 + i, f"Stress Test Book {i}",
+              f"Author {i % 100}", 3) for i in range(books)))
+        db.executemany('''
+            INSERT OR IGNORE INTO users(id, name, fines, rewards, borrow_limit)
+            VALUES(?,?,0,0,6);''',
+            ((1000 + i, f"Member {i}") for i in range(members)))
+        db.commit()
+    finally:
+        db.close()
+
+
+def _desk(pools, books, members, stop, counts):
+    """Function run by each desk thread of the stress test: a mix of
+    searches, book lookups, borrows and returns until told to stop."""
+
+    done = 0
+    locked = 0
+    while not stop.is_set():
+        choice = rd.random()
+        isbn = 9780000000000 + rd.randrange(books)
+        member_id = 1000 + rd.randrange(members)
+        try:
+            if choice < 0.4:
+                with pools.reader() as library:
+                    library.search_books('title', str(rd.randrange(books)))
+            elif choice < 0.7:
+                with pools.reader() as library:
+                    library.book_record(isbn)
+            else:
+                with pools.service() as library:
+                    outcome = library.borrow_book(isbn, member_id)
+                    if outcome.status == 'has_copy':
+                        library.return_book(isbn, member_id)
+            done += 1
+        except sqlite3.OperationalError:
+            # "database is locked" after waiting for the busy timeout
+            locked += 1
+    counts.append((done, locked))
+
+
+def stress_test(path, terminals=(1, 2, 4, 8), seconds=5.0, books=10000,
+                members=2000):
+    """Function to measure throughput as more desks use the database.
+
+    Parameters
+    ----------
+    path: str
+        The database file to use. Books and members are added if missing.
+    terminals: tuple
+        The numbers of desks to try, each as a separate run.
+    seconds: float
+        How long each run lasts.
+    books: int
+        The number of books in the test library.
+    members: int
+        The number of members in the test library.
+
+    Returns
+    -------
+    list
+        (desks, operations, operations per second, locked errors) for each
+        run."""
+
+    _seed(path, books, members)
+    results = []
+
+    for desks in terminals:
+        pools = LibraryPools(path, writers=desks, readers=desks)
+        stop = threading.Event()
+        counts = []
+        threads = [threading.Thread(target=_desk,
+                                    args=(pools, books, members, stop, counts))
+                   for _ in range(desks)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        pools.close()
+
+        done = sum(count[0] for count in counts)
+        locked = sum(count[1] for count in counts)
+        results.append((desks, done, done / elapsed, locked))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Stress test a library database with many desks.")
+    parser.add_argument('--db', default='library_stress_db')
+    parser.add_argument('--terminals', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+
+    print("Desks  Operations  Ops/sec  Locked")
+    for desks, operations, rate, locked in stress_test(args.db, args.terminals,
+                                                       args.seconds):
+        print(f"{desks:5}  {operations:10}  {rate:7.0f}  {locked:6}")
@@ -0,0 +1,194 @@
+"""
+Reports over the whole library: every book, every loan or every member.
+
+Reports are read a page at a time using keyset pagination: each page starts
+after the key (ISBN, member id, ...) of the last row of the page before, so
+fetching any page is an index lookup however far into the table it is. Only
+one page is held in memory at once, and the first page is shown as soon as
+it is read, whatever the size of the table.
+
+Each page is read in its own short read transaction, so a long report never
+holds up the writer. Rows changed while a report is running may show either
+their old or new values, but no row is listed twice or skipped.
+
+Functions
+---------
+pages:
+    Reads a report one page at a time.
+print_report:
+    Displays a report in the terminal, a page at a time.
+export:
+    Writes a report to a CSV or JSONL file.
+"""
+
+import argparse
+import csv
+import json
+import operator
+import sys
+
+from library_pool import connect_readonly
+from library_service import LibraryService
+
+
+# Rows per page shown in the terminal, and per page read when exporting.
+PAGE_SIZE = 50
+EXPORT_PAGE_SIZE = 5000
+
+# For each report: the LibraryService method that reads a page, the
+# headings shown in the terminal, the field names used in exported files
+# and a function giving the key of a row to start the next page after.
+REPORTS = {
+    'books': ('all_books',
+              ['ISBN', 'Title', 'Author', 'Stock', 'On Shelf'],
+              ['isbn', 'title', 'author', 'stock', 'on_shelf'],
+              operator.itemgetter(0)),
+    'loans': ('loaned_books',
+              ['ISBN', 'Title', 'Author', 'ID', 'Name', 'Date Borrowed',
+               'Date Due'],
+              ['isbn', 'title', 'author', 'member_id', 'name',
+               'date_checked_out', 'date_due'],
+              operator.itemgetter(0, 3)),
+    'members': ('members',
+                ['ID', 'Name', 'Fines', 'Rewards', 'Borrow Limit'],
+                ['id', 'name', 'fines', 'rewards', 'borrow_limit'],
+                operator.itemgetter(0)),
+}
+
+
+def pages(service, report, page_size=PAGE_SIZE):
+    """Function to read a report one page at a time.
+
+    Parameters
+    ----------
+    service: LibraryService
+        The library to report on.
+    report: str
+        'books', 'loans' or 'members'.
+    page_size: int
+        The most rows in each page.
+
+    Yields
+    ------
+    list
+        The rows of the next page. The last page may be short, empty pages
+        are not yielded."""
+
+    method_name, _, _, key = REPORTS[report]
+    read_page = getattr(service, method_name)
+    after = None
+    while True:
+        page = read_page(after, page_size)
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        after = key(page[-1])
+
+
+def print_report(service, report, page_size=PAGE_SIZE, ask=input):
+    """Function to display a report in the terminal, a page at a time.
+
+    Parameters
+    ----------
+    service: LibraryService
+        The library to report on.
+    report: str
+        'books', 'loans' or 'members'.
+    page_size: int
+        The rows shown before asking whether to carry on.
+    ask: function
+        Called with a prompt between pages. Returning 'Q' stops the report.
+
+    Returns
+    -------
+    int
+        The number of rows shown."""
+
+    from tabulate import tabulate
+
+    headings = REPORTS[report][1]
+    shown = 0
+    for page in pages(service, report, page_size):
+        if shown:
+            if ask("Press Enter for the next page, or Q to stop: "
+                   ).strip().upper() == 'Q':
+                break
+        print(tabulate(page, headers=headings))
+        shown += len(page)
+
+    if not shown:
+        # Show the headings for an empty report, as before:
+        print(tabulate([], headers=headings))
+    return shown
+
+
+def export(service, report, file, file_format='csv',
+           page_size=EXPORT_PAGE_SIZE):
+    """Function to write a report to a file.
+
+    Parameters
+    ----------
+    service: LibraryService
+        The library to report on.
+    report: str
+        'books', 'loans' or 'members'.
+    file: file
+        A text file open for writing (opened with newline='' for CSV).
+    file_format: str
+        'csv' for a header row then one row per line, or 'jsonl' for one
+        JSON object per line.
+    page_size: int
+        The rows read from the database at a time.
+
+    Returns
+    -------
+    int
+        The number of rows written."""
+
+    fields = REPORTS[report][2]
+    if file_format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(fields)
+        write_rows = writer.writerows
+    elif file_format == 'jsonl':
+        def write_rows(rows):
+            file.writelines(json.dumps(dict(zip(fields, row))) + '\n'
+                            for row in rows)
+    else:
+        raise ValueError(f"Unknown file format {file_format}")
+
+    written = 0
+    for page in pages(service, report, page_size):
+        write_rows(page)
+        written += len(page)
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Export a library report as CSV or JSONL.")
+    parser.add_argument('report', choices=sorted(REPORTS))
+    parser.add_argument('--db', default='library_db')
+    parser.add_argument('--output', '-o',
+                        help="file to write (default: standard output)")
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help="default: from the file extension, else csv")
+    args = parser.parse_args()
+
+    file_format = args.format
+    if file_format is None:
+        is_jsonl = args.output and args.output.endswith(('.jsonl', '.json'))
+        file_format = 'jsonl' if is_jsonl else 'csv'
+
+    read_db = connect_readonly(args.db)
+    try:
+        service = LibraryService(read_db, read_db)
+        if args.output:
+            with open(args.output, 'w', newline='', encoding='utf-8') as f:
+                count = export(service, args.report, f, file_format)
+            print(f"{count} rows written to {args.output}")
+        else:
+            export(service, args.report, sys.stdout, file_format)
+    finally:
+        read_db.close()
@@ -0,0 +1,827 @@
+"""
+Schema management for the Library Management System database.
+
+The schema is built up by an ordered list of migrations. The version of a
+database file is tracked with PRAGMA user_version, so an existing
+'library_db' is upgraded in place by applying only the migrations it has
+not seen yet.
+
+Functions
+---------
+connect:
+    Opens a library database, creating or upgrading its tables as needed.
+migrate:
+    Brings a database up to the latest schema version.
+rebuild_counters:
+    Recounts the counters kept by triggers (copies on loan and on hold,
+    holds waiting and members' loans) and repairs any drift.
+add_open_loans:
+    Adds each member's count of books on loan (migration 12).
+sample_statements:
+    Captures the statements the library runs, for check_query_plans.
+check_query_plans:
+    Checks that none of the library's statements fall back to a full table
+    scan.
+"""
+
+import re
+import sqlite3
+import sys
+
+
+# The triggers that count each member's books on loan in users.open_loans
+# (see migration 12), by name. A branch shard has no users table, so its
+# connections make their own TEMP copies of these (see library_branches).
+OPEN_LOANS_TRIGGERS = {
+    'records_open_loans_insert': '''
+        CREATE TRIGGER records_open_loans_insert
+            AFTER INSERT ON records
+            WHEN new.day_in IS NULL
+            BEGIN
+                UPDATE users SET open_loans = open_loans + 1
+                WHERE id = new.user_id;
+            END;''',
+    'records_open_loans_update': '''
+        CREATE TRIGGER records_open_loans_update
+            AFTER UPDATE OF user_id, day_in ON records
+            WHEN (old.day_in IS NULL) IS NOT (new.day_in IS NULL)
+            OR old.user_id IS NOT new.user_id
+            BEGIN
+                UPDATE users SET open_loans = open_loans - 1
+                WHERE id = old.user_id AND old.day_in IS NULL;
+                UPDATE users SET open_loans = open_loans + 1
+                WHERE id = new.user_id AND new.day_in IS NULL;
+            END;''',
+    'records_open_loans_delete': '''
+        CREATE TRIGGER records_open_loans_delete
+            AFTER DELETE ON records
+            WHEN old.day_in IS NULL
+            BEGIN
+                UPDATE users SET open_loans = open_loans - 1
+                WHERE id = old.user_id;
+            END;''',
+}
+
+
+def add_open_loans(cursor):
+    """Function to add users.open_loans, each member's count of books on
+    loan, with the triggers that keep it up to date (migration 12).
+
+    Parameters
+    ----------
+    cursor: sqlite3.Cursor
+        A cursor inside the migration's transaction.
+
+    Notes
+    -----
+        A file without a users table, i.e. a branch shard, is left as it
+        is. A member registry has no loans of its own, so its counts are
+        filled in from the shards (see BranchLibrary)."""
+
+    cursor.execute('''SELECT 1 FROM sqlite_master
+                   WHERE type = 'table' AND name = 'users';''')
+    if cursor.fetchone() is None:
+        return
+
+    cursor.execute('''ALTER TABLE users
+                   ADD COLUMN open_loans INTEGER NOT NULL DEFAULT 0;''')
+    # Each count is read from the records_open_user index:
+    cursor.execute('''
+        UPDATE users SET open_loans = (
+            SELECT COUNT(*) FROM records
+            WHERE user_id = users.id AND day_in IS NULL);''')
+    for trigger in OPEN_LOANS_TRIGGERS.values():
+        cursor.execute(trigger)
+
+
+# Each migration is a list of SQL statements, applied in a single
+# transaction. Migration N (counting from 1) moves user_version to N. A step
+# SQL cannot express is a function, called with the migration's cursor.
+# Never edit a migration once released - add a new one to the end instead.
+MIGRATIONS = [
+    # 1. The original three tables. IF NOT EXISTS lets files created before
+    #    versioning was introduced pick up the version number unchanged.
+    [
+        '''CREATE TABLE IF NOT EXISTS books(
+            isbn INTEGER PRIMARY KEY,
+            title TEXT,
+            author TEXT,
+            stock INTEGER);''',
+        '''CREATE TABLE IF NOT EXISTS users(
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            fines INTEGER,
+            rewards INTEGER,
+            borrow_limit INTEGER);''',
+        '''CREATE TABLE IF NOT EXISTS records(
+            isbn INTEGER,
+            user_id INTEGER,
+            date_checked_out,
+            date_checked_in,
+            returned);''',
+    ],
+    # 2. Indexes for the records table. The two partial indexes only hold
+    #    open loans, so they stay small however long the loan history gets,
+    #    and include 'returned' so the availability counts are covered.
+    [
+        '''CREATE INDEX IF NOT EXISTS records_open_isbn
+            ON records(isbn, user_id, returned)
+            WHERE returned = 'FALSE';''',
+        '''CREATE INDEX IF NOT EXISTS records_open_user
+            ON records(user_id, isbn, returned)
+            WHERE returned = 'FALSE';''',
+        '''CREATE INDEX IF NOT EXISTS records_isbn_user
+            ON records(isbn, user_id);''',
+    ],
+    # 3. Copies on loan are counted in books.on_loan, kept up to date by
+    #    triggers on records, so availability is a primary key lookup.
+    #    books_on_shelf only holds books with at least one copy available.
+    [
+        '''ALTER TABLE books ADD COLUMN on_loan INTEGER NOT NULL DEFAULT 0;''',
+        '''UPDATE books
+            SET on_loan = (
+                SELECT COUNT(*) FROM records
+                WHERE records.isbn = books.isbn AND returned = 'FALSE');''',
+        '''CREATE TRIGGER IF NOT EXISTS records_on_loan_insert
+            AFTER INSERT ON records
+            WHEN new.returned = 'FALSE'
+            BEGIN
+                UPDATE books SET on_loan = on_loan + 1
+                WHERE isbn = new.isbn;
+            END;''',
+        '''CREATE TRIGGER IF NOT EXISTS records_on_loan_update
+            AFTER UPDATE OF isbn, returned ON records
+            WHEN old.returned IS NOT new.returned OR old.isbn IS NOT new.isbn
+            BEGIN
+                UPDATE books SET on_loan = on_loan - 1
+                WHERE isbn = old.isbn AND old.returned = 'FALSE';
+                UPDATE books SET on_loan = on_loan + 1
+                WHERE isbn = new.isbn AND new.returned = 'FALSE';
+            END;''',
+        '''CREATE TRIGGER IF NOT EXISTS records_on_loan_delete
+            AFTER DELETE ON records
+            WHEN old.returned = 'FALSE'
+            BEGIN
+                UPDATE books SET on_loan = on_loan - 1
+                WHERE isbn = old.isbn;
+            END;''',
+        '''CREATE INDEX IF NOT EXISTS books_on_shelf
+            ON books(isbn)
+            WHERE stock > on_loan;''',
+    ],
+    # 4. Full text index over book titles and authors. It is an external
+    #    content table, so the text is not stored twice, and triggers on
+    #    books keep it in step with the catalogue.
+    [
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS books_fts
+            USING fts5(title, author, content='books', content_rowid='isbn');''',
+        '''INSERT INTO books_fts(books_fts) VALUES('rebuild');''',
+        '''CREATE TRIGGER IF NOT EXISTS books_fts_insert
+            AFTER INSERT ON books
+            BEGIN
+                INSERT INTO books_fts(rowid, title, author)
+                VALUES(new.isbn, new.title, new.author);
+            END;''',
+        '''CREATE TRIGGER IF NOT EXISTS books_fts_update
+            AFTER UPDATE OF isbn, title, author ON books
+            BEGIN
+                INSERT INTO books_fts(books_fts, rowid, title, author)
+                VALUES('delete', old.isbn, old.title, old.author);
+                INSERT INTO books_fts(rowid, title, author)
+                VALUES(new.isbn, new.title, new.author);
+            END;''',
+        '''CREATE TRIGGER IF NOT EXISTS books_fts_delete
+            AFTER DELETE ON books
+            BEGIN
+                INSERT INTO books_fts(books_fts, rowid, title, author)
+                VALUES('delete', old.isbn, old.title, old.author);
+            END;''',
+    ],
+    # 5. Sequences for allocating new membership numbers (see library_ids).
+    [
+        '''CREATE TABLE IF NOT EXISTS id_sequences(
+            name TEXT PRIMARY KEY,
+            next_value INTEGER NOT NULL);''',
+    ],
+    # 6. Returned loans are moved out of records into loan_history in
+    #    batches (see library_archive), so records only holds the open loans
+    #    and the rows the archiver has not reached yet. loan_history is only
+    #    ever appended to. all_loans shows both tables as one.
+    [
+        '''CREATE TABLE IF NOT EXISTS loan_history(
+            isbn INTEGER,
+            user_id INTEGER,
+            date_checked_out,
+            date_checked_in);''',
+        '''CREATE INDEX IF NOT EXISTS loan_history_user
+            ON loan_history(user_id, date_checked_out);''',
+        '''CREATE INDEX IF NOT EXISTS loan_history_isbn
+            ON loan_history(isbn, date_checked_out);''',
+        '''CREATE TRIGGER IF NOT EXISTS loan_history_no_update
+            BEFORE UPDATE ON loan_history
+            BEGIN
+                SELECT RAISE(ABORT, 'loan_history is append-only');
+            END;''',
+        '''CREATE TRIGGER IF NOT EXISTS loan_history_no_delete
+            BEFORE DELETE ON loan_history
+            BEGIN
+                SELECT RAISE(ABORT, 'loan_history is append-only');
+            END;''',
+        '''CREATE VIEW IF NOT EXISTS all_loans AS
+            SELECT isbn, user_id, date_checked_out, date_checked_in, returned
+            FROM records
+            UNION ALL
+            SELECT isbn, user_id, date_checked_out, date_checked_in, 'TRUE'
+            FROM loan_history;''',
+    ],
+    # 7. Each loan gets an id, loan_id, so one loan can be returned without
+    #    touching any other. records is rebuilt with loan_id as its INTEGER
+    #    PRIMARY KEY, each existing loan keeping its rowid as its id, so no
+    #    row is changed. AUTOINCREMENT stops the id of a loan moved to
+    #    loan_history from being used again. Loans archived before this
+    #    migration have no id.
+    [
+        '''DROP VIEW IF EXISTS all_loans;''',
+        '''CREATE TABLE records_new(
+            loan_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            isbn INTEGER,
+            user_id INTEGER,
+            date_checked_out,
+            date_checked_in,
+            returned);''',
+        '''INSERT INTO records_new(
+            loan_id, isbn, user_id, date_checked_out, date_checked_in,
+            returned)
+            SELECT rowid, isbn, user_id, date_checked_out, date_checked_in,
+            returned
+            FROM records
+            ORDER BY rowid;''',
+        '''DROP TABLE records;''',
+        '''ALTER TABLE records_new RENAME TO records;''',
+        # The indexes and triggers went with the old table:
+        '''CREATE INDEX records_open_isbn
+            ON records(isbn, user_id, returned)
+            WHERE returned = 'FALSE';''',
+        '''CREATE INDEX records_open_user
+            ON records(user_id, isbn, returned)
+            WHERE returned = 'FALSE';''',
+        '''CREATE INDEX records_isbn_user
+            ON records(isbn, user_id);''',
+        '''CREATE TRIGGER records_on_loan_insert
+            AFTER INSERT ON records
+            WHEN new.returned = 'FALSE'
+            BEGIN
+                UPDATE books SET on_loan = on_loan + 1
+                WHERE isbn = new.isbn;
+            END;''',
+        '''CREATE TRIGGER records_on_loan_update
+            AFTER UPDATE OF isbn, returned ON records
+            WHEN old.returned IS NOT new.returned OR old.isbn IS NOT new.isbn
+            BEGIN
+                UPDATE books SET on_loan = on_loan - 1
+                WHERE isbn = old.isbn AND old.returned = 'FALSE';
+                UPDATE books SET on_loan = on_loan + 1
+                WHERE isbn = new.isbn AND new.returned = 'FALSE';
+            END;''',
+        '''CREATE TRIGGER records_on_loan_delete
+            AFTER DELETE ON records
+            WHEN old.returned = 'FALSE'
+            BEGIN
+                UPDATE books SET on_loan = on_loan - 1
+                WHERE isbn = old.isbn;
+            END;''',
+        # The query planner's statistics for records went with it too:
+        '''ANALYZE records;''',
+        '''ALTER TABLE loan_history ADD COLUMN loan_id INTEGER;''',
+        '''CREATE UNIQUE INDEX loan_history_loan
+            ON loan_history(loan_id);''',
+        '''CREATE VIEW all_loans AS
+            SELECT loan_id, isbn, user_id, date_checked_out, date_checked_in,
+            returned
+            FROM records
+            UNION ALL
+            SELECT loan_id, isbn, user_id, date_checked_out, date_checked_in,
+            'TRUE'
+            FROM loan_history;''',
+    ],
+    # 8. Compact, typed loans. Dates become day numbers (days since
+    #    1970-01-01) rather than text, and the 'TRUE'/'FALSE' returned flag
+    #    goes: a loan is open while its day_in is NULL. Both tables are
+    #    STRICT, so a value of the wrong type is refused rather than
+    #    stored. loan_history takes loan_id as its primary key, loans
+    #    archived before migration 7 being given new ids after every id
+    #    used so far. Run VACUUM afterwards to give back the space freed.
+    [
+        '''DROP VIEW IF EXISTS all_loans;''',
+        '''CREATE TABLE loan_history_new(
+            loan_id INTEGER PRIMARY KEY,
+            isbn INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            day_out INTEGER NOT NULL,
+            day_in INTEGER NOT NULL) STRICT;''',
+        '''INSERT INTO loan_history_new(
+            loan_id, isbn, user_id, day_out, day_in)
+            SELECT
+            COALESCE(loan_id, (
+                SELECT MAX(IFNULL(MAX(loan_id), 0), IFNULL((
+                    SELECT seq FROM sqlite_sequence
+                    WHERE name = 'records'), 0))
+                FROM loan_history) + rowid),
+            isbn, user_id,
+            CAST(julianday(date_checked_out) - 2440587.5 AS INTEGER),
+            CAST(julianday(COALESCE(date_checked_in, date_checked_out))
+                 - 2440587.5 AS INTEGER)
+            FROM loan_history;''',
+        '''DROP TABLE loan_history;''',
+        '''ALTER TABLE loan_history_new RENAME TO loan_history;''',
+        '''CREATE INDEX loan_history_user
+            ON loan_history(user_id, day_out);''',
+        '''CREATE INDEX loan_history_isbn
+            ON loan_history(isbn, day_out);''',
+        '''CREATE TRIGGER loan_history_no_update
+            BEFORE UPDATE ON loan_history
+            BEGIN
+                SELECT RAISE(ABORT, 'loan_history is append-only');
+            END;''',
+        '''CREATE TRIGGER loan_history_no_delete
+            BEFORE DELETE ON loan_history
+            BEGIN
+                SELECT RAISE(ABORT, 'loan_history is append-only');
+            END;''',
+        '''CREATE TABLE records_new(
+            loan_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            isbn INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            day_out INTEGER NOT NULL,
+            day_in INTEGER) STRICT;''',
+        '''INSERT INTO records_new(loan_id, isbn, user_id, day_out, day_in)
+            SELECT loan_id, isbn, user_id,
+            CAST(julianday(date_checked_out) - 2440587.5 AS INTEGER),
+            CASE WHEN returned = 'FALSE' THEN NULL
+            ELSE CAST(julianday(COALESCE(date_checked_in, date_checked_out))
+                      - 2440587.5 AS INTEGER) END
+            FROM records
+            ORDER BY loan_id;''',
+        '''DROP TABLE records;''',
+        '''ALTER TABLE records_new RENAME TO records;''',
+        # Loan ids carry on after the highest one used, archived or not:
+        '''INSERT INTO sqlite_sequence(name, seq)
+            SELECT 'records', 0
+            WHERE NOT EXISTS (
+                SELECT 1 FROM sqlite_sequence WHERE name = 'records');''',
+        '''UPDATE sqlite_sequence
+            SET seq = MAX(seq, IFNULL((SELECT MAX(loan_id) FROM loan_history),
+                                      0))
+            WHERE name = 'records';''',
+        '''CREATE INDEX records_open_isbn
+            ON records(isbn, user_id, day_in)
+            WHERE day_in IS NULL;''',
+        '''CREATE INDEX records_open_user
+            ON records(user_id, isbn, day_in)
+            WHERE day_in IS NULL;''',
+        '''CREATE INDEX records_isbn_user
+            ON records(isbn, user_id);''',
+        '''CREATE TRIGGER records_on_loan_insert
+            AFTER INSERT ON records
+            WHEN new.day_in IS NULL
+            BEGIN
+                UPDATE books SET on_loan = on_loan + 1
+                WHERE isbn = new.isbn;
+            END;''',
+        '''CREATE TRIGGER records_on_loan_update
+            AFTER UPDATE OF isbn, day_in ON records
+            WHEN (old.day_in IS NULL) IS NOT (new.day_in IS NULL)
+            OR old.isbn IS NOT new.isbn
+            BEGIN
+                UPDATE books SET on_loan = on_loan - 1
+                WHERE isbn = old.isbn AND old.day_in IS NULL;
+                UPDATE books SET on_loan = on_loan + 1
+                WHERE isbn = new.isbn AND new.day_in IS NULL;
+            END;''',
+        '''CREATE TRIGGER records_on_loan_delete
+            AFTER DELETE ON records
+            WHEN old.day_in IS NULL
+            BEGIN
+                UPDATE books SET on_loan = on_loan - 1
+                WHERE isbn = old.isbn;
+            END;''',
+        '''ANALYZE records;''',
+        '''ANALYZE loan_history;''',
+        '''CREATE VIEW all_loans AS
+            SELECT loan_id, isbn, user_id, day_out, day_in
+            FROM records
+            UNION ALL
+            SELECT loan_id, isbn, user_id, day_out, day_in
+            FROM loan_history;''',
+    ],
+    # 9. Due dates. Each loan is due back on day_due, set when it is
+    #    borrowed; open loans are given the 21 day loan period of the time
+    #    (LOAN_DAYS in library_service). fined is 1 once the overdue sweep
+    #    (see library_overdue) has fined the member for the loan, so it is
+    #    only fined once. records_overdue holds just the open loans not yet
+    #    fined, in due date order, so the sweep reads only what it fines.
+    [
+        '''DROP VIEW IF EXISTS all_loans;''',
+        '''ALTER TABLE records ADD COLUMN day_due INTEGER;''',
+        '''ALTER TABLE records
+            ADD COLUMN fined INTEGER NOT NULL DEFAULT 0;''',
+        '''UPDATE records SET day_due = day_out + 21;''',
+        '''CREATE INDEX records_overdue
+            ON records(day_due, user_id)
+            WHERE day_in IS NULL AND fined = 0;''',
+        '''ALTER TABLE loan_history ADD COLUMN day_due INTEGER;''',
+        '''CREATE VIEW all_loans AS
+            SELECT loan_id, isbn, user_id, day_out, day_in, day_due
+            FROM records
+            UNION ALL
+            SELECT loan_id, isbn, user_id, day_out, day_in, day_due
+            FROM loan_history;''',
+    ],
+    # 10. Holds. Members queue for a book with every copy out, first come
+    #     first served in hold_id order. A hold is waiting until a copy is
+    #     set aside for the member (day_ready), then ready to collect until
+    #     day_expires. holds_queue holds only the waiting holds, in queue
+    #     order, so the head of a queue is one index lookup however long it
+    #     is. books.holds counts the waiting holds and books.on_hold the
+    #     copies set aside, kept up to date by triggers on holds; a copy is
+    #     on the shelf if stock > on_loan + on_hold.
+    [
+        '''CREATE TABLE holds(
+            hold_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            isbn INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            day_placed INTEGER NOT NULL,
+            day_ready INTEGER,
+            day_expires INTEGER) STRICT;''',
+        '''CREATE INDEX holds_queue
+            ON holds(isbn, hold_id)
+            WHERE day_ready IS NULL;''',
+        '''CREATE UNIQUE INDEX holds_member
+            ON holds(user_id, isbn);''',
+        '''CREATE INDEX holds_expiry
+            ON holds(day_expires)
+            WHERE day_ready IS NOT NULL;''',
+        '''ALTER TABLE books ADD COLUMN on_hold INTEGER NOT NULL DEFAULT 0;''',
+        '''ALTER TABLE books ADD COLUMN holds INTEGER NOT NULL DEFAULT 0;''',
+        '''CREATE TRIGGER holds_count_insert
+            AFTER INSERT ON holds
+            BEGIN
+                UPDATE books
+                SET holds = holds + (new.day_ready IS NULL),
+                    on_hold = on_hold + (new.day_ready IS NOT NULL)
+                WHERE isbn = new.isbn;
+            END;''',
+        '''CREATE TRIGGER holds_count_update
+            AFTER UPDATE OF isbn, day_ready ON holds
+            WHEN (old.day_ready IS NULL) IS NOT (new.day_ready IS NULL)
+            OR old.isbn IS NOT new.isbn
+            BEGIN
+                UPDATE books
+                SET holds = holds - (old.day_ready IS NULL),
+                    on_hold = on_hold - (old.day_ready IS NOT NULL)
+                WHERE isbn = old.isbn;
+                UPDATE books
+                SET holds = holds + (new.day_ready IS NULL),
+                    on_hold = on_hold + (new.day_ready IS NOT NULL)
+                WHERE isbn = new.isbn;
+            END;''',
+        '''CREATE TRIGGER holds_count_delete
+            AFTER DELETE ON holds
+            BEGIN
+                UPDATE books
+                SET holds = holds - (old.day_ready IS NULL),
+                    on_hold = on_hold - (old.day_ready IS NOT NULL)
+                WHERE isbn = old.isbn;
+            END;''',
+        # Copies set aside for a hold are not on the shelf to borrow:
+        '''DROP INDEX books_on_shelf;''',
+        '''CREATE INDEX books_on_shelf
+            ON books(isbn)
+            WHERE stock > on_loan + on_hold;''',
+    ],
+    # 11. The outbox, an event for each change made to the library, written
+    #     in the change's transaction, for other systems to follow (see
+    #     library_outbox). seq is AUTOINCREMENT so that it is never reused,
+    #     even once old events are deleted. at is the time in seconds since
+    #     1970-01-01, and value depends on the kind of event.
+    [
+        '''CREATE TABLE outbox(
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            at INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            isbn INTEGER,
+            user_id INTEGER,
+            loan_id INTEGER,
+            value INTEGER) STRICT;''',
+    ],
+    # 12. Each member's books on loan are counted in users.open_loans, kept
+    #     up to date by triggers on records, so the borrowing limit is
+    #     checked against one column. Members of a library with branches
+    #     borrow from every branch's shard, so this is the only count of
+    #     their loans across the branches (see library_branches).
+    [
+        add_open_loans,
+    ],
+    # 13. Every loan a member has in records, returned or not, for their
+    #     loan history. records_open_user only holds the open loans, and
+    #     loan_history has an index of its own, loan_history_user.
+    [
+        '''CREATE INDEX records_user
+            ON records(user_id);''',
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def connect(path='library_db'):
+    """Function to open a library database.
+
+    Parameters
+    ----------
+    path: str
+        The database file, created if it does not exist.
+
+    Returns
+    -------
+    sqlite3.Connection
+        A connection to the database, migrated to the latest version."""
+
+    db = sqlite3.connect(path)
+    try:
+        migrate(db)
+    except Exception:
+        db.close()
+        raise
+    return db
+
+
+def migrate(db):
+    """Function to bring a database up to the latest schema version.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to the library database.
+
+    Returns
+    -------
+    int
+        The schema version of the database after migrating.
+
+    Notes
+    -----
+        Each migration runs in its own transaction together with the
+        user_version update, so an interrupted upgrade can simply be re-run."""
+
+    cursor = db.cursor()
+    cursor.execute('''PRAGMA user_version;''')
+    version = cursor.fetchone()[0]
+
+    if version == SCHEMA_VERSION:
+        # Already up to date, the usual case
+        return version
+    elif version > SCHEMA_VERSION:
+        raise sqlite3.DatabaseError(
+            f"Database schema version {version} is newer than this "
+            f"program supports ({SCHEMA_VERSION}).")
+
+    for number in range(version + 1, SCHEMA_VERSION + 1):
+        try:
+            cursor.execute('''BEGIN;''')
+            for statement in MIGRATIONS[number - 1]:
+                if callable(statement):
+                    statement(cursor)
+                else:
+                    cursor.execute(statement)
+            # PRAGMA does not accept parameters, number is always an int:
+            cursor.execute('''PRAGMA user_version = %d;''' % number)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    return SCHEMA_VERSION
+
+
+# The counters kept up to date by triggers, as (table, key, column, source,
+# source key, condition): each row's column counts the rows of source with
+# its key that meet the condition.
+COUNTERS = (
+    ('books', 'isbn', 'on_loan', 'records', 'isbn', 'day_in IS NULL'),
+    ('books', 'isbn', 'on_hold', 'holds', 'isbn', 'day_ready IS NOT NULL'),
+    ('books', 'isbn', 'holds', 'holds', 'isbn', 'day_ready IS NULL'),
+    ('users', 'id', 'open_loans', 'records', 'user_id', 'day_in IS NULL'),
+)
+
+
+def rebuild_counters(db, counters=COUNTERS):
+    """Function to recount the counters kept by triggers from the records
+    and holds tables.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to a migrated library database.
+    counters: tuple
+        The counters to recount, from COUNTERS. All of them by default.
+
+    Returns
+    -------
+    list
+        A (counter, key, stored count, actual count) tuple for each row
+        whose counter had drifted, e.g. ('books.on_loan', isbn, 2, 1).
+        These rows have been corrected."""
+
+    cursor = db.cursor()
+    drift = []
+    try:
+        # IMMEDIATE, so no loan or hold changes between the count and the
+        # correction:
+        cursor.execute('''BEGIN IMMEDIATE;''')
+        for table, key, column, source, source_key, condition in counters:
+            # Each source is counted in one pass, then compared with every
+            # row's counter. The names come from COUNTERS, not the caller:
+            cursor.execute('''
+                SELECT t.%s, t.%s, COALESCE(counted.n, 0)
+                FROM %s AS t
+                LEFT JOIN (
+                    SELECT %s AS k, COUNT(*) AS n
+                    FROM %s
+                    WHERE %s
+                    GROUP BY %s) AS counted
+                ON counted.k = t.%s
+                WHERE t.%s IS NOT COALESCE(counted.n, 0);'''
+                           % (key, column, table, source_key, source,
+                              condition, source_key, key, column))
+            found = cursor.fetchall()
+
+            # Overwrite the counters that are wrong:
+            cursor.executemany('''UPDATE %s SET %s = ? WHERE %s = ?;'''
+                               % (table, column, key),
+                               [(actual, row) for row, _, actual in found])
+            drift += [(f"{table}.{column}", row, stored, actual)
+                      for row, stored, actual in found]
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return drift
+
+
+# ------------------------------------------------------------------------
+# Query plan check
+# ------------------------------------------------------------------------
+
+# The statements allowed to scan, by their names in the query statistics
+# (see library_stats), with patterns for the scans (as worded in the query
+# plan after 'SCAN') that they may make.
+ALLOWED_SCANS = {
+    # Full text searches show as a scan of the virtual table, but an index
+    # string containing 'M' means the MATCH is answered by the FTS index:
+    'search_books': (r'books_fts VIRTUAL TABLE INDEX \d+:M.*',),
+    # The overdue loans, found in records_overdue, counted by member:
+    'fine_overdue.members': ('overdue',),
+    # The member's loans, found in both halves of the all_loans view:
+    'loan_history': ('al',),
+}
+
+
+def sample_statements():
+    """Function to capture the statements the desks and the nightly sweeps
+    run.
+
+    Each operation is carried out on a small library in memory with query
+    statistics kept, so the statements checked are the ones the library
+    runs, not copies of them.
+
+    Returns
+    -------
+    dict
+        The (sql, params) of each statement, by its name in the query
+        statistics."""
+
+    # Imported here, as each of them imports this module:
+    from library_holds import expire_holds
+    from library_outbox import read_events
+    from library_overdue import fine_overdue
+    from library_service import LibraryService
+    from library_stats import QueryStats
+
+    db = sqlite3.connect(':memory:')
+    try:
+        migrate(db)
+        stats = QueryStats()
+        library = LibraryService(db, stats=stats)
+        first = library.add_member('Sample Member').data['id']
+        second = library.add_member('Other Member').data['id']
+        one_copy, three_copies = 9780000000001, 9780000000002
+        library.add_book(one_copy, 'The Hobbit', 'J. R. R. Tolkien', 1)
+        library.add_book(three_copies, 'Dune', 'Frank Herbert', 2)
+        library.add_stock(three_copies, 1)
+
+        # Lookups and scans:
+        library.member_exists(first)
+        library.book_exists(one_copy)
+        library.has_loans(first)
+        library.book_stock(one_copy)
+        library.book_record(one_copy)
+        library.member_record(first)
+        library.scan_all_books()
+        library.scan_from_shelf()
+        library.user_id(True)
+
+        # Borrowing, refusals, holds and returns:
+        library.borrow_book(one_copy, first)
+        library.borrow_book(one_copy, second)
+        library.scan_from_user(first)
+        library.loan_holders(one_copy)
+        library.place_hold(one_copy, second)
+        library.place_hold(three_copies, second)
+        library.member_holds(second)
+        # Rewarded, and the copy is set aside for the hold:
+        library.return_book(one_copy, first, True)
+        loan_id = library.borrow_book(three_copies, first).data['loan_id']
+        library.return_loan(loan_id, False)
+        library.pay_fine(first)
+        library.place_hold(one_copy, first)
+        library.cancel_hold(one_copy, first)
+        library.reward(first)
+        library.fine(first)
+        library.pay_fine(first)
+        library.remove_book(three_copies)
+        library.borrow_book(three_copies, first)
+
+        # Searches and reports:
+        library.search_books('title', 'hobbit')
+        library.all_books(limit=10)
+        library.loaned_books(limit=10)
+        library.members(limit=10)
+        library.loan_history(first)
+
+        # The nightly sweeps, far enough ahead for every loan to be
+        # overdue and the set aside copy's hold to have expired:
+        fine_overdue(db, 1000000, stats)
+        expire_holds(db, 1000000, stats)
+        read_events(db, stats=stats)
+        return stats.statements()
+    finally:
+        db.close()
+
+
+def check_query_plans(db, statements=None):
+    """Function to check the library's statements are answered from an
+    index.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to a migrated library database.
+    statements: dict
+        The statements to check, as from sample_statements, which is
+        called if this is None.
+
+    Returns
+    -------
+    list
+        A (statement name, plan line) tuple for each full scan found. The
+        list is empty when every statement uses an index."""
+
+    if statements is None:
+        statements = sample_statements()
+    cursor = db.cursor()
+    problems = []
+
+    for name, (sql, params) in sorted(statements.items()):
+        # BEGIN, PRAGMA and the like have no query plan:
+        if not re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', sql,
+                        re.IGNORECASE):
+            continue
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        for row in cursor.fetchall():
+            # A 'SCAN' line walks a whole table (or a whole index), except
+            # for 'SCAN CONSTANT ROW', which reads no table at all:
+            scan = re.match(r'SCAN (?!CONSTANT ROW$)(.+)', row[3])
+            if scan and not any(re.fullmatch(allowed, scan.group(1))
+                                for allowed in ALLOWED_SCANS.get(name, ())):
+                problems.append((name, row[3]))
+
+    return problems
+
+
+if __name__ == '__main__':
+    # Usage: python library_schema.py [database file]
+    # Upgrades the database, then fails if any hot query does a full scan.
+    db = connect(sys.argv[1] if len(sys.argv) > 1 else 'library_db')
+    try:
+        print(f"Schema version {SCHEMA_VERSION}")
+        statements = sample_statements()
+        full_scans = check_query_plans(db, statements)
+        for query_name, plan_line in full_scans:
+            print(f"Error: {query_name} uses a full scan: {plan_line}")
+        if full_scans:
+            sys.exit(1)
+        print(f"All {len(statements)} statements use an index.")
+    finally:
+        db.close()
@@ -0,0 +1,541 @@
+"""
+A network front-end for the library, for self-service kiosks.
+
+The server speaks a line protocol over TCP: each request is one line of
+JSON, e.g.
+
+    {"id": 1, "op": "borrow", "isbn": 9781234567897, "member_id": 1234}
+
+and each response is one line of JSON carrying the same id, e.g.
+
+    {"id": 1, "ok": true, "status": "borrowed", "message": "...", "data": null}
+
+A kiosk can send several requests without waiting. Each is run as soon as
+it arrives and answered when it finishes, so responses may come back in a
+different order. The blocking SQLite calls run on two sized thread pools:
+changes on the write executor and searches and reports on the read
+executor, so a slow report never holds up a checkout.
+
+Operations
+----------
+borrow: isbn, member_id
+return: isbn and member_id, or loan_id (from the borrow), and on_time
+    (true for a reward, false to issue a fine, default: by the due date)
+pay_fine: member_id
+hold: isbn, member_id (when every copy is out)
+cancel_hold: isbn, member_id
+holds: member_id, the member's holds
+search: search_for, column ('title', 'author' or null for both)
+member: member_id
+loaned: after (from the previous page, default null), limit (at least 1,
+    default and most PAGE_LIMIT) a page of the books out on loan, and the
+    'after' to send for the next page (null after the last page)
+scan: kind ('book', 'shelf', 'member' or 'loan'), member_id for 'loan'
+stats: (no parameters) the query statistics, if the server is timing queries,
+    and the cache hits and misses, if it has a cache
+
+Classes
+-------
+LibraryServer:
+    Serves library operations to kiosks over TCP.
+KioskClient:
+    A connection to the server that can have many requests in flight.
+
+Functions
+---------
+run_load:
+    Simulates many kiosks using the server and reports the throughput.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import random as rd
+import time
+
+from library_cache import LibraryCache
+from library_pool import LibraryPools
+from library_stats import SLOW_MS, QueryStats, percentiles
+from library_transactions import PROFILES
+
+
+# The longest line, in bytes, either end will read.
+LINE_LIMIT = 2 ** 24
+
+# The most rows sent in one page of a report.
+PAGE_LIMIT = 500
+
+
+# ------------------------------------------------------------------------
+# Operations
+# ------------------------------------------------------------------------
+
+def _borrow(library, request):
+    """Function to borrow a book for a kiosk request."""
+
+    return library.borrow_book(int(request['isbn']),
+                               int(request['member_id']))._asdict()
+
+
+def _return(library, request):
+    """Function to return a book for a kiosk request, then give a reward,
+    or a fine if it was late."""
+
+    on_time = request.get('on_time')
+    # Only a JSON true or false, as e.g. the string "false" would be true:
+    if on_time is not None and not isinstance(on_time, bool):
+        return {'ok': False, 'status': 'bad_request',
+                'message': "Error: on_time must be true, false or null"}
+    if request.get('loan_id') is not None:
+        outcome = library.return_loan(int(request['loan_id']), on_time)
+    else:
+        outcome = library.return_book(int(request['isbn']),
+                                      int(request['member_id']), on_time)
+    if not outcome.ok:
+        return outcome._asdict()
+    after = outcome.data['after']
+    return dict(outcome._asdict(),
+                data=dict(outcome.data,
+                          after=after._asdict() if after else None))
+
+
+def _pay_fine(library, request):
+    """Function to pay a member's fines for a kiosk request."""
+
+    return library.pay_fine(int(request['member_id']))._asdict()
+
+
+def _hold(library, request):
+    """Function to put a member in the queue for a book for a kiosk
+    request."""
+
+    return library.place_hold(int(request['isbn']),
+                              int(request['member_id']))._asdict()
+
+
+def _cancel_hold(library, request):
+    """Function to cancel a member's hold for a kiosk request."""
+
+    return library.cancel_hold(int(request['isbn']),
+                               int(request['member_id']))._asdict()
+
+
+def _holds(library, request):
+    """Function to list a member's holds for a kiosk request."""
+
+    holds = library.member_holds(int(request['member_id']))
+    return {'ok': True, 'status': 'found', 'data': holds}
+
+
+def _search(library, request):
+    """Function to search the catalogue for a kiosk request."""
+
+    limit = int(request.get('limit', 50))
+    if limit < 1:
+        return {'ok': False, 'status': 'bad_request',
+                'message': "Error: limit must be at least 1"}
+    books = library.search_books(request.get('column'),
+                                 str(request.get('search_for', '')), limit)
+    return {'ok': True, 'status': 'found', 'data': books}
+
+
+def _member(library, request):
+    """Function to look up a member for a kiosk request."""
+
+    record = library.member_record(int(request['member_id']))
+    if record is None:
+        return {'ok': False, 'status': 'no_member',
+                'message': "Error: ID not found."}
+    names = ('id', 'name', 'fines', 'rewards', 'borrow_limit', 'on_loan')
+    return {'ok': True, 'status': 'found', 'data': dict(zip(names, record))}
+
+
+def _loaned(library, request):
+    """Function to list a page of the books out on loan for a kiosk
+    request."""
+
+    after = request.get('after')
+    limit = int(request.get('limit', PAGE_LIMIT))
+    # An empty page would also look like a full one:
+    if limit < 1:
+        return {'ok': False, 'status': 'bad_request',
+                'message': "Error: limit must be at least 1"}
+    limit = min(limit, PAGE_LIMIT)
+    loans = library.loaned_books(tuple(after) if after else None, limit)
+    # The key to ask for the next page with, or None after the last page:
+    after = [loans[-1][0], loans[-1][3]] if len(loans) == limit else None
+    return {'ok': True, 'status': 'found', 'data': loans, 'after': after}
+
+
+def _scan(library, request):
+    """Function to 'scan' a random book or card for a kiosk request."""
+
+    kind = request.get('kind')
+    if kind == 'book':
+        value = library.scan_all_books()
+    elif kind == 'shelf':
+        value = library.scan_from_shelf()
+    elif kind == 'member':
+        value = library.user_id(True)
+    elif kind == 'loan':
+        value = library.scan_from_user(int(request['member_id']))
+    else:
+        return {'ok': False, 'status': 'bad_request',
+                'message': f"Error: Cannot scan {kind}"}
+    if value is None:
+        return {'ok': False, 'status': 'nothing_to_scan', 'data': None,
+                'message': f"Error: There is no {kind} to scan."}
+    return {'ok': True, 'status': 'scanned', 'data': value}
+
+
+def _stats(library, request):
+    """Function to report the query statistics for a kiosk request."""
+
+    if library.stats is None and library.cache is None:
+        return {'ok': False, 'status': 'stats_off',
+                'message': "Error: The server is not timing queries."}
+    data = {} if library.stats is None else library.stats.summary()
+    if library.cache is not None:
+        data['cache'] = library.cache.summary()
+    return {'ok': True, 'status': 'found', 'data': data}
+
+
+# Each operation, with True if it changes the database (and so runs on the
+# write executor) or False if it only reads.
+OPERATIONS = {
+    'borrow': (_borrow, True),
+    'return': (_return, True),
+    'pay_fine': (_pay_fine, True),
+    'hold': (_hold, True),
+    'cancel_hold': (_cancel_hold, True),
+    'holds': (_holds, False),
+    'search': (_search, False),
+    'member': (_member, False),
+    'loaned': (_loaned, False),
+    'scan': (_scan, False),
+    'stats': (_stats, False),
+}
+
+
+class LibraryServer:
+    """Serves library operations to kiosks over TCP.
+
+    Parameters
+    ----------
+    path: str
+        The library database file.
+    writers: int
+        Threads (and write connections) for operations that change the
+        database. SQLite allows one writer at a time, so a small number
+        is enough.
+    readers: int
+        Threads (and read-only connections) for searches and reports.
+    max_in_flight: int
+        The most requests from one connection being worked on at once.
+        Reading from that connection pauses when it is reached.
+    stats: QueryStats
+        Times every statement the server runs (see library_stats), or None
+        to not time them.
+    durability: str
+        A durability profile (see library_transactions), or None for the
+        default. With 'group', changes from the write threads share
+        commits, so it pays to have more writers than the default.
+    cache: LibraryCache
+        Keeps book and member rows for repeat lookups (see library_cache),
+        or None to not keep them. Only use one if the server is the only
+        program changing the database."""
+
+    def __init__(self, path='library_db', writers=2, readers=8,
+                 max_in_flight=64, stats=None, durability=None, cache=None):
+        # Write operations also use a read connection (see LibraryPools):
+        self.pools = LibraryPools(path, writers=writers,
+                                  readers=readers + writers, stats=stats,
+                                  durability=durability, cache=cache)
+        self.write_executor = concurrent.futures.ThreadPoolExecutor(
+            writers, thread_name_prefix='library-write')
+        self.read_executor = concurrent.futures.ThreadPoolExecutor(
+            readers, thread_name_prefix='library-read')
+        self.max_in_flight = max_in_flight
+
+    def _run(self, operation, writes, request):
+        """Method run on an executor thread to carry out one request."""
+
+        if writes:
+            with self.pools.service() as library:
+                return operation(library, request)
+        with self.pools.reader() as library:
+            return operation(library, request)
+
+    async def _answer(self, request, writer, limit):
+        """Method to carry out one request and write its response."""
+
+        try:
+            operation, writes = OPERATIONS[request.get('op')]
+            executor = self.write_executor if writes else self.read_executor
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(
+                executor, self._run, operation, writes, request)
+        except KeyError as e:
+            response = {'ok': False, 'status': 'bad_request',
+                        'message': f"Error: Missing or unknown {e}"}
+        except Exception as e:
+            response = {'ok': False, 'status': 'error',
+                        'message': f"Error: {e}"}
+        finally:
+            limit.release()
+
+        response['id'] = request.get('id')
+        writer.write(json.dumps(response).encode() + b'\n')
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        """Method to serve one kiosk connection until it closes."""
+
+        limit = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError
+                except ValueError:
+                    writer.write(b'{"ok": false, "status": "bad_request", '
+                                 b'"message": "Error: Invalid JSON"}\n')
+                    continue
+
+                # Start the request and go straight on to the next line:
+                await limit.acquire()
+                task = asyncio.create_task(self._answer(request, writer, limit))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            if tasks:
+                await asyncio.wait(tasks)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        """Method to accept kiosk connections until cancelled.
+
+        Parameters
+        ----------
+        host: str
+            The address to listen on.
+        port: int
+            The port to listen on."""
+
+        server = await asyncio.start_server(self.handle, host, port,
+                                            limit=LINE_LIMIT)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        """Method to stop the executors and close the connections."""
+
+        self.write_executor.shutdown()
+        self.read_executor.shutdown()
+        self.pools.close()
+
+
+# ------------------------------------------------------------------------
+# Load client
+# ------------------------------------------------------------------------
+
+class KioskClient:
+    """A connection to the library server that can have many requests in
+    flight at once. Responses are matched to requests by their id."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.waiting = {}
+        self.next_id = 0
+        self.listener = asyncio.create_task(self._listen())
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=8765):
+        """Method to open a connection to the server.
+
+        Returns
+        -------
+        KioskClient
+            The connected client."""
+
+        # Reports can be much longer than asyncio's default 64KB line limit:
+        reader, writer = await asyncio.open_connection(host, port,
+                                                       limit=LINE_LIMIT)
+        return cls(reader, writer)
+
+    async def _listen(self):
+        """Method to hand each response to the request waiting for it."""
+
+        try:
+            while line := await self.reader.readline():
+                response = json.loads(line)
+                future = self.waiting.pop(response.get('id'), None)
+                if future is not None:
+                    future.set_result(response)
+            error = ConnectionError("Connection closed by the server")
+        except Exception as e:
+            error = e
+
+        # Nothing more will arrive, so fail any requests still waiting:
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_exception(error)
+        self.waiting.clear()
+
+    async def request(self, op, **params):
+        """Method to send a request and wait for its response.
+
+        Parameters
+        ----------
+        op: str
+            The operation, e.g. 'borrow'.
+        params
+            The operation's parameters, e.g. isbn=..., member_id=...
+
+        Returns
+        -------
+        dict
+            The server's response."""
+
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[self.next_id] = future
+        params.update(id=self.next_id, op=op)
+        self.writer.write(json.dumps(params).encode() + b'\n')
+        await self.writer.drain()
+        return await future
+
+    async def close(self):
+        """Method to close the connection."""
+
+        self.writer.close()
+        self.listener.cancel()
+
+
+async def _kiosk(client, requests, latencies):
+    """Function to act as one kiosk: a member scans their card, then
+    searches, borrows, returns and pays fines."""
+
+    member = (await client.request('scan', kind='member'))['data']
+    for _ in range(requests):
+        choice = rd.random()
+        start = time.perf_counter()
+        if choice < 0.5:
+            op = 'search'
+            await client.request(op, search_for=str(rd.randrange(10000)),
+                                 column='title')
+        elif choice < 0.75:
+            op = 'borrow'
+            isbn = (await client.request('scan', kind='shelf')).get('data')
+            response = await client.request(op, isbn=isbn, member_id=member)
+            if response['status'] == 'has_fines':
+                await client.request('pay_fine', member_id=member)
+        elif choice < 0.98:
+            op = 'return'
+            isbn = (await client.request('scan', kind='loan',
+                                         member_id=member)).get('data')
+            if isbn is not None:
+                await client.request(op, isbn=isbn, member_id=member,
+                                     on_time=rd.random() < 0.9)
+        else:
+            op = 'loaned'
+            await client.request(op)
+        latencies.setdefault(op, []).append(time.perf_counter() - start)
+
+
+async def run_load(host='127.0.0.1', port=8765, kiosks=100, connections=10,
+                   requests=50):
+    """Function to simulate many kiosks using the server at once.
+
+    Parameters
+    ----------
+    host: str
+        The server address.
+    port: int
+        The server port.
+    kiosks: int
+        The number of kiosks, each a member working through requests one
+        after another.
+    connections: int
+        The number of connections the kiosks share, so each connection
+        has several requests in flight.
+    requests: int
+        The number of operations each kiosk carries out.
+
+    Returns
+    -------
+    dict
+        The operations per second, and the latency percentiles of each
+        type of operation."""
+
+    clients = [await KioskClient.connect(host, port)
+               for _ in range(connections)]
+    latencies = {}
+    start = time.perf_counter()
+    await asyncio.gather(*(_kiosk(clients[i % connections], requests, latencies)
+                           for i in range(kiosks)))
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        await client.close()
+
+    total = sum(len(samples) for samples in latencies.values())
+    return {'operations': total, 'seconds': elapsed,
+            'ops_per_sec': total / elapsed,
+            'latency': {op: percentiles(samples)
+                        for op, samples in sorted(latencies.items())}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Serve the library to kiosks, or load test a server.")
+    parser.add_argument('mode', choices=['serve', 'load'])
+    parser.add_argument('--db', default='library_db')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--kiosks', type=int, default=100)
+    parser.add_argument('--connections', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--query-stats', action='store_true',
+                        help="time every SQL statement")
+    parser.add_argument('--slow-ms', type=float, default=SLOW_MS)
+    parser.add_argument('--slow-log',
+                        help="file to append slow queries to")
+    parser.add_argument('--durability', choices=sorted(PROFILES),
+                        help="commit profile (default: normal); use more "
+                             "--writers with group")
+    parser.add_argument('--cache', type=int, default=0, metavar='ROWS',
+                        help="cache this many books and members (only if "
+                             "nothing else writes to the database)")
+    args = parser.parse_args()
+
+    if args.mode == 'serve':
+        stats = None
+        if args.query_stats:
+            stats = QueryStats(args.slow_ms, args.slow_log)
+        cache = None
+        if args.cache:
+            cache = LibraryCache(args.cache, args.cache)
+        library_server = LibraryServer(args.db, args.writers, args.readers,
+                                       stats=stats,
+                                       durability=args.durability,
+                                       cache=cache)
+        print(f"Serving the library on {args.host}:{args.port}")
+        try:
+            asyncio.run(library_server.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            library_server.close()
+    else:
+        print(json.dumps(asyncio.run(run_load(
+            args.host, args.port, args.kiosks, args.connections,
+            args.requests)), indent=2))
@@ -0,0 +1,1504 @@
+"""
+The Library Management System as an importable service.
+
+LibraryService holds the library's rules for borrowing, returning, fines and
+rewards. It works on a connection passed in by the caller and returns results
+rather than printing them, so the same rules serve the interactive menu in
+LibrarySystem2.py, scripts and anything else that embeds the library.
+
+Classes
+-------
+Outcome:
+    The result of an operation that changes the database.
+LibraryService:
+    The library's operations on one database connection.
+
+Functions
+---------
+valid_isbn:
+    Returns an ISBN as an int if it is a valid 13 digit ISBN.
+allocate_hold:
+    Sets a copy of a book on the shelf aside for the first hold in its
+    queue.
+"""
+
+import collections
+import contextlib
+import random as rd
+import re
+
+from library_cache import MISSING
+from library_ids import IdAllocator, IdSpaceExhausted
+from library_schema import rebuild_counters
+from library_stats import execute
+
+
+# ok is True when the operation went ahead. status is a short code for the
+# result (e.g. 'borrowed', 'no_stock'), message is ready to show to the user
+# and data holds any values the caller might need (e.g. a new member ID).
+Outcome = collections.namedtuple('Outcome', ['ok', 'status', 'message', 'data'],
+                                 defaults=[None])
+
+# Days a book may be borrowed for before it is overdue.
+LOAN_DAYS = 21
+
+# Days a copy set aside for a hold waits to be collected.
+PICKUP_DAYS = 7
+
+
+def valid_isbn(isbn):
+    """Function to check an ISBN is a 13 digit number.
+
+    Parameters
+    ----------
+    isbn
+        The ISBN to check (int or str).
+
+    Returns
+    -------
+    int
+        The ISBN, or None if it is not a 13 digit number."""
+
+    try:
+        isbn = int(isbn)
+    except (TypeError, ValueError):
+        return None
+    if isbn > 0 and len(str(isbn)) == 13:
+        return isbn
+    return None
+
+
+def allocate_hold(cursor, ISBN, day=None, stats=None, label='allocate_hold'):
+    """Function to set a copy of a book on the shelf aside for the first
+    hold in its queue, inside the caller's write transaction. Every copy
+    set aside (see LibraryService, library_holds and library_import) goes
+    through this one statement.
+
+    Members with unpaid fines keep their place in the queue, but are
+    passed over until they have paid (see LibraryService.pay_fine).
+
+    Parameters
+    ----------
+    cursor: sqlite3.Cursor
+        A cursor of the connection in the transaction.
+    ISBN: int
+        The ISBN of the book.
+    day: int
+        The day number (days since 1970-01-01) the copy is set aside on.
+        None for today.
+    stats: QueryStats
+        To time the statement under label (see library_stats), or None.
+    label: str
+        The name to time the statement under.
+
+    Returns
+    -------
+    int
+        The id of the member the copy is for, or None if there is no copy
+        on the shelf or no hold to give it to."""
+
+    # The head of the queue is the first entry for the book in the
+    # holds_queue index, so this is as quick for a queue of thousands as
+    # for one:
+    execute(cursor, stats, label, '''
+        UPDATE holds
+        SET day_ready = COALESCE(?1, CAST(julianday('now') - 2440587.5
+                                          AS INTEGER)),
+            day_expires = COALESCE(?1, CAST(julianday('now') - 2440587.5
+                                            AS INTEGER)) + ?2
+        WHERE hold_id = (
+            SELECT h.hold_id FROM holds AS h, users AS u
+            WHERE h.isbn = ?3 AND h.day_ready IS NULL
+            AND u.id = h.user_id AND u.fines <= 0
+            ORDER BY h.hold_id LIMIT 1)
+        AND (SELECT stock > on_loan + on_hold FROM books WHERE isbn = ?3)
+        RETURNING user_id;''', (day, PICKUP_DAYS, ISBN))
+    allocated = cursor.fetchone()
+    return None if allocated is None else allocated[0]
+
+
+class LibraryService:
+    """The library's operations on one database connection.
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The connection to a migrated library database (see
+        library_schema.connect). The service does not close it.
+    read_db: sqlite3.Connection
+        An optional second connection, e.g. a read-only one (see
+        library_pool), used for searches and reports so they do not hold
+        up borrowing and returning on db.
+    ids: IdAllocator
+        Hands out new membership numbers. The default gives 4 digit
+        numbers with no check digit (see library_ids).
+    stats: QueryStats
+        Times every statement under a name for the operation, e.g.
+        'borrow_book.insert' (see library_stats). None, the default, runs
+        statements without timing them.
+    transactions: TransactionManager
+        Shared with other services to group their commits, for a
+        durability profile (see library_transactions). db must be its
+        connection. None, the default, commits each change on its own.
+    cache: LibraryCache
+        Keeps book and member rows for repeat lookups, and can be shared
+        with other services (see library_cache). None, the default, reads
+        them from the database every time."""
+
+    def __init__(self, db, read_db=None, ids=None, stats=None,
+                 transactions=None, cache=None):
+        self.db = db
+        self.cursor = db.cursor()
+        self.read_cursor = (read_db or db).cursor()
+        self.ids = ids or IdAllocator(db)
+        self.stats = stats
+        self.transactions = transactions
+        self.cache = cache
+        # The cached rows changed by the open transaction, if any:
+        self._in_transaction = False
+        self._changed = []
+
+    def _execute(self, label, sql, params=()):
+        """Method to run a statement on db, timed under label when
+        query statistics are being kept."""
+
+        if self.stats is None:
+            return self.cursor.execute(sql, params)
+        return self.stats.execute(self.cursor, label, sql, params)
+
+    def _read(self, label, sql, params=()):
+        """Method to run a query on the read connection, timed under label
+        when query statistics are being kept."""
+
+        if self.stats is None:
+            return self.read_cursor.execute(sql, params)
+        return self.stats.execute(self.read_cursor, label, sql, params)
+
+    def _lookup(self, label, sql, params=()):
+        """Method to run a query that only reads, returning the cursor to
+        fetch from. Inside a transaction it runs on db, to see the
+        transaction's own changes. Otherwise it runs on read_db, never on a
+        connection other desks may have uncommitted changes on (e.g. one
+        shared by a TransactionManager)."""
+
+        if self._in_transaction:
+            self._execute(label, sql, params)
+            return self.cursor
+        self._read(label, sql, params)
+        return self.read_cursor
+
+    # --------------------------------------------------------------------
+    # Lookups
+    # --------------------------------------------------------------------
+
+    def _cached(self, kind, key, label, sql):
+        """Method to get a book or member row, from the cache if there is
+        one and it has the row. Rows are always read from the database
+        inside a transaction, so that checks see the transaction's own
+        changes."""
+
+        if self._in_transaction or self.cache is None:
+            return self._lookup(label, sql, (key,)).fetchone()
+
+        if self.cache.other_writers:
+            self._read('data_version', '''PRAGMA data_version;''')
+            self.cache.check_data_version(self.read_cursor.fetchone()[0])
+        generation = self.cache.generation
+        row = self.cache.get(kind, key)
+        if row is MISSING:
+            self._read(label, sql, (key,))
+            row = self.read_cursor.fetchone()
+            self.cache.put(kind, key, row, generation)
+        return row
+
+    def _book(self, ISBN):
+        """Method to get a book's (isbn, title, author, stock, on loan, on
+        hold, holds waiting) row, or None if it is not in the library."""
+
+        return self._cached('book', ISBN, 'book_record', '''
+                    SELECT isbn, title, author, stock, on_loan, on_hold, holds
+                    FROM books
+                    WHERE isbn = ?;''')
+
+    def _member(self, member_id):
+        """Method to get a member's (id, name, fines, rewards, borrow limit,
+        books on loan) row, or None if they are not a member."""
+
+        return self._cached('member', member_id, 'member_record', '''
+                    SELECT u.id, u.name, u.fines, u.rewards, u.borrow_limit,
+                    u.open_loans
+                    FROM users AS u
+                    WHERE u.id = ?;''')
+
+    def _change(self, kind, key):
+        """Method to note that a book or member row is being changed, so
+        that it is removed from the cache when the transaction ends."""
+
+        if self.cache is not None:
+            self._changed.append((kind, key))
+
+    def _event(self, kind, ISBN=None, member_id=None, loan_id=None,
+               value=None):
+        """Method to add an event for a change to the outbox, inside the
+        change's transaction (see library_outbox for the kinds of event)."""
+
+        self._execute('outbox.insert', '''
+                    INSERT INTO outbox(at, kind, isbn, user_id, loan_id, value)
+                    VALUES(CAST((julianday('now') - 2440587.5) * 86400
+                                AS INTEGER), ?, ?, ?, ?, ?);''',
+                      (kind, ISBN, member_id, loan_id, value))
+
+    def member_exists(self, member_id):
+        """Method to check a member id is in the database.
+
+        Parameters
+        ----------
+        member_id: int
+            The id to look for.
+
+        Returns
+        -------
+        bool
+            True if the member exists."""
+
+        return self._member(member_id) is not None
+
+    def book_exists(self, ISBN):
+        """Method to check an ISBN is in the database.
+
+        Parameters
+        ----------
+        ISBN: int
+            The ISBN to look for.
+
+        Returns
+        -------
+        bool
+            True if the book is in the library."""
+
+        return self._book(ISBN) is not None
+
+    def has_loans(self, member_id):
+        """Method to check if a member has any books on loan.
+
+        Parameters
+        ----------
+        member_id: int
+            The id of the member.
+
+        Returns
+        -------
+        bool
+            True if the member has at least one book on loan."""
+
+        cursor = self._lookup('has_loans', '''SELECT * FROM records
+                              WHERE user_id = ?
+                              AND day_in IS NULL;''', (member_id,))
+        return cursor.fetchone() is not None
+
+    def book_stock(self, ISBN):
+        """Method to get the number of copies of a book the library owns.
+
+        Parameters
+        ----------
+        ISBN: int
+            The ISBN of the book.
+
+        Returns
+        -------
+        int
+            The stock of the book, or None if it is not in the library."""
+
+        book = self._book(ISBN)
+        return book[3] if book else None
+
+    def loan_holders(self, ISBN):
+        """Method to list the members who have a book on loan.
+
+        Parameters
+        ----------
+        ISBN: int
+            The ISBN of the book.
+
+        Returns
+        -------
+        list
+            The ids of the members with a copy on loan."""
+
+        cursor = self._lookup('loan_holders', '''
+                SELECT user_id from records
+                WHERE isbn = ? AND day_in IS NULL;''', (ISBN,))
+        return [row[0] for row in cursor.fetchall()]
+
+    # --------------------------------------------------------------------
+    # 'Scan' feature
+    # --------------------------------------------------------------------
+
+    def _probe(self, label, table, key, where='1'):
+        """Method to pick a random key from a table without reading it all.
+
+        A random value between the lowest and highest matching keys is
+        chosen, and the first matching key at or after it is returned. Each
+        step is a single index lookup, so the cost does not grow with the
+        size of the table.
+
+        Parameters
+        ----------
+        label: str
+            The name the queries are timed under (see library_stats).
+        table: str
+            The table to pick from, optionally with an INDEXED BY clause.
+        key: str
+            The indexed column to pick from.
+        where: str
+            A condition the row must meet.
+
+        Returns
+        -------
+        int
+            A random key, or None if no rows match.
+
+        Notes
+        -----
+            Keys just after a large gap in the numbering are picked more
+            often than others. That is fine for the 'scan' feature, which
+            only needs something plausible at the desk."""
+
+        # Each MIN / MAX is a lookup at one end of the index:
+        cursor = self._lookup(label + '.bounds', f'''
+            SELECT (SELECT MIN({key}) FROM {table} WHERE {where}),
+                   (SELECT MAX({key}) FROM {table} WHERE {where});''')
+        low, high = cursor.fetchone()
+        if low is None:
+            return None
+
+        cursor = self._lookup(label, f'''
+            SELECT {key} FROM {table}
+            WHERE {where} AND {key} >= ?
+            ORDER BY {key} LIMIT 1;''', (rd.randint(low, high),))
+        row = cursor.fetchone()
+        # Rows after the one picked may have gone since the bounds were read:
+        return None if row is None else row[0]
+
+    def scan_all_books(self, member_id=None):
+        """Method to return a random ISBN from the library collection.
+
+        Parameters
+        ----------
+        member_id
+            Not required for this method (see LibrarySystem2.get_book).
+
+        Returns
+        -------
+        int
+            A valid ISBN from the database, or None if there are no books."""
+
+        return self._probe('scan_all_books', 'books', 'isbn')
+
+    def scan_from_shelf(self, member_id=None):
+        """Method to return a random ISBN from the library collection,
+        but only from copies that are not out on loan or on hold.
+
+        Parameters
+        ----------
+        member_id
+            Not required for this method (see LibrarySystem2.get_book).
+
+        Returns
+        -------
+        int
+            A valid ISBN from books held in the database that are on the
+            shelf, or None if every copy is on loan or on hold."""
+
+        # books_on_shelf only holds books with a copy available:
+        return self._probe('scan_from_shelf',
+                           'books INDEXED BY books_on_shelf', 'isbn',
+                           'stock > on_loan + on_hold')
+
+    def scan_from_user(self, member_id):
+        """Method to return a random ISBN from the books taken out by a user.
+
+        Parameters
+        ----------
+        member_id: int
+            The ID of the member.
+
+        Returns
+        -------
+        int
+            A valid ISBN from the books the member has on loan, or None if
+            they have none."""
+
+        # A member has at most a handful of loans, so count them and
+        # pick one by its position in the records_open_user index:
+        cursor = self._lookup('scan_from_user.count', '''
+                      SELECT COUNT(*) FROM records
+                      WHERE user_id = ? AND day_in IS NULL;''',
+                              (member_id,))
+        on_loan = cursor.fetchone()[0]
+        if on_loan == 0:
+            return None
+
+        cursor = self._lookup('scan_from_user', '''SELECT isbn FROM records
+                      WHERE user_id = ? AND day_in IS NULL
+                      LIMIT 1 OFFSET ?;''',
+                              (member_id, rd.randrange(on_loan)))
+        row = cursor.fetchone()
+        # Another desk may have taken a loan back since it was counted:
+        return None if row is None else row[0]
+
+    def user_id(self, exists):
+        """Method to return a new id or a random existing id.
+
+        Parameters
+        ----------
+        exists: bool
+            True if an existing id is required.
+
+        Returns
+        -------
+        int
+            A new id from the membership number sequence if exists=False,
+            a random id from database if exists=True (None if there are
+            no members).
+
+        Raises
+        ------
+        IdSpaceExhausted
+            If a new id is needed and every number has been used."""
+
+        if exists:
+            # Select from the existing ids:
+            return self._probe('user_id', 'users', 'id')
+
+        # Takes the next free number (see library_ids):
+        return self.ids.allocate()
+
+    # --------------------------------------------------------------------
+    # Circulation
+    # --------------------------------------------------------------------
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Method to run a change as one write transaction.
+
+        BEGIN IMMEDIATE takes the write lock before anything is read, so the
+        checks and the changes made inside the with block cannot be
+        interleaved with another desk's. The transaction is committed once
+        at the end, or rolled back if the block raises an exception.
+
+        With a TransactionManager, the change is made as part of a group
+        of changes sharing one commit instead.
+
+        Cached rows changed by the block are removed from the cache once
+        the transaction has ended, or with a TransactionManager once the
+        group holding the change has been committed."""
+
+        self._in_transaction = True
+        try:
+            if self.transactions is not None:
+                with self.transactions.transaction():
+                    yield
+                    # The group may only be committed after this returns
+                    # (see TransactionManager.after_commit):
+                    changed, self._changed = self._changed, []
+                    if changed:
+                        self.transactions.after_commit(
+                            lambda: self._invalidate(changed))
+                return
+
+            self._begin()
+            try:
+                yield
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+        finally:
+            self._in_transaction = False
+            # Removed only now, when other connections can see the change,
+            # so the old row cannot be read back into the cache:
+            self._invalidate(self._changed)
+            self._changed = []
+
+    def _invalidate(self, changed):
+        """Method to remove changed (kind, key) rows from the cache."""
+
+        for kind, key in changed:
+            self.cache.invalidate(kind, key)
+
+    def _begin(self):
+        """Method to start the write transaction for _transaction."""
+
+        self._execute('begin', '''BEGIN IMMEDIATE;''')
+
+    def _return_loan(self, ISBN, member_id):
+        """Method to mark a loan as returned, inside a transaction.
+
+        Returns
+        -------
+        tuple
+            The loan id, whether it is back by its due date and whether the
+            overdue sweep has fined for it, or None if the member does not
+            have the book on loan."""
+
+        # The open loan is found in the records_open_isbn index, then only
+        # that one row is updated:
+        self._execute('return_book.update', '''
+                    UPDATE records
+                    SET day_in = CAST(julianday('now') - 2440587.5 AS INTEGER)
+                    WHERE loan_id = (
+                        SELECT loan_id FROM records
+                        WHERE isbn = ? AND user_id = ? AND day_in IS NULL
+                        LIMIT 1)
+                    RETURNING loan_id, day_in <= day_due, fined;''',
+                      (ISBN, member_id))
+        returned = self.cursor.fetchone()
+        if returned is None:
+            return None
+        self._change('book', ISBN)
+        self._change('member', member_id)
+        self._event('return_book', ISBN, member_id, returned[0])
+        return returned
+
+    def _allocate(self, ISBN):
+        """Method to set a copy of a book on the shelf aside for the first
+        hold in its queue, inside a transaction (see allocate_hold).
+
+        Returns
+        -------
+        int
+            The id of the member the copy is for, or None if there is no
+            copy on the shelf or no hold to give it to."""
+
+        member_id = allocate_hold(self.cursor, ISBN, stats=self.stats)
+        if member_id is not None:
+            self._change('book', ISBN)
+        return member_id
+
+    def _after_return(self, member_id, on_time, due_on_time, fined):
+        """Method to reward or fine a member for a return, inside the
+        return's transaction. See return_book."""
+
+        if on_time is None:
+            on_time = due_on_time
+        if on_time:
+            return self._reward(member_id)
+        if fined:
+            # The overdue sweep has already fined for this loan, whether
+            # the desk judged the return late or it was past its due date:
+            return None
+        return self._fine(member_id)
+
+    def _reward(self, member_id):
+        """Method to give a member a reward point, inside a transaction.
+        See reward."""
+
+        # Every 10th reward raises the borrowing limit, until it is 6, and
+        # resets the rewards:
+        self._execute('reward', '''
+                UPDATE users
+                SET rewards = CASE WHEN rewards >= 9 AND borrow_limit < 6
+                              THEN 0 ELSE rewards + 1 END,
+                    borrow_limit = CASE WHEN rewards >= 9 AND borrow_limit < 6
+                                   THEN borrow_limit + 1 ELSE borrow_limit END
+                WHERE id = ?
+                RETURNING name, rewards, borrow_limit;''', (member_id,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return Outcome(False, 'no_member',
+                           f"Error: Member {member_id} not found.")
+        name, rewards, borrow_limit = row
+        self._change('member', member_id)
+        self._event('reward', member_id=member_id, value=rewards)
+
+        if rewards == 0:
+            return Outcome(True, 'limit_raised',
+                           f"Congratulations to {name}! "
+                           f"They have earned 10 rewards and can now borrow"
+                           f" {borrow_limit} books!",
+                           {'borrow_limit': borrow_limit})
+
+        return Outcome(True, 'rewarded', "Reward point earned!",
+                       {'borrow_limit': borrow_limit})
+
+    def _fine(self, member_id, fine_qty=1):
+        """Method to fine a member, inside a transaction. See fine."""
+
+        self._execute('fine', '''
+                    UPDATE users
+                    SET fines = fines + ?, rewards = 0, borrow_limit = 3
+                    WHERE id = ?;''', (fine_qty, member_id))
+        self._change('member', member_id)
+        self._event('fine', member_id=member_id, value=fine_qty)
+        return Outcome(True, 'fined', "Fine has been issued")
+
+    def return_book(self, ISBN, member_id, on_time=None):
+        """Method to record a book returning to library.
+
+        Parameters
+        ----------
+        ISBN: int
+            The ISBN of the book being returned.
+        member_id: int
+            The id of the member who is attempting to return the book.
+        on_time: bool
+            True to give the member a reward for returning it on time,
+            False to fine them for returning it late, or None, the default,
+            to go by the loan's due date. A late loan the overdue sweep
+            (see library_overdue) has already fined for is not fined again.
+
+        Returns
+        -------
+        Outcome
+            status is 'returned' or 'not_on_loan'. data['after'] is the
+            Outcome of the reward or fine, or None, data['loan_id'] is the
+            id of the loan returned and data['late'] is True if it was
+            returned after its due date. data['hold_for'] is the id of the
+            member the copy has been set aside for, if someone has the book
+            on hold, otherwise None.
+
+        Notes
+        -----
+            The return, the reward or fine and setting the copy aside are
+            one transaction."""
+
+        with self._transaction():
+            returned = self._return_loan(ISBN, member_id)
+            if returned is None:
+                return Outcome(False, 'not_on_loan',
+                               f"Error: Member {member_id} does not have "
+                               "this book on loan.")
+            loan_id, due_on_time, fined = returned
+            after = self._after_return(member_id, on_time, due_on_time, fined)
+            hold_for = self._allocate(ISBN)
+
+        return Outcome(True, 'returned', self._returned_message(hold_for),
+                       {'after': after, 'loan_id': loan_id,
+                        'late': not due_on_time, 'hold_for': hold_for})
+
+    @staticmethod
+    def _returned_message(hold_for):
+        """Method to word the message for a return."""
+
+        if hold_for is None:
+            return "Book successfully returned."
+        return ("Book successfully returned. Please set it aside for member "
+                f"{hold_for}, who has it on hold.")
+
+    def return_loan(self, loan_id, on_time=None):
+        """Method to record a book returning to library by its loan id.
+
+        Parameters
+        ----------
+        loan_id: int
+            The id of the loan, as given when the book was borrowed.
+        on_time: bool
+            As for return_book.
+
+        Returns
+        -------
+        Outcome
+            As for return_book, with data['isbn'] and data['member_id'] of
+            the loan. status is 'not_on_loan' if there is no open loan with
+            that id."""
+
+        with self._transaction():
+            self._execute('return_loan.update', '''
+                    UPDATE records
+                    SET day_in = CAST(julianday('now') - 2440587.5 AS INTEGER)
+                    WHERE loan_id = ? AND day_in IS NULL
+                    RETURNING isbn, user_id, day_in <= day_due, fined;''',
+                          (loan_id,))
+            returned = self.cursor.fetchone()
+            if returned is None:
+                return Outcome(False, 'not_on_loan',
+                               f"Error: Loan {loan_id} is not out on loan.")
+            ISBN, member_id, due_on_time, fined = returned
+            self._change('book', ISBN)
+            self._change('member', member_id)
+            self._event('return_book', ISBN, member_id, loan_id)
+            after = self._after_return(member_id, on_time, due_on_time, fined)
+            hold_for = self._allocate(ISBN)
+
+        return Outcome(True, 'returned', self._returned_message(hold_for),
+                       {'after': after, 'loan_id': loan_id,
+                        'late': not due_on_time, 'hold_for': hold_for,
+                        'isbn': ISBN, 'member_id': member_id})
+
+    def borrow_book(self, ISBN, member_id):
+        """Method to borrow a book from the library.
+
+        Parameters
+        ----------
+        ISBN: int
+            The ISBN of the book to be borrowed.
+        member_id: int
+            The id of the member wishing to borrow the book.
+
+        Returns
+        -------
+        Outcome
+            status is 'borrowed', or the reason the book cannot be borrowed:
+            'no_member', 'no_stock', 'has_copy', 'has_fines' or
+            'limit_reached'. data['loan_id'] is the id of a new loan, to
+            return it by (see return_loan), and data['due'] the date it is
+            due back, LOAN_DAYS from today.
+
+        Notes
+        -----
+            The loan is only recorded if every check passes, in the same
+            statement, so two desks cannot both lend the last copy. Copies
+            set aside for holds can only be borrowed by the member they are
+            set aside for, which collects their hold."""
+
+        with self._transaction():
+            # Record the loan if the book is on the shelf (or set aside for
+            # this member), the member does not already have a copy, has no
+            # fines and is under their borrowing limit:
+            self._execute('borrow_book.insert', '''
+                    INSERT INTO records(isbn, user_id, day_out, day_due)
+                    SELECT bk.isbn, u.id,
+                    CAST(julianday('now') - 2440587.5 AS INTEGER),
+                    CAST(julianday('now') - 2440587.5 AS INTEGER) + ?
+                    FROM books AS bk, users AS u
+                    WHERE bk.isbn = ? AND u.id = ?
+                    AND (bk.stock > bk.on_loan + bk.on_hold OR EXISTS (
+                        SELECT 1 FROM holds
+                        WHERE user_id = u.id AND isbn = bk.isbn
+                        AND day_ready IS NOT NULL))
+                    AND u.fines <= 0
+                    AND NOT EXISTS (
+                        SELECT 1 FROM records
+                        WHERE isbn = bk.isbn AND user_id = u.id
+                        AND day_in IS NULL)
+                    AND u.borrow_limit > u.open_loans
+                    RETURNING loan_id, DATE(day_due + 2440587.5),
+                    (SELECT name FROM users WHERE id = user_id), day_due;''',
+                          (LOAN_DAYS, ISBN, member_id))
+            borrowed = self.cursor.fetchone()
+            if borrowed:
+                # The member's hold on the book, if any, is collected:
+                self._execute('borrow_book.collect', '''
+                        DELETE FROM holds
+                        WHERE user_id = ? AND isbn = ?;''', (member_id, ISBN))
+                self._change('book', ISBN)
+                self._change('member', member_id)
+                self._event('borrow_book', ISBN, member_id, borrowed[0],
+                            borrowed[3])
+                return Outcome(True, 'borrowed', f"{borrowed[2]} "
+                               f"successfully checked out {ISBN}, due back "
+                               f"{borrowed[1]}",
+                               {'loan_id': borrowed[0], 'due': borrowed[1]})
+
+            # Nothing was recorded, find out why:
+            self._execute('borrow_book.refused', '''
+                    SELECT u.name, u.fines, u.borrow_limit - u.open_loans,
+                    EXISTS(
+                        SELECT 1 FROM books
+                        WHERE isbn = ? AND stock > on_loan + on_hold)
+                    OR EXISTS(
+                        SELECT 1 FROM holds
+                        WHERE user_id = u.id AND isbn = ?
+                        AND day_ready IS NOT NULL),
+                    EXISTS(
+                        SELECT 1 FROM records
+                        WHERE isbn = ? AND user_id = u.id
+                        AND day_in IS NULL)
+                    FROM users AS u
+                    WHERE u.id = ?;''', (ISBN, ISBN, ISBN, member_id))
+            check_user = self.cursor.fetchone()
+
+        if not check_user:
+            # Not a library member
+            return Outcome(False, 'no_member',
+                           f"Error: Member {member_id} not found.")
+        elif not check_user[3]:
+            # No copies left on the shelves (see place_hold)
+            return Outcome(False, 'no_stock',
+                           "Error: All copies are currently out on loan "
+                           "or on hold.")
+        elif check_user[4]:
+            # User has already taken the book out
+            return Outcome(False, 'has_copy',
+                           f"Error: {check_user[0]} has already got a "
+                           "copy on loan.")
+        elif check_user[1] > 0:
+            # User has fines
+            return Outcome(False, 'has_fines',
+                           f"Error: {check_user[0]} has outstanding "
+                           "fines to be paid before borrowing.")
+        # User has reached borrowing limit
+        return Outcome(False, 'limit_reached',
+                       f"Error: {check_user[0]} has reached their "
+                       "borrowing limit.")
+
+    def pay_fine(self, member_id):
+        """Method to record that a member's fines have been paid.
+
+        Parameters
+        ----------
+        member_id: int
+            The id of the member paying a fine.
+
+        Returns
+        -------
+        Outcome
+            status is 'paid', 'no_fines' or 'no_member'. data['amount'] is
+            the amount paid in pounds.
+
+        Notes
+        -----
+            Holds passed over while the member had fines are given any copy
+            of the book now on the shelf (see place_hold)."""
+
+        with self._transaction():
+            # Check if a member has an outstanding fine:
+            self._execute('pay_fine.check',
+                          '''SELECT fines FROM users WHERE id = ?;''',
+                          (member_id,))
+            member = self.cursor.fetchone()
+            if member is None:
+                return Outcome(False, 'no_member',
+                               f"Error: Member {member_id} not found.",
+                               {'amount': 0})
+            fine_number = member[0]
+
+            if fine_number == 0:
+                # Member does not have any fines
+                return Outcome(False, 'no_fines', "No fines to pay.",
+                               {'amount': 0})
+
+            # Clears the fine (as if been paid):
+            self._execute('pay_fine.update',
+                          '''UPDATE users SET fines = 0 WHERE id = ?;''',
+                          (member_id,))
+            self._change('member', member_id)
+            self._event('pay_fine', member_id=member_id, value=fine_number)
+
+            # Set aside copies left on the shelf while the member could not
+            # be given them:
+            self._execute('pay_fine.holds', '''
+                    SELECT h.isbn FROM holds AS h, books AS bk
+                    WHERE h.user_id = ? AND h.day_ready IS NULL
+                    AND bk.isbn = h.isbn
+                    AND bk.stock > bk.on_loan + bk.on_hold;''', (member_id,))
+            for (ISBN,) in self.cursor.fetchall():
+                self._allocate(ISBN)
+
+        # Calculates fine cost:
+        fine_total = fine_number * 1.50
+        return Outcome(True, 'paid', "Fines successfully paid.",
+                       {'amount': fine_total})
+
+    def reward(self, member_id):
+        """Method to give a user a reward for returning books on time.
+
+        Parameters
+        ----------
+        member_id: int
+            The id of the member getting a reward point.
+
+        Returns
+        -------
+        Outcome
+            status is 'limit_raised' when the reward takes the member to a
+            higher borrowing limit, otherwise 'rewarded', or 'no_member'.
+
+        Notes
+        -----
+            The borrowing limit is increased by 1 book each time 10 rewards
+            are collected, until 6 books can be borrowed. Rewards are reset
+            each time the borrowing limit is increased. Returns give the
+            reward themselves (see return_book)."""
+
+        with self._transaction():
+            return self._reward(member_id)
+
+    def fine(self, member_id, fine_qty=1):
+        """Method to give the user a fine for a late return / lost book.
+
+        Parameters
+        ----------
+        member_id: int
+            The id of the member being given a fine.
+        fine_qty: int
+            The number of fines. This can be used to charge a larger amount
+            for a lost book.
+
+        Returns
+        -------
+        Outcome
+            status is 'fined', or 'no_member'."""
+
+        with self._transaction():
+            if not self.member_exists(member_id):
+                return Outcome(False, 'no_member',
+                               f"Error: Member {member_id} not found.")
+            return self._fine(member_id, fine_qty)
+
+    # --------------------------------------------------------------------
+    # Holds
+    # --------------------------------------------------------------------
+
+    def place_hold(self, ISBN, member_id):
+        """Method to put a member in the queue for a book with every copy
+        out.
+
+        Parameters
+        ----------
+        ISBN: int
+            The ISBN of the book wanted.
+        member_id: int
+            The id of the member wanting it.
+
+        Returns
+        -------
+        Outcome
+            status is 'placed', or the reason the hold cannot be placed:
+            'no_member', 'no_book', 'has_copy', 'has_hold' or 'available'
+            (a copy is on the shelf to borrow). data['hold_id'] is the id
+            of the new hold and data['position'] its place in the queue.
+
+        Notes
+        -----
+            Holds are served first come first served. When a copy comes
+            back (see return_book), or new copies are added, it is set
+            aside for the first member in the queue without unpaid fines,
+            who then has PICKUP_DAYS to borrow it before the hold expires
+            (see library_holds)."""
+
+        with self._transaction():
+            # Join the end of the queue if no copy is on the shelf and the
+            # member has neither a copy nor a hold already:
+            self._execute('place_hold.insert', '''
+                    INSERT INTO holds(isbn, user_id, day_placed)
+                    SELECT bk.isbn, u.id,
+                    CAST(julianday('now') - 2440587.5 AS INTEGER)
+                    FROM books AS bk, users AS u
+                    WHERE bk.isbn = ? AND u.id = ?
+                    AND bk.stock <= bk.on_loan + bk.on_hold
+                    AND NOT EXISTS (
+                        SELECT 1 FROM records
+                        WHERE isbn = bk.isbn AND user_id = u.id
+                        AND day_in IS NULL)
+                    AND NOT EXISTS (
+                        SELECT 1 FROM holds
+                        WHERE user_id = u.id AND isbn = bk.isbn)
+                    RETURNING hold_id,
+                    (SELECT name FROM users WHERE id = user_id);''',
+                          (ISBN, member_id))
+            placed = self.cursor.fetchone()
+            if placed:
+                self._change('book', ISBN)
+                # The new hold is the last of the book's waiting holds:
+                position = self._book(ISBN)[6]
+                return Outcome(True, 'placed',
+                               f"{placed[1]} is number {position} in the "
+                               f"queue for {ISBN}.",
+                               {'hold_id': placed[0], 'position': position})
+
+            # Nothing was placed, find out why:
+            self._execute('place_hold.refused', '''
+                    SELECT u.name,
+                    EXISTS(
+                        SELECT 1 FROM books WHERE isbn = ?),
+                    EXISTS(
+                        SELECT 1 FROM records
+                        WHERE isbn = ? AND user_id = u.id
+                        AND day_in IS NULL),
+                    EXISTS(
+                        SELECT 1 FROM holds
+                        WHERE user_id = u.id AND isbn = ?)
+                    FROM users AS u
+                    WHERE u.id = ?;''', (ISBN, ISBN, ISBN, member_id))
+            check_user = self.cursor.fetchone()
+
+        if not check_user:
+            # Not a library member
+            return Outcome(False, 'no_member',
+                           f"Error: Member {member_id} not found.")
+        elif not check_user[1]:
+            # Not a library book
+            return Outcome(False, 'no_book',
+                           "Error: This is not a book from the library.")
+        elif check_user[2]:
+            # User already has the book
+            return Outcome(False, 'has_copy',
+                           f"Error: {check_user[0]} has already got a "
+                           "copy on loan.")
+        elif check_user[3]:
+            # User is already in the queue
+            return Outcome(False, 'has_hold',
+                           f"Error: {check_user[0]} already has this book "
+                           "on hold.")
+        # A copy is on the shelf
+        return Outcome(False, 'available',
+                       "Error: A copy is on the shelf, please borrow it "
+                       "instead.")
+
+    def cancel_hold(self, ISBN, member_id):
+        """Method to take a member out of the queue for a book.
+
+        Parameters
+        ----------
+        ISBN: int
+            The ISBN of the book on hold.
+        member_id: int
+            The id of the member who placed the hold.
+
+        Returns
+        -------
+        Outcome
+            status is 'cancelled' or 'no_hold'. If a copy had been set
+            aside for the member, it goes to the next in the queue, and
+            data['hold_for'] is their id (otherwise None)."""
+
+        with self._transaction():
+            self._execute('cancel_hold', '''
+                    DELETE FROM holds
+                    WHERE user_id = ? AND isbn = ?
+                    RETURNING day_ready IS NOT NULL;''', (member_id, ISBN))
+            cancelled = self.cursor.fetchone()
+            if cancelled is None:
+                return Outcome(False, 'no_hold',
+                               f"Error: Member {member_id} does not have "
+                               "this book on hold.")
+            self._change('book', ISBN)
+            hold_for = self._allocate(ISBN) if cancelled[0] else None
+
+        if hold_for is None:
+            return Outcome(True, 'cancelled', "Hold cancelled.",
+                           {'hold_for': None})
+        return Outcome(True, 'cancelled',
+                       f"Hold cancelled. Please set the copy aside for "
+                       f"member {hold_for}, who has it on hold.",
+                       {'hold_for': hold_for})
+
+    def member_holds(self, member_id):
+        """Method to list the books a member has on hold.
+
+        Parameters
+        ----------
+        member_id: int
+            The id of the member.
+
+        Returns
+        -------
+        list
+            (isbn, title, place in queue, date to collect by) tuples, in
+            the order the holds were placed. The place is None once a copy
+            has been set aside, and the date None until then.
+
+        Notes
+        -----
+            A place in the queue is counted from the holds_queue index, so
+            takes longer the further back the member is."""
+
+        self._read('member_holds', '''
+                    SELECT h.isbn, bk.title,
+                    CASE WHEN h.day_ready IS NULL THEN (
+                        SELECT COUNT(*) FROM holds AS q
+                        WHERE q.isbn = h.isbn AND q.day_ready IS NULL
+                        AND q.hold_id <= h.hold_id) END,
+                    DATE(h.day_expires + 2440587.5)
+                    FROM holds AS h
+                    LEFT JOIN books AS bk
+                    ON h.isbn = bk.isbn
+                    WHERE h.user_id = ?
+                    ORDER BY h.hold_id;''', (member_id,))
+        return self.read_cursor.fetchall()
+
+    # --------------------------------------------------------------------
+    # Stock and members
+    # --------------------------------------------------------------------
+
+    def add_book(self, ISBN, book_title, book_author, book_stock):
+        """Method to add a new book to the library stock.
+
+        Parameters
+        ----------
+        ISBN: int
+            The ISBN of the new book.
+        book_title: str
+            The title of the book.
+        book_author: str
+            The author of the book.
+        book_stock: int
+            The number of copies the library owns.
+
+        Returns
+        -------
+        Outcome
+            status is 'added', or 'exists' if the ISBN is already in the
+            library (use add_stock instead)."""
+
+        with self._transaction():
+            if self.book_exists(ISBN):
+                return Outcome(False, 'exists',
+                               "This book is already in stock.")
+
+            # Records the new book record in books table:
+            self._execute('add_book', '''
+                    INSERT INTO books(isbn, title, author, stock)
+                    VALUES(?,?,?,?);
+                    ''', (ISBN, book_title, book_author, book_stock))
+            self._change('book', ISBN)
+            self._event('add_book', ISBN, value=book_stock)
+        return Outcome(True, 'added',
+                       f"{book_stock} copies of {book_title} added to database.")
+
+    def add_stock(self, ISBN, add_stock):
+        """Method to add more copies of a book to the library stock.
+
+        Parameters
+        ----------
+        ISBN: int
+            The ISBN of a book already in the library.
+        add_stock: int
+            The number of copies to add.
+
+        Returns
+        -------
+        Outcome
+            status is 'stock_updated'. data['hold_for'] lists the members
+            new copies have been set aside for, from the book's holds."""
+
+        # Updates number of copies:
+        with self._transaction():
+            self._execute('add_stock', '''
+                    UPDATE books
+                    SET stock = stock + ?
+                    WHERE isbn = ?;''', (add_stock, ISBN))
+            self._change('book', ISBN)
+            self._event('add_stock', ISBN, value=add_stock)
+
+            # The new copies go to the holds queue first:
+            hold_for = []
+            for _ in range(add_stock):
+                member_id = self._allocate(ISBN)
+                if member_id is None:
+                    break
+                hold_for.append(member_id)
+
+        if hold_for:
+            return Outcome(True, 'stock_updated',
+                           f"Stock updated. Please set {len(hold_for)} "
+                           f"copies aside for members {hold_for}, who have "
+                           "it on hold.", {'hold_for': hold_for})
+        return Outcome(True, 'stock_updated', "Stock updated.",
+                       {'hold_for': hold_for})
+
+    def remove_book(self, ISBN, bad_member=None):
+        """Method to remove a book from stock, e.g. when lost.
+
+        Parameters
+        ----------
+        ISBN: int
+            The ISBN of the book being removed from stock.
+        bad_member: int
+            The id of the member who lost / damaged a copy on loan, or None
+            to remove a copy from the shelf.
+
+        Returns
+        -------
+        Outcome
+            status is 'removed', or 'no_stock', 'all_on_loan' or 'not_on_loan'
+            if no copy can be removed that way.
+
+        Notes
+        -----
+            A member who lost the book has it returned and is given 5 fines."""
+
+        with self._transaction():
+            # Checks stock is more than 0:
+            book = self._book(ISBN)
+            if not book or not book[3]:
+                return Outcome(False, 'no_stock',
+                               "Error: There are no copies of this book "
+                               "stocked.")
+
+            # Checks if there is a copy on the shelf (copies set aside for
+            # holds are kept for the members waiting for them):
+            if bad_member is None and book[3] <= book[4] + book[5]:
+                return Outcome(False, 'all_on_loan',
+                               "Error: All stock is on loan or on hold, "
+                               "please enter a user")
+            elif bad_member is not None:
+                check_list = self.loan_holders(ISBN)
+                if bad_member not in check_list:
+                    return Outcome(False, 'not_on_loan',
+                                   "Error: Incorrect member number")
+                # Returns the book to stock and fines member:
+                self._return_loan(ISBN, bad_member)
+                self._fine(bad_member, 5)
+
+            # Reduce stock of the book by 1:
+            self._execute('remove_book.update',
+                          '''UPDATE books SET stock = stock - 1
+                          WHERE isbn = ?;''', (ISBN,))
+            self._change('book', ISBN)
+            self._event('remove_book', ISBN, bad_member)
+        return Outcome(True, 'removed',
+                       "One copy successfully removed from the stock record.")
+
+    def add_member(self, user_name):
+        """Method to add a new member to the database.
+
+        Parameters
+        ----------
+        user_name: str
+            The name of the member being added to the database.
+
+        Returns
+        -------
+        Outcome
+            status is 'added', or 'no_ids' if there are no membership
+            numbers left. data['id'] is the new membership number."""
+
+        try:
+            if self.transactions is None:
+                # Spare numbers are reserved ahead, outside this
+                # transaction, so none are kept if it rolls back:
+                self.ids.reserve()
+            with self._transaction():
+                # Obtains an ID for the new member, in this transaction:
+                new_id = self.user_id(False)
+
+                # Creates a record for the new member:
+                self._execute('add_member', '''
+                        INSERT INTO users(id, name, fines, rewards,
+                        borrow_limit)
+                        VALUES(?,?,0,0,3);
+                        ''', (new_id, user_name))
+                self._change('member', new_id)
+                self._event('add_member', member_id=new_id)
+        except IdSpaceExhausted as e:
+            return Outcome(False, 'no_ids', f"Error: {e}")
+        return Outcome(True, 'added',
+                       f"Membership number {new_id}, {user_name} "
+                       "added to database.", {'id': new_id})
+
+    def check_counters(self):
+        """Method to recount the counters kept by triggers: each book's
+        copies on loan and on hold and holds waiting, and each member's
+        books on loan.
+
+        Returns
+        -------
+        list
+            A (counter, key, stored count, actual count) tuple for each
+            counter that was wrong and has been corrected (see
+            library_schema.rebuild_counters)."""
+
+        drift = rebuild_counters(self.db)
+        if drift and self.cache is not None:
+            self.cache.clear()
+        return drift
+
+    # --------------------------------------------------------------------
+    # Searches and reports
+    # --------------------------------------------------------------------
+
+    def search_books(self, column_name, search_for, limit=50):
+        """Method to search for books in the library.
+
+        Parameters
+        ----------
+        column_name: str
+            The column to be searched, either 'title' or 'author', or None
+            to search both.
+        search_for: str
+            The string the user wishes to look for.
+        limit: int
+            The maximum number of books to return.
+
+        Returns
+        -------
+        list
+            (isbn, title, author) tuples, best matches first.
+
+        Notes
+        -----
+            Every word in the search term must match the start of a word in
+            the title or author, e.g. 'tolk hob' finds 'The Hobbit' by
+            J.R.R. Tolkien."""
+
+        if column_name not in ('title', 'author', None):
+            raise ValueError(f"Cannot search books by {column_name}")
+
+        # Builds a full text query from the words in the search term. Each
+        # word is quoted, so FTS5 syntax is not used by accident, and
+        # matched as a prefix:
+        words = re.findall(r'\w+', search_for)
+        if not words:
+            return []
+        match = ' '.join('"%s"*' % word for word in words)
+        if column_name:
+            match = '%s : (%s)' % (column_name, match)
+
+        self._read('search_books', '''
+                SELECT rowid, title, author
+                FROM books_fts
+                WHERE books_fts MATCH ?
+                ORDER BY rank
+                LIMIT ?;''', (match, limit))
+        return self.read_cursor.fetchall()
+
+    def book_record(self, ISBN):
+        """Method to get the record for a book.
+
+        Parameters
+        ----------
+        ISBN: int
+            The ISBN to get the record for.
+
+        Returns
+        -------
+        tuple
+            (isbn, title, author, copies available), or None if the book
+            is not in the library. Copies set aside for holds are not
+            available."""
+
+        book = self._book(ISBN)
+        return book[:3] + (book[3] - book[4] - book[5],) if book else None
+
+    def all_books(self, after=None, limit=None):
+        """Method to get the records for the books in the library, in ISBN
+        order.
+
+        Parameters
+        ----------
+        after: int
+            Only return books with an ISBN after this one, e.g. the last
+            ISBN of the previous page. None to start from the beginning.
+        limit: int
+            The most books to return, or None for all of them.
+
+        Returns
+        -------
+        list
+            (isbn, title, author, stock, copies on shelf) tuples. Copies
+            set aside for holds are not on the shelf.
+
+        Notes
+        -----
+            Each page is found by ISBN rather than by OFFSET, so later pages
+            are as quick to fetch as the first (see library_reports)."""
+
+        self._read('all_books', '''
+                    SELECT isbn, title, author, stock,
+                    stock - on_loan - on_hold
+                    FROM books
+                    WHERE isbn > ?
+                    ORDER BY isbn
+                    LIMIT ?;''', (after or 0, -1 if limit is None else limit))
+        return self.read_cursor.fetchall()
+
+    def loaned_books(self, after=None, limit=None):
+        """Method to get the records for books out on loan.
+
+        Parameters
+        ----------
+        after: tuple
+            Only return loans after this (isbn, member id), e.g. from the
+            last loan of the previous page. None to start from the
+            beginning.
+        limit: int
+            The most loans to return, or None for all of them.
+
+        Returns
+        -------
+        list
+            (isbn, title, author, member id, member name, date borrowed,
+            date due) tuples, in ISBN then member id order."""
+
+        self._read('loaned_books', '''
+                    SELECT
+                     rc.isbn,
+                     bk.title,
+                     bk.author,
+                     rc.user_id,
+                     u.name,
+                     DATE(rc.day_out + 2440587.5),
+                     DATE(rc.day_due + 2440587.5)
+                    FROM records AS rc
+                    INNER JOIN books AS bk
+                    ON rc.isbn = bk.isbn
+                    INNER JOIN users AS u
+                    ON rc.user_id = u.id
+                    WHERE rc.day_in IS NULL
+                    AND (rc.isbn, rc.user_id) > (?, ?)
+                    ORDER BY rc.isbn, rc.user_id
+                    LIMIT ?;''', (*(after or (0, 0)),
+                                   -1 if limit is None else limit))
+        return self.read_cursor.fetchall()
+
+    def member_record(self, member_id):
+        """Method to get the record for a library member.
+
+        Parameters
+        ----------
+        member_id: int
+            The id of the member.
+
+        Returns
+        -------
+        tuple
+            (id, name, fines, rewards, borrow limit, books on loan), or None
+            if the member does not exist."""
+
+        return self._member(member_id)
+
+    def loan_history(self, member_id):
+        """Method to get every loan a member has made, open or returned.
+
+        Parameters
+        ----------
+        member_id: int
+            The id of the member.
+
+        Returns
+        -------
+        list
+            (isbn, title, date borrowed, date returned) tuples, most recent
+            first. The date returned is None for books still on loan.
+
+        Notes
+        -----
+            Reads the all_loans view, so it includes loans archived to
+            loan_history (see library_archive)."""
+
+        self._read('loan_history', '''
+                    SELECT al.isbn, bk.title, DATE(al.day_out + 2440587.5),
+                    DATE(al.day_in + 2440587.5)
+                    FROM all_loans AS al
+                    LEFT JOIN books AS bk
+                    ON al.isbn = bk.isbn
+                    WHERE al.user_id = ?
+                    ORDER BY al.day_out DESC;''', (member_id,))
+        return self.read_cursor.fetchall()
+
+    def members(self, after=None, limit=None):
+        """Method to get the records for library members, in id order.
+
+        Parameters
+        ----------
+        after: int
+            Only return members with an id after this one, e.g. the last id
+            of the previous page. None to start from the beginning.
+        limit: int
+            The most members to return, or None for all of them.
+
+        Returns
+        -------
+        list
+            (id, name, fines, rewards, borrow limit) tuples."""
+
+        self._read('members', '''
+                    SELECT id, name, fines, rewards, borrow_limit
+                    FROM users
+                    WHERE id > ?
+                    ORDER BY id
+                    LIMIT ?;''', (after or 0, -1 if limit is None else limit))
+        return self.read_cursor.fetchall()
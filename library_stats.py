@@ -0,0 +1,241 @@
+"""
+Timing of the SQL statements run by the library.
+
+LibraryService runs every statement under a name for the operation it is
+part of, e.g. 'borrow_book.insert' or 'search_books'. Given a QueryStats
+object, the service times each statement and records it under that name.
+Without one (the default) statements are run directly, at the cost of one
+extra function call.
+
+Statements slower than a threshold are also kept as slow queries, together
+with their query plan, and can be appended to a log file of JSON lines. The
+first statement run under each name is kept too, so that the statements the
+library runs can be checked against a database (see
+library_schema.check_query_plans).
+
+Classes
+-------
+QueryStats:
+    Collects the timings of the statements run by one or more services.
+
+Functions
+---------
+percentiles:
+    Summarises a list of latencies.
+execute:
+    Runs a statement, timed by a QueryStats if there is one.
+"""
+
+import collections
+import json
+import statistics
+import threading
+import time
+
+
+# Statements taking longer than this (in ms) are logged as slow.
+SLOW_MS = 100.0
+
+
+def percentiles(samples):
+    """Function to summarise a list of latencies in seconds.
+
+    Returns
+    -------
+    dict
+        The count, and the mean, p50, p95 and p99 latencies in
+        milliseconds."""
+
+    count = len(samples)
+    if count < 2:
+        samples = samples * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {'count': count, 'mean_ms': statistics.fmean(samples) * 1000,
+            'p50_ms': cuts[49] * 1000, 'p95_ms': cuts[94] * 1000,
+            'p99_ms': cuts[98] * 1000}
+
+
+class QueryStats:
+    """Collects the timings of SQL statements by operation name.
+
+    One QueryStats can be shared by several services, e.g. every desk
+    served from a LibraryPools.
+
+    Parameters
+    ----------
+    slow_ms: float
+        Statements taking longer than this many milliseconds are kept as
+        slow queries.
+    slow_log: str
+        A file to append each slow query to as a line of JSON, or None to
+        only keep the most recent ones in memory.
+    samples: int
+        The most recent timings kept for each name to work out the
+        percentiles. The count, total and slowest time cover every
+        statement.
+
+    Notes
+    -----
+        The time recorded for a query is the time to run it up to its first
+        row. A report that fetches many rows spends more time after that."""
+
+    def __init__(self, slow_ms=SLOW_MS, slow_log=None, samples=10000):
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._plans = {}
+        # name: (sql, params) of the first statement run under the name
+        self._statements = {}
+        self.reset()
+
+    def reset(self):
+        """Method to clear all the timings and slow queries collected."""
+
+        with self._lock:
+            # name: [count, total seconds, slowest seconds, recent times]
+            self._timings = {}
+            self._slow = collections.deque(maxlen=50)
+
+    def execute(self, cursor, label, sql, params=()):
+        """Method to run and time a statement.
+
+        Parameters
+        ----------
+        cursor: sqlite3.Cursor
+            The cursor to run the statement on.
+        label: str
+            The name to record the time under.
+        sql: str
+            The statement.
+        params: tuple
+            The statement's parameters.
+
+        Returns
+        -------
+        sqlite3.Cursor
+            The cursor, as returned by cursor.execute."""
+
+        start = time.perf_counter()
+        try:
+            return cursor.execute(sql, params)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                timing = self._timings.get(label)
+                if timing is None:
+                    timing = self._timings[label] = [
+                        0, 0.0, 0.0, collections.deque(maxlen=self.samples)]
+                    self._statements.setdefault(label, (sql, tuple(params)))
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+                timing[3].append(elapsed)
+            if elapsed * 1000 > self.slow_ms:
+                self._log_slow(cursor, label, sql, params, elapsed)
+
+    def statements(self):
+        """Method to get the statements run so far.
+
+        Returns
+        -------
+        dict
+            The (sql, params) of the first statement run under each name,
+            by name."""
+
+        with self._lock:
+            return dict(self._statements)
+
+    def _plan(self, cursor, sql, params):
+        """Method to get the query plan for a statement, as a list of the
+        plan's lines. Plans are remembered for each statement."""
+
+        plan = self._plans.get(sql)
+        if plan is None:
+            # A separate cursor, so the slow query's rows are not lost:
+            explain = cursor.connection.cursor()
+            try:
+                explain.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = [row[3] for row in explain.fetchall()]
+            except Exception as e:
+                plan = [f"Error: {e}"]
+            finally:
+                explain.close()
+            self._plans[sql] = plan
+        return plan
+
+    def _log_slow(self, cursor, label, sql, params, elapsed):
+        """Method to record a slow query and its plan."""
+
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'label': label,
+                 'ms': round(elapsed * 1000, 3), 'sql': ' '.join(sql.split()),
+                 'params': [str(param) for param in params],
+                 'plan': self._plan(cursor, sql, params)}
+        with self._lock:
+            self._slow.append(entry)
+            if self.slow_log:
+                with open(self.slow_log, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry) + '\n')
+
+    def summary(self):
+        """Method to summarise the timings collected.
+
+        Returns
+        -------
+        dict
+            For each name: the count, total_ms, max_ms and the mean, p50,
+            p95 and p99 times in milliseconds (see percentiles),
+            most total time first."""
+
+        with self._lock:
+            timings = {label: (count, total, slowest, list(recent))
+                       for label, (count, total, slowest, recent)
+                       in self._timings.items()}
+
+        summary = {}
+        for label, (count, total, slowest, recent) in sorted(
+                timings.items(), key=lambda item: -item[1][1]):
+            summary[label] = percentiles(recent)
+            summary[label].update({'count': count, 'total_ms': total * 1000,
+                                   'mean_ms': total / count * 1000,
+                                   'max_ms': slowest * 1000})
+        return summary
+
+    def slow_queries(self):
+        """Method to get the most recent slow queries.
+
+        Returns
+        -------
+        list
+            Dictionaries with the time, label, ms, sql, params and plan of
+            each slow query, oldest first."""
+
+        with self._lock:
+            return list(self._slow)
+
+
+def execute(cursor, stats, label, sql, params=()):
+    """Function to run a statement, timed under label when query statistics
+    are being kept, as LibraryService does.
+
+    Parameters
+    ----------
+    cursor: sqlite3.Cursor
+        The cursor to run the statement on.
+    stats: QueryStats
+        The statistics to time it in, or None to run it directly.
+    label: str
+        The name to record the time under.
+    sql: str
+        The statement.
+    params: tuple
+        The statement's parameters.
+
+    Returns
+    -------
+    sqlite3.Cursor
+        The cursor, as returned by cursor.execute."""
+
+    if stats is None:
+        return cursor.execute(sql, params)
+    return stats.execute(cursor, label, sql, params)
@@ -0,0 +1,249 @@
+"""
+Commit handling and durability profiles for library changes.
+
+Each change LibraryService makes (a borrow, a return, a new member, ...) is
+one transaction. Committing a transaction can mean waiting for the disk, so
+when many desks share one process the commits can limit how many changes a
+second the library manages. A TransactionManager lets changes from several
+threads share one write connection and one commit:
+
+- each change runs inside a SAVEPOINT in the shared transaction, so a change
+  that fails is undone without touching the others;
+- the transaction is committed when it holds group_ops changes, or group_ms
+  after its first change, whichever comes first;
+- with wait=True a change is only reported done once the commit holding it
+  has finished, so a desk never tells a member a loan is recorded before it
+  is safely stored.
+
+Profiles
+--------
+strict:
+    One commit per change, each synced to disk (synchronous=FULL). Nothing
+    acknowledged is ever lost, even on power failure.
+normal:
+    One commit per change, synced at checkpoints (synchronous=NORMAL). The
+    default: a power cut can lose the last few changes, a crash cannot.
+group:
+    Changes from concurrent callers share a commit, synced to disk. As safe
+    as strict, with fewer syncs, but each change can wait up to group_ms.
+bulk:
+    Large groups, not synced (synchronous=OFF), and callers do not wait for
+    the commit. For loading data that can be loaded again if lost; call
+    flush() at the end.
+
+Classes
+-------
+Profile:
+    The settings for a durability profile.
+TransactionManager:
+    Runs changes from many threads on one connection, committing in groups.
+"""
+
+import collections
+import contextlib
+import threading
+import time
+
+
+# synchronous is the PRAGMA synchronous level. Changes are committed in
+# groups of up to group_ops, or group_ms after the first change of a group
+# (None: only when the group is full or flush() is called). wait is True if
+# a change waits for its group to be committed.
+Profile = collections.namedtuple('Profile', ['synchronous', 'group_ops',
+                                             'group_ms', 'wait'])
+
+PROFILES = {
+    'strict': Profile('FULL', 1, None, True),
+    'normal': Profile('NORMAL', 1, None, True),
+    'group': Profile('FULL', 64, 5.0, True),
+    'bulk': Profile('OFF', 10000, None, False),
+}
+
+
+class TransactionManager:
+    """Runs changes from many threads on one write connection, committing
+    them in groups (see the module docstring).
+
+    Parameters
+    ----------
+    db: sqlite3.Connection
+        The write connection to share, opened with check_same_thread=False.
+        Its synchronous level is set for the profile.
+    profile: str
+        'strict', 'normal', 'group' or 'bulk'.
+    group_ops: int
+        Overrides the profile's group size.
+    group_ms: float
+        Overrides the profile's longest wait for a commit, in ms.
+    wait: bool
+        Overrides whether a change waits for its group to be committed.
+        A single thread making changes one after another cannot wait, as
+        no other change would fill its group (see library_cli)."""
+
+    def __init__(self, db, profile='group', group_ops=None, group_ms=None,
+                 wait=None):
+        self.db = db
+        self.profile = PROFILES[profile]
+        self.group_ops = group_ops or self.profile.group_ops
+        self.group_ms = group_ms if group_ms is not None else (
+            self.profile.group_ms)
+        self.wait = wait if wait is not None else self.profile.wait
+
+        # PRAGMA does not accept parameters, the level comes from PROFILES:
+        db.execute('''PRAGMA synchronous = %s;''' % self.profile.synchronous)
+        self.cursor = db.cursor()
+
+        # One change runs at a time. _committed is notified each time the
+        # group number (_group) moves on, i.e. after each commit:
+        self._lock = threading.Lock()
+        self._committed = threading.Condition(self._lock)
+        self._group = 0
+        self._pending = 0
+        self._deadline = None
+        self._failed = {}
+        # Called once the changes made so far are committed (see
+        # after_commit):
+        self._after_commit = []
+
+        # Counts for reporting (see summary):
+        self.commits = 0
+        self.changes = 0
+
+    def _commit(self):
+        """Method to commit the open group. Called holding the lock."""
+
+        try:
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            # Every change in the group is lost, tell their callers:
+            self._failed[self._group] = e
+        self._run_after_commit()
+        self.commits += 1
+        self._pending = 0
+        self._deadline = None
+        self._group += 1
+        self._committed.notify_all()
+
+    def _run_after_commit(self):
+        """Method to call the functions waiting for the last commit (or
+        rollback). Called holding the lock."""
+
+        waiting, self._after_commit = self._after_commit, []
+        for function in waiting:
+            function()
+
+    def after_commit(self, function):
+        """Method to call function once the change being made has been
+        committed, or has been lost with its group. Only to be called
+        inside transaction().
+
+        With wait=False, transaction() returns before the change can be
+        seen by other connections, so anything that must follow the
+        commit, e.g. removing changed rows from a cache, is done here."""
+
+        self._after_commit.append(function)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Method to run one change.
+
+        Yields
+        ------
+        sqlite3.Connection
+            The shared connection, to make the change on. The change is
+            undone if the with block raises an exception.
+
+        Raises
+        ------
+        sqlite3.Error
+            If the commit holding the change fails."""
+
+        with self._lock:
+            if self.group_ops == 1:
+                # No grouping: a plain transaction per change
+                self.cursor.execute('''BEGIN IMMEDIATE;''')
+                try:
+                    yield self.db
+                    self.db.commit()
+                except BaseException:
+                    self.db.rollback()
+                    raise
+                finally:
+                    self._run_after_commit()
+                self.commits += 1
+                self.changes += 1
+                return
+
+            if not self.db.in_transaction:
+                self.cursor.execute('''BEGIN IMMEDIATE;''')
+                if self.group_ms is not None:
+                    self._deadline = (time.perf_counter()
+                                      + self.group_ms / 1000)
+            self.cursor.execute('''SAVEPOINT change;''')
+            try:
+                yield self.db
+            except BaseException:
+                # Undo this change only, the rest of the group stands:
+                self.cursor.execute('''ROLLBACK TO change;''')
+                self.cursor.execute('''RELEASE change;''')
+                raise
+            self.cursor.execute('''RELEASE change;''')
+            self.changes += 1
+            self._pending += 1
+            group = self._group
+
+            if self._pending >= self.group_ops:
+                self._commit()
+            elif not self.wait:
+                return
+
+            # Wait for another change to commit the group, or commit it
+            # when its time is up:
+            while self._group == group:
+                if self._deadline is None:
+                    self._committed.wait()
+                    continue
+                remaining = self._deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._commit()
+                else:
+                    self._committed.wait(remaining)
+
+            error = self._failed.get(group)
+            if error is not None:
+                raise error
+
+    def flush(self):
+        """Method to commit any changes waiting for their group to fill.
+
+        Raises
+        ------
+        sqlite3.Error
+            If the commit fails."""
+
+        with self._lock:
+            if self.db.in_transaction:
+                group = self._group
+                self._commit()
+                error = self._failed.get(group)
+                if error is not None:
+                    raise error
+
+    def summary(self):
+        """Method to report how well changes have been grouped.
+
+        Returns
+        -------
+        dict
+            The number of changes, commits and changes per commit."""
+
+        with self._lock:
+            return {'changes': self.changes, 'commits': self.commits,
+                    'changes_per_commit': self.changes / (self.commits or 1)}
+
+    def close(self):
+        """Method to commit any waiting changes and close the connection."""
+
+        self.flush()
+        self.db.close()